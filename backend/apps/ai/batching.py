@@ -0,0 +1,76 @@
+"""
+Splitting translation work into prompt-sized chunks and running them.
+
+A chunk is a list of texts whose estimated token count fits the budget, so
+neither the prompt nor the JSON answer gets truncated. Chunks run
+concurrently; the ones that fail (an API error, or an answer that does not
+parse) are split in half and retried, and only those are retried.
+"""
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Rough but conservative for LLaMA-style tokenizers: ~4 characters per token
+# for Latin text, and every non-ASCII character counted as a token of its own.
+PER_TEXT_OVERHEAD = 8
+
+
+def estimate_tokens(text):
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars) + PER_TEXT_OVERHEAD
+
+
+def split_by_budget(texts, budget, max_items):
+    """Group texts, in order, into chunks of at most `budget` estimated tokens and `max_items` texts."""
+    chunks, current, used = [], [], 0
+    for text in texts:
+        cost = estimate_tokens(text)
+        if current and (used + cost > budget or len(current) >= max_items):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def translate_in_chunks(texts, translate_chunk, budget=None, max_items=None, workers=None, retries=None):
+    """
+    Run ``translate_chunk(list_of_texts) -> {text: translation}`` over texts in
+    budgeted chunks and merge the results. A chunk that raises, or leaves some
+    of its texts untranslated, has just those texts retried, in halves, up to
+    `retries` more times. Returns ``(translations, failed_texts)``.
+    """
+    budget = budget or getattr(settings, "TRANSLATION_CHUNK_TOKENS", 1500)
+    max_items = max_items or getattr(settings, "TRANSLATION_CHUNK_ITEMS", 50)
+    workers = workers or getattr(settings, "TRANSLATION_WORKERS", 4)
+    retries = getattr(settings, "TRANSLATION_RETRIES", 2) if retries is None else retries
+
+    def attempt(chunk):
+        try:
+            return translate_chunk(chunk) or {}
+        except Exception as e:
+            logger.warning(f"Translation chunk of {len(chunk)} failed: {e}")
+            return {}
+
+    translations = {}
+    pending = split_by_budget(texts, budget, max_items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for round_ in range(retries + 1):
+            failed = []
+            for chunk, result in zip(pending, pool.map(attempt, pending)):
+                translations.update({text: result[text] for text in chunk if text in result})
+                missing = [text for text in chunk if text not in result]
+                if missing:
+                    half = max(1, math.ceil(len(missing) / 2))
+                    failed.extend([missing[:half], missing[half:]] if len(missing) > 1 else [missing])
+            pending = [chunk for chunk in failed if chunk]
+            if not pending or round_ == retries:
+                break
+            logger.info(f"Retrying {sum(map(len, pending))} untranslated text(s) in {len(pending)} chunk(s)")
+    return translations, [text for chunk in pending for text in chunk]
@@ -0,0 +1,307 @@
+"""
+One pool of LLM API keys per process, shared by every GroqService.
+
+Each key has:
+
+* a token bucket (``KEY_POOL_RPM`` requests per minute, bursts up to
+  ``KEY_POOL_BURST``), so we stay under the provider's per-key limit instead of
+  finding it with 429s;
+* a circuit breaker: ``KEY_POOL_FAILURE_THRESHOLD`` consecutive failures open
+  it for ``KEY_POOL_COOLDOWN`` seconds (doubling on every failed probe, up to
+  ``KEY_POOL_MAX_COOLDOWN``). After the cooldown one request is let through
+  half-open; success closes the breaker. A rejected key (401/403) is disabled
+  for good.
+
+``acquire`` picks the least-loaded usable key (fewest requests in flight,
+then fewest sent) and waits up to ``KEY_POOL_MAX_WAIT`` seconds for a token
+if every usable key is rate limited.
+
+With ``KEY_POOL_CACHE`` set to a shared cache alias, open breakers and
+per-minute request counts are also kept there, so several workers respect
+one limit and skip a key another worker found broken.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN, DISABLED = "closed", "open", "half_open", "disabled"
+
+
+class KeyPoolExhausted(Exception):
+    """No key can take a request right now."""
+
+
+def key_id(key):
+    """A short, non-secret name for a key, for logs, metrics and the shared store."""
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+class KeyState:
+    def __init__(self, key, capacity, now):
+        self.key = key
+        self.id = key_id(key)
+        self.tokens = float(capacity)
+        self.refilled_at = now
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.cooldown = 0.0
+        self.open_until = 0.0
+        self.probing = False
+        self.in_flight = 0
+        self.requests = self.successes = self.failures = self.rate_limited = 0
+        self.last_error = None
+
+
+class KeyPool:
+    def __init__(self, keys, rpm=None, burst=None, failure_threshold=None, cooldown=None,
+                 max_cooldown=None, max_wait=None, store=None, clock=time.monotonic):
+        self.rpm = rpm or getattr(settings, "KEY_POOL_RPM", 30)
+        self.capacity = burst or getattr(settings, "KEY_POOL_BURST", 5)
+        self.failure_threshold = failure_threshold or getattr(settings, "KEY_POOL_FAILURE_THRESHOLD", 3)
+        self.base_cooldown = cooldown or getattr(settings, "KEY_POOL_COOLDOWN", 30)
+        self.max_cooldown = max_cooldown or getattr(settings, "KEY_POOL_MAX_COOLDOWN", 600)
+        self.max_wait = getattr(settings, "KEY_POOL_MAX_WAIT", 5) if max_wait is None else max_wait
+        self.store = store
+        self.clock = clock
+        now = clock()
+        self.keys = {key: KeyState(key, self.capacity, now) for key in keys}
+        self.scope = None
+        self._lock = threading.Lock()
+
+    # ---------- local bookkeeping (call with the lock held) ----------
+
+    def _refill(self, s, now):
+        s.tokens = min(self.capacity, s.tokens + (now - s.refilled_at) * self.rpm / 60)
+        s.refilled_at = now
+
+    def _usable(self, s, now):
+        if s.state == DISABLED:
+            return False
+        if s.state == OPEN and now >= s.open_until:
+            s.state, s.probing = HALF_OPEN, False
+        if s.state == OPEN:
+            return False
+        return not (s.state == HALF_OPEN and s.probing)
+
+    def _open(self, s, now, cooldown):
+        s.state, s.probing = OPEN, False
+        s.cooldown = cooldown
+        s.open_until = now + cooldown
+        logger.warning(f"Key {s.id} circuit open for {cooldown:.0f}s")
+
+    def _pick(self, blocked=()):
+        """Take a token from the best key. Returns (key, None) or (None, seconds to wait)."""
+        with self._lock:
+            now = self.clock()
+            usable = [s for s in self.keys.values() if s.id not in blocked and self._usable(s, now)]
+            if not usable:
+                raise KeyPoolExhausted("No API key is available (all disabled or cooling down).")
+            for s in usable:
+                self._refill(s, now)
+            ready = [s for s in usable if s.tokens >= 1]
+            if not ready:
+                return None, min((1 - s.tokens) * 60 / self.rpm for s in usable)
+            best = min(ready, key=lambda s: (s.in_flight, s.requests))
+            best.tokens -= 1
+            best.in_flight += 1
+            best.requests += 1
+            if best.state == HALF_OPEN:
+                best.probing = True
+            return best.key, None
+
+    def _unpick(self, key):
+        """Undo _pick for a key the shared store vetoed."""
+        with self._lock:
+            s = self.keys[key]
+            s.in_flight -= 1
+            s.requests -= 1
+            s.probing = False
+            s.tokens = min(self.capacity, s.tokens + 1)
+
+    # ---------- shared store ----------
+
+    def _store_key(self, kind, s, window=None):
+        suffix = f":{window}" if window is not None else ""
+        return f"keypool:{kind}:{s.id}{suffix}"
+
+    def _store_blocked(self, values, now_wall):
+        """Key ids the shared store says to skip: opened elsewhere or over the shared limit."""
+        blocked = set()
+        for name, value in values.items():
+            kind, kid = name.split(":")[1:3]
+            if kind == "open" and value and value > now_wall:
+                blocked.add(kid)
+            elif kind == "rate" and value and value > self.rpm:
+                blocked.add(kid)
+        return blocked
+
+    def _store_names(self):
+        window = int(time.time() // 60)
+        return [self._store_key(kind, s, window if kind == "rate" else None)
+                for s in self.keys.values() for kind in ("open", "rate")]
+
+    # ---------- public API ----------
+
+    def acquire(self):
+        """Lease the best key for one request, waiting for a token if needed. Pair with release()."""
+        deadline = self.clock() + self.max_wait
+        blocked = set()
+        while True:
+            if self.store is not None:
+                blocked = self._store_blocked(self.store.get_many(self._store_names()), time.time())
+            key, wait = self._pick(blocked)
+            if key is not None:
+                if self.store is None or self._store_admit(key):
+                    return key
+                self._unpick(key)
+                blocked.add(key_id(key))
+                continue
+            if self.clock() + wait > deadline:
+                raise KeyPoolExhausted(f"All API keys are rate limited for another {wait:.1f}s.")
+            time.sleep(wait)
+
+    async def aacquire(self):
+        deadline = self.clock() + self.max_wait
+        blocked = set()
+        while True:
+            if self.store is not None:
+                blocked = self._store_blocked(await self.store.aget_many(self._store_names()), time.time())
+            key, wait = self._pick(blocked)
+            if key is not None:
+                if self.store is None or await self._astore_admit(key):
+                    return key
+                self._unpick(key)
+                blocked.add(key_id(key))
+                continue
+            if self.clock() + wait > deadline:
+                raise KeyPoolExhausted(f"All API keys are rate limited for another {wait:.1f}s.")
+            await asyncio.sleep(wait)
+
+    def _store_admit(self, key):
+        name = self._store_key("rate", self.keys[key], int(time.time() // 60))
+        self.store.add(name, 0, 120)
+        return self.store.incr(name) <= self.rpm
+
+    async def _astore_admit(self, key):
+        name = self._store_key("rate", self.keys[key], int(time.time() // 60))
+        await self.store.aadd(name, 0, 120)
+        return await self.store.aincr(name) <= self.rpm
+
+    def _settle(self, key, error):
+        """Record how a leased key's request went. Returns the breaker to publish, if it opened."""
+        with self._lock:
+            s = self.keys[key]
+            now = self.clock()
+            s.in_flight -= 1
+            s.probing = False
+            if error is None:
+                s.successes += 1
+                s.consecutive_failures = 0
+                s.state, s.cooldown = CLOSED, 0.0
+                return None
+            s.failures += 1
+            s.last_error = f"{type(error).__name__}: {str(error)[:200]}"
+            status = getattr(error, "status_code", None)
+            if status in (401, 403):
+                s.state = DISABLED
+                logger.error(f"Key {s.id} rejected ({status}); disabled")
+                return None
+            if status == 429:
+                s.rate_limited += 1
+                s.tokens = 0
+                retry_after = self._retry_after(error)
+                self._open(s, now, retry_after or self.base_cooldown)
+            else:
+                s.consecutive_failures += 1
+                if s.state == HALF_OPEN:
+                    self._open(s, now, min(self.max_cooldown, max(s.cooldown, self.base_cooldown) * 2))
+                elif s.consecutive_failures >= self.failure_threshold:
+                    self._open(s, now, self.base_cooldown)
+            if s.state == OPEN:
+                return self._store_key("open", s), time.time() + s.open_until - now, s.open_until - now
+        return None
+
+    @staticmethod
+    def _retry_after(error):
+        try:
+            return float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def release(self, key, error=None):
+        """Give back a key from acquire(), with the exception the request raised, if any."""
+        opened = self._settle(key, error)
+        if opened and self.store is not None:
+            name, until, ttl = opened
+            self.store.set(name, until, max(1, int(ttl) + 1))
+
+    async def arelease(self, key, error=None):
+        opened = self._settle(key, error)
+        if opened and self.store is not None:
+            name, until, ttl = opened
+            await self.store.aset(name, until, max(1, int(ttl) + 1))
+
+    def abandon(self, key):
+        """
+        Give back a key whose request was cancelled before it finished. Frees
+        its slot without counting a success or a failure, so a cancelled
+        half-open probe leaves the breaker half-open for the next request.
+        """
+        with self._lock:
+            s = self.keys[key]
+            s.in_flight -= 1
+            s.probing = False
+
+    def snapshot(self):
+        """Per-key metrics, keyed by key id."""
+        with self._lock:
+            now = self.clock()
+            out = {}
+            for s in self.keys.values():
+                self._refill(s, now)
+                out[s.id] = {
+                    "state": OPEN if s.state == OPEN and now < s.open_until else
+                             (HALF_OPEN if s.state == OPEN else s.state),
+                    "in_flight": s.in_flight,
+                    "tokens": round(s.tokens, 2),
+                    "requests": s.requests,
+                    "successes": s.successes,
+                    "failures": s.failures,
+                    "rate_limited": s.rate_limited,
+                    "consecutive_failures": s.consecutive_failures,
+                    "open_for": round(max(0.0, s.open_until - now), 1) if s.state == OPEN else 0.0,
+                    "last_error": s.last_error,
+                }
+            return out
+
+
+def configured_keys():
+    keys_str = os.getenv("GROQ_API_KEYS", os.getenv("GROQ_API_KEY", ""))
+    return tuple(k.strip() for k in keys_str.split(",") if k.strip())
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool():
+    """The process-wide pool for the configured keys (rebuilt if the keys or endpoint change)."""
+    global _pool
+    keys = configured_keys()
+    if not keys:
+        raise ValueError("No Groq API keys found in environment")
+    scope = (keys, os.getenv("GROQ_BASE_URL", ""))
+    with _pool_lock:
+        if _pool is None or _pool.scope != scope:
+            alias = getattr(settings, "KEY_POOL_CACHE", None)
+            _pool = KeyPool(keys, store=caches[alias] if alias else None)
+            _pool.scope = scope
+        return _pool
@@ -0,0 +1,39 @@
+"""Small in-process latency metrics for the AI endpoints."""
+import threading
+from collections import deque
+
+
+class LatencySamples:
+    """The most recent ``size`` latencies (seconds) and their percentiles."""
+
+    def __init__(self, size=1000):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.count = 0
+
+    def snapshot(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+
+        def percentile(p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 1)
+
+        return {"count": count, "p50_ms": percentile(0.5), "p95_ms": percentile(0.95),
+                "max_ms": round(samples[-1] * 1000, 1) if samples else None}
+
+
+# Time from sending a streaming request to its first token.
+time_to_first_token = LatencySamples()
@@ -1,3 +1,17 @@
 from django.db import models
 
-# Create your models here.
+
+class CachedTranslation(models.Model):
+    """
+    Second tier of the translation cache (see apps.ai.translation_cache).
+    Entries are content-addressed, so the same text in any room or message
+    shares one row per target language and model.
+    """
+    content_hash = models.CharField(max_length=64)
+    target_lang = models.CharField(max_length=10)
+    model = models.CharField(max_length=100)
+    translation = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("content_hash", "target_lang", "model")
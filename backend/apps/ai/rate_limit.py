@@ -0,0 +1,152 @@
+"""
+Admission control for AI calls made on behalf of chat users.
+
+Every call has to get a token from three buckets: the user's, the room's
+and the global one (``AI_RATE_LIMITS``). ``admit`` never waits. It takes one
+token (``cost`` tokens for work that makes several model calls at once, never
+more than a bucket's burst) from each bucket and allows the call, or it takes
+nothing and returns
+the tier that refused and how long until it would allow the call. The caller
+then chooses to drop the work or retry later. ``acquire`` does the retrying for
+background work that can afford to wait a little.
+
+Buckets live in this process by default. With ``AI_RATE_LIMIT_CACHE`` set to
+a shared cache alias (Redis) every worker draws from the same buckets. The
+cache has no compare-and-set, so there each bucket is approximated by a
+counter of ``burst`` calls per ``burst / rate`` window, which only needs the
+atomic add/incr every cache backend has.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+TIERS = ("user", "room", "global")
+
+
+class Decision(namedtuple("Decision", "allowed tier retry_after")):
+    """Outcome of an admission check. ``tier`` names the bucket that said no."""
+
+    @property
+    def reason(self):
+        if self.allowed:
+            return None
+        return f"{self.tier} rate limit reached, retry in {self.retry_after:.1f}s"
+
+
+ALLOWED = Decision(True, None, 0.0)
+
+
+class LocalBuckets:
+    """Token buckets in this process's memory. Full, idle buckets are pruned."""
+
+    prune_every = 1000
+
+    def __init__(self):
+        self.buckets = {}  # key -> (tokens, updated_at)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _level(self, key, rate, burst, now):
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        return min(burst, tokens + (now - updated_at) * rate)
+
+    def take(self, limits, now, cost=1):
+        """Take ``cost`` tokens from every (key, tier, rate per second, burst) or from none."""
+        with self.lock:
+            levels = [self._level(key, rate, burst, now) for key, _, rate, burst in limits]
+            for level, (_, tier, rate, burst) in zip(levels, limits):
+                need = min(cost, burst)
+                if level < need:
+                    return Decision(False, tier, (need - level) / rate)
+            for level, (key, _, _, burst) in zip(levels, limits):
+                self.buckets[key] = (level - min(cost, burst), now)
+            self.calls += 1
+            if self.calls % self.prune_every == 0:
+                self._prune(limits, now)
+            return ALLOWED
+
+    def _prune(self, limits, now):
+        # A bucket that has been idle long enough to refill is the same as no bucket.
+        longest_refill = max(burst / rate for _, _, rate, burst in limits)
+        for key in [k for k, (_, at) in self.buckets.items() if now - at > longest_refill]:
+            del self.buckets[key]
+
+    async def atake(self, limits, now, cost=1):
+        return self.take(limits, now, cost)
+
+
+class CacheBuckets:
+    """Fixed-window counters in a shared cache, for several workers."""
+
+    key_prefix = "ai-rate:"
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    async def atake(self, limits, now, cost=1):
+        taken = []
+        for key, tier, rate, burst in limits:
+            need = min(cost, burst)
+            window = burst / rate
+            start = math.floor(now / window) * window
+            name = f"{self.key_prefix}{key}:{int(start / window)}"
+            await self.cache.aadd(name, 0, math.ceil(window) + 1)
+            try:
+                count = await self.cache.aincr(name, need)
+            except ValueError:  # expired between add and incr
+                await self.cache.aset(name, need, math.ceil(window) + 1)
+                count = need
+            taken.append((name, need))
+            if count > burst:
+                for name, need in taken:
+                    await self.cache.adecr(name, need)
+                return Decision(False, tier, start + window - now)
+        return ALLOWED
+
+
+class AIRateLimiter:
+    def __init__(self, store=None, clock=time.time):
+        self._store = store
+        self._local = LocalBuckets()
+        self.clock = clock
+
+    @property
+    def store(self):
+        if self._store is not None:
+            return self._store
+        alias = getattr(settings, "AI_RATE_LIMIT_CACHE", None)
+        return CacheBuckets(caches[alias]) if alias else self._local
+
+    def limits(self, user_id, room_id):
+        configured = getattr(settings, "AI_RATE_LIMITS", {})
+        ids = {"user": user_id, "room": room_id, "global": ""}
+        limits = []
+        for tier in TIERS:
+            if tier in configured:
+                per_minute, burst = configured[tier]
+                limits.append((f"{tier}:{ids[tier]}", tier, per_minute / 60, burst))
+        return limits
+
+    async def admit(self, user_id, room_id, cost=1):
+        """Take tokens for ``cost`` AI calls, or say which tier refused and for how long."""
+        limits = self.limits(user_id, room_id)
+        if not limits:
+            return ALLOWED
+        return await self.store.atake(limits, self.clock(), cost)
+
+    async def acquire(self, user_id, room_id, max_wait, cost=1):
+        """admit(), retrying for up to ``max_wait`` seconds while the wait is short enough."""
+        deadline = self.clock() + max_wait
+        while True:
+            decision = await self.admit(user_id, room_id, cost)
+            if decision.allowed or self.clock() + decision.retry_after > deadline:
+                return decision
+            await asyncio.sleep(decision.retry_after)
+
+
+ai_rate_limiter = AIRateLimiter()
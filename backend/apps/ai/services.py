@@ -1,60 +1,68 @@
+import asyncio
 import json
 import os
 import logging
-from openai import OpenAI
+import threading
+import time
+import weakref
+from openai import AsyncOpenAI, OpenAI
 import re
 
+from .batching import estimate_tokens, translate_in_chunks
+from .key_pool import KeyPoolExhausted, get_key_pool, key_id
+from .metrics import time_to_first_token
+from .translation_cache import translation_cache
+
 logger = logging.getLogger(__name__)
 
-class GroqService:
+# One client (and so one HTTP connection pool) per (base_url, key), reused by
+# every service instance. Async clients are bound to the event loop that
+# first used them, so they are kept per loop.
+_sync_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def get_sync_client(base_url, key):
+    with _clients_lock:
+        client = _sync_clients.get((base_url, key))
+        if client is None:
+            client = _sync_clients[(base_url, key)] = OpenAI(base_url=base_url, api_key=key)
+        return client
+
+
+def get_async_client(base_url, key):
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get((base_url, key))
+    if client is None:
+        client = clients[(base_url, key)] = AsyncOpenAI(base_url=base_url, api_key=key)
+    return client
+
+
+class BaseGroqService:
+    """Key pool and prompts; subclasses supply the transport."""
+
     def __init__(self):
-        # Load multiple keys from a comma-separated environment variable
-        keys_str = os.getenv("GROQ_API_KEYS", os.getenv("GROQ_API_KEY", ""))
-        self.api_keys = [k.strip() for k in keys_str.split(",") if k.strip()]
-        if not self.api_keys:
-            raise ValueError("No Groq API keys found in environment")
-        self.key_failures = {key: 0 for key in self.api_keys}
+        # Keys come from GROQ_API_KEYS (comma-separated) or GROQ_API_KEY and are
+        # shared, with their rate limits and breakers, by every instance.
+        self.pool = get_key_pool()
+        self.api_keys = list(self.pool.keys)
+        self.base_url = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
         self.model = "llama-3.3-70b-versatile"
 
-    def _get_working_key(self):
-        """Select a key with the fewest failures (simple round-robin)."""
-        # Sort by failure count, pick one with minimum failures
-        valid_keys = [k for k in self.api_keys if self.key_failures[k] < 3]  # allow up to 3 failures
-        if not valid_keys:
-            raise Exception("All API keys have failed too many times.")
-        return min(valid_keys, key=lambda k: self.key_failures[k])
+    def _request(self, prompt, max_tokens, temperature):
+        return dict(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
 
-    def _call_groq(self, prompt, max_tokens=100, temperature=0.7):
-        last_error = None
-        for attempt in range(len(self.api_keys)):
-            key = self._get_working_key()
-            client = OpenAI(
-                base_url="https://api.groq.com/openai/v1",
-                api_key=key
-            )
-            try:
-                response = client.chat.completions.create(
-                    model=self.model,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=temperature,
-                    max_tokens=max_tokens
-                )
-                # Success – reset failure count for this key
-                self.key_failures[key] = 0
-                return response.choices[0].message.content
-            except Exception as e:
-                logger.warning(f"Key {key[:8]}... failed: {e}")
-                self.key_failures[key] += 1
-                last_error = e
-                # If it's an auth error (401), mark as permanently failed
-                if hasattr(e, 'status_code') and e.status_code == 401:
-                    self.key_failures[key] = 999  # essentially blacklist
-                continue
-        # If all keys failed, raise the last error
-        raise last_error or Exception("All API keys exhausted")
-    def analyze_conversation(self, conversation, lang='en'):
+    # ---------- prompts ----------
+
+    def _analysis_prompt(self, conversation, lang):
         language_instruction = f"Respond in {lang} language." if lang != 'en' else ""
-        prompt = f"""{language_instruction}
+        return f"""{language_instruction}
     Analyze the following conversation and return a **valid JSON object** with exactly three fields:
     - "mood": an object with "score" (0-100) and "label" (string: positive/neutral/negative)
     - "replies": a list of 3 short, casual, friendly replies to the last message, considering context
@@ -64,11 +72,11 @@ class GroqService:
     {conversation}
 
     JSON:"""
-        result = self._call_groq(prompt, max_tokens=400, temperature=0.7)
+
+    def _parse_analysis(self, result):
         if result:
             print(f"Raw analyze_conversation response: {result}")  # DEBUG
             # Try to extract JSON if wrapped in markdown code blocks
-            import re
             json_match = re.search(r'```json\s*(\{.*?\})\s*```', result, re.DOTALL)
             if json_match:
                 json_str = json_match.group(1)
@@ -85,10 +93,10 @@ class GroqService:
             'replies': ["Got it!", "Interesting", "Tell me more"],
             'suggestions': ["That's great!"]
         }
-    def generate_continuation(self, partial_message, recent_context, lang='en'):
-        """Generate ghost suggestion for typing."""
+
+    def _continuation_prompt(self, partial_message, recent_context, lang):
         language_instruction = f"Respond in {lang} language." if lang != 'en' else ""
-        prompt = f"""{language_instruction}
+        return f"""{language_instruction}
 You are a smart typing assistant. Continue the user's current message naturally.
 
 Rules:
@@ -104,24 +112,18 @@ User is typing:
 "{partial_message}"
 
 Continuation:"""
-        result = self._call_groq(prompt, max_tokens=30, temperature=0.5)
-        return result.strip() if result else ""
 
-    def summarize_conversation(self, messages, lang='en'):
-        """Summarize a list of messages."""
+    def _summary_prompt(self, messages, lang):
         language_instruction = f"Respond in {lang} language." if lang != 'en' else ""
         conversation = "\n".join(messages)
-        prompt = f"""{language_instruction}
+        return f"""{language_instruction}
 Summarize the following conversation in 2-3 sentences.
 Conversation:
 {conversation}
 Summary:"""
-        result = self._call_groq(prompt, max_tokens=100, temperature=0.3)
-        return result.strip() if result else "No summary available."
 
-    def translate_batch(self, messages_dict, target_lang):
-        """Translate a dict of {id: content} to target language."""
-        msg_list = "\n".join([f'{msg_id}: "{content}"' for msg_id, content in messages_dict.items()])
+    def _translation_prompt(self, texts, target_lang):
+        msg_list = "\n".join([f'{i}: {json.dumps(content, ensure_ascii=False)}' for i, content in enumerate(texts)])
 
         # Optional example for the target language
         examples = {
@@ -141,20 +143,211 @@ Messages:
 {msg_list}
 
 JSON:"""
-        prompt = prompt_template.format(target_lang=target_lang, example=example, msg_list=msg_list)
+        return prompt_template.format(target_lang=target_lang, example=example, msg_list=msg_list)
+
+    def _translation_budget(self, texts):
+        # Answers in non-Latin scripts run longer than the English input.
+        return sum(estimate_tokens(text) for text in texts) * 3 + 100
 
-        original_model = self.model
-        self.model = "llama-3.3-70b-versatile"  # ensure we use the current model
+    def _parse_translation(self, result, texts, target_lang):
+        """Map the model's {index: translation} answer back to {text: translation}."""
+        if not result:
+            return {}
+        logger.debug(f"Raw translation response for {target_lang}: {result[:200]}")
         try:
-            result = self._call_groq(prompt, max_tokens=2000, temperature=0.2)
-            if result:
-                logger.debug(f"Raw translation response for {target_lang}: {result[:200]}")
-                try:
-                    translations = json.loads(result)
-                    if isinstance(translations, dict):
-                        return {str(k): v for k, v in translations.items()}
-                except json.JSONDecodeError as e:
-                    logger.error(f"Translation JSON parse error: {e}")
-            return None
-        finally:
-            self.model = original_model
\ No newline at end of file
+            translations = json.loads(result)
+        except json.JSONDecodeError as e:
+            logger.error(f"Translation JSON parse error: {e}")
+            return {}
+        if not isinstance(translations, dict):
+            return {}
+        by_index = {str(k): v for k, v in translations.items()}
+        return {
+            text: by_index[str(i)]
+            for i, text in enumerate(texts)
+            if isinstance(by_index.get(str(i)), str)
+        }
+
+
+class GroqService(BaseGroqService):
+    """Blocking client, for the DRF views."""
+
+    def _call_groq(self, prompt, max_tokens=100, temperature=0.7):
+        last_error = None
+        for attempt in range(len(self.api_keys)):
+            try:
+                key = self.pool.acquire()
+            except KeyPoolExhausted:
+                if last_error:
+                    break
+                raise
+            client = get_sync_client(self.base_url, key)
+            try:
+                response = client.chat.completions.create(**self._request(prompt, max_tokens, temperature))
+            except Exception as e:
+                logger.warning(f"Key {key_id(key)} failed: {e}")
+                self.pool.release(key, e)
+                last_error = e
+                continue
+            self.pool.release(key)
+            return response.choices[0].message.content
+        # If all keys failed, raise the last error
+        raise last_error or KeyPoolExhausted("All API keys exhausted")
+
+    def analyze_conversation(self, conversation, lang='en'):
+        result = self._call_groq(self._analysis_prompt(conversation, lang), max_tokens=400, temperature=0.7)
+        return self._parse_analysis(result)
+
+    def generate_continuation(self, partial_message, recent_context, lang='en'):
+        """Generate ghost suggestion for typing."""
+        prompt = self._continuation_prompt(partial_message, recent_context, lang)
+        result = self._call_groq(prompt, max_tokens=30, temperature=0.5)
+        return result.strip() if result else ""
+
+    def summarize_conversation(self, messages, lang='en'):
+        """Summarize a list of messages."""
+        result = self._call_groq(self._summary_prompt(messages, lang), max_tokens=100, temperature=0.3)
+        return result.strip() if result else "No summary available."
+
+    def translate_batch(self, messages_dict, target_lang):
+        """
+        Translate a dict of {id: content} to target language. Texts already in
+        the translation cache are not sent again, identical texts are
+        translated once, and the rest go out in concurrent, token-budgeted
+        chunks. Ids whose text could not be translated are left out; returns
+        None only if nothing at all could be translated.
+        """
+        texts = {content for content in messages_dict.values() if content}
+        translated = translation_cache.get_many(texts, target_lang, self.model)
+        misses = sorted(texts - translated.keys())
+        if misses:
+            fresh, failed = translate_in_chunks(
+                misses, lambda chunk: self._translate_texts(chunk, target_lang)
+            )
+            if failed:
+                logger.error(f"Could not translate {len(failed)} of {len(misses)} text(s) to {target_lang}")
+                if not fresh and not translated:
+                    return None
+            translation_cache.set_many(fresh, target_lang, self.model)
+            translated.update(fresh)
+        return {
+            str(msg_id): translated.get(content, content)
+            for msg_id, content in messages_dict.items()
+            if not content or content in translated
+        }
+
+    def _translate_texts(self, texts, target_lang):
+        """Ask the model for translations of one chunk of texts. Returns {text: translation}."""
+        result = self._call_groq(
+            self._translation_prompt(texts, target_lang),
+            max_tokens=self._translation_budget(texts), temperature=0.2,
+        )
+        return self._parse_translation(result, texts, target_lang)
+
+
+class AsyncGroqService(BaseGroqService):
+    """Non-blocking client, awaited directly from the consumers."""
+
+    async def _call_groq(self, prompt, max_tokens=100, temperature=0.7):
+        last_error = None
+        for attempt in range(len(self.api_keys)):
+            try:
+                key = await self.pool.aacquire()
+            except KeyPoolExhausted:
+                if last_error:
+                    break
+                raise
+            client = get_async_client(self.base_url, key)
+            try:
+                response = await client.chat.completions.create(**self._request(prompt, max_tokens, temperature))
+            except asyncio.CancelledError:
+                self.pool.abandon(key)  # not the key's fault, nor evidence that it works
+                raise
+            except Exception as e:
+                logger.warning(f"Key {key_id(key)} failed: {e}")
+                await self.pool.arelease(key, e)
+                last_error = e
+                continue
+            await self.pool.arelease(key)
+            return response.choices[0].message.content
+        raise last_error or KeyPoolExhausted("All API keys exhausted")
+
+    async def _stream_groq(self, prompt, max_tokens=100, temperature=0.7):
+        """
+        Yield the completion's text as it is generated. A key that fails before
+        the first token is swapped for the next one; after that, errors propagate.
+        Closing or cancelling the iteration closes the HTTP stream.
+        """
+        last_error = None
+        for attempt in range(len(self.api_keys)):
+            try:
+                key = await self.pool.aacquire()
+            except KeyPoolExhausted:
+                if last_error:
+                    break
+                raise
+            client = get_async_client(self.base_url, key)
+            stream, started, first_token_at = None, time.perf_counter(), None
+            settled = finished = False
+            try:
+                stream = await client.chat.completions.create(
+                    stream=True, **self._request(prompt, max_tokens, temperature)
+                )
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            time_to_first_token.record(first_token_at - started)
+                        yield delta
+                finished = True
+            except Exception as e:
+                logger.warning(f"Key {key_id(key)} failed while streaming: {e}")
+                settled = True
+                await self.pool.arelease(key, e)
+                if first_token_at is not None:
+                    raise
+                last_error = e
+                continue
+            finally:
+                if finished:
+                    self.pool.release(key)
+                elif not settled:
+                    # The caller stopped listening (disconnect, newer input).
+                    self.pool.abandon(key)
+                if stream is not None:
+                    await stream.close()
+            return
+        raise last_error or KeyPoolExhausted("All API keys exhausted")
+
+    async def stream_continuation(self, partial_message, recent_context, lang='en'):
+        """generate_continuation, as an async iterator of text deltas."""
+        prompt = self._continuation_prompt(partial_message, recent_context, lang)
+        async for delta in self._stream_groq(prompt, max_tokens=30, temperature=0.5):
+            yield delta
+
+    async def stream_summary(self, messages, lang='en'):
+        """summarize_conversation, as an async iterator of text deltas."""
+        async for delta in self._stream_groq(self._summary_prompt(messages, lang), max_tokens=100, temperature=0.3):
+            yield delta
+
+    async def analyze_conversation(self, conversation, lang='en'):
+        result = await self._call_groq(self._analysis_prompt(conversation, lang), max_tokens=400, temperature=0.7)
+        return self._parse_analysis(result)
+
+    async def generate_continuation(self, partial_message, recent_context, lang='en'):
+        prompt = self._continuation_prompt(partial_message, recent_context, lang)
+        result = await self._call_groq(prompt, max_tokens=30, temperature=0.5)
+        return result.strip() if result else ""
+
+    async def translate_texts(self, texts, target_lang):
+        """Translate one budget-sized chunk of texts. Returns {text: translation}."""
+        result = await self._call_groq(
+            self._translation_prompt(texts, target_lang),
+            max_tokens=self._translation_budget(texts), temperature=0.2,
+        )
+        return self._parse_translation(result, texts, target_lang)
+
+    async def summarize_conversation(self, messages, lang='en'):
+        result = await self._call_groq(self._summary_prompt(messages, lang), max_tokens=100, temperature=0.3)
+        return result.strip() if result else "No summary available."
@@ -1,3 +1,633 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from .batching import split_by_budget
+from .key_pool import CLOSED, DISABLED, HALF_OPEN, OPEN, KeyPool, KeyPoolExhausted, get_key_pool, key_id
+from .metrics import time_to_first_token
+from .models import CachedTranslation
+from .rate_limit import AIRateLimiter, CacheBuckets
+from .services import AsyncGroqService, GroqService
+from .translation import GroqTranslationProvider, LibreTranslateProvider, TranslationBackend, translate_text
+from .translation_cache import TranslationCache, content_hash, translation_cache
+
+
+class FakeGroq(GroqService):
+    """GroqService with the network call replaced by an upper-casing 'translator'."""
+
+    def __init__(self):
+        with mock.patch.dict(os.environ, {"GROQ_API_KEYS": "test-key"}):
+            super().__init__()
+        self.prompts = []
+
+    def _call_groq(self, prompt, max_tokens=100, temperature=0.7):
+        self.prompts.append(prompt)
+        lines = prompt.split("Messages:\n", 1)[1].split("\n\nJSON:", 1)[0].splitlines()
+        pairs = (line.split(": ", 1) for line in lines)
+        return json.dumps({key: text.strip('"').upper() for key, text in pairs})
+
+
+class TranslationCacheTests(TestCase):
+    def setUp(self):
+        translation_cache.clear()
+
+    def test_only_misses_reach_the_model(self):
+        ai = FakeGroq()
+        self.assertEqual(ai.translate_batch({"1": "hello", "2": "bye", "3": "hello"}, "hi"),
+                         {"1": "HELLO", "2": "BYE", "3": "HELLO"})
+        self.assertEqual(len(ai.prompts), 1)
+        self.assertEqual(ai.prompts[0].count('"hello"'), 1)
+
+        self.assertEqual(ai.translate_batch({"4": "bye", "5": "new"}, "hi"), {"4": "BYE", "5": "NEW"})
+        self.assertNotIn('"bye"', ai.prompts[1])
+
+        # Another worker starts with an empty memory tier but shares the database.
+        translation_cache.clear()
+        ai.translate_batch({"6": "hello", "7": "bye"}, "hi")
+        self.assertEqual(len(ai.prompts), 2)
+        ai.translate_batch({"8": "hello"}, "kn")
+        self.assertEqual(len(ai.prompts), 3)
+
+    def test_lru_evicts_and_invalidate_forgets_everywhere(self):
+        cache = TranslationCache(max_entries=2)
+        cache.set_many({"a": "A", "b": "B"}, "hi", "m")
+        cache.get_many(["a"], "hi", "m")
+        cache.set_many({"c": "C"}, "hi", "m")
+        self.assertEqual(list(cache._entries), [(content_hash(t), "hi", "m") for t in ("a", "c")])
+        self.assertEqual(cache.get_many(["b"], "hi", "m"), {"b": "B"})  # from the database
+
+        cache.invalidate("a")
+        self.assertEqual(cache.get_many(["a"], "hi", "m"), {})
+        self.assertEqual(CachedTranslation.objects.count(), 2)
+
+    def test_editing_a_message_drops_its_translations(self):
+        from rest_framework.test import APIClient
+        from apps.chat.tests import make_group, make_user, send
+
+        alice = make_user("alice")
+        message = send(alice, make_group([alice, make_user("bob")]), "see you soon")
+        translation_cache.set_many({"see you soon": "जल्द मिलते हैं"}, "hi", "m")
+        client = APIClient()
+        client.force_authenticate(alice)
+        client.post("/api/chat/messages/edit/", {"message_id": message.id, "new_content": "see you later"})
+        self.assertEqual(translation_cache.get_many(["see you soon"], "hi", "m"), {})
+
+
+class FakeOpenAIServer:
+    """
+    A local stand-in for an OpenAI-compatible /chat/completions endpoint that
+    "translates" translation prompts by upper-casing them. It can cut answers
+    off like max_tokens would for chunks over ``truncate_over`` texts, and
+    reject ``bad_key`` with a 401. Streaming requests get the answer word by
+    word as server-sent events, ``token_delay`` seconds apart.
+    """
+
+    def __init__(self, truncate_over=None, bad_key=None, delay=0.05, token_delay=0.05):
+        self.truncate_over, self.bad_key, self.delay = truncate_over, bad_key, delay
+        self.token_delay = token_delay
+        self.streams_finished = self.streams_aborted = 0
+        self.requests = []
+        self.connections = set()
+        self.in_flight = self.peak = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is visible
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                key = self.headers["Authorization"].split()[-1]
+                server.connections.add(self.client_address)
+                status, payload = server.respond(key, body)
+                if body.get("stream") and status == 200:
+                    return self.stream(payload)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream(self, payload):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                answer = payload["choices"][0]["message"]["content"]
+                words = re.findall(r"\s*\S+", answer)
+                events = [{"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0,
+                           "model": payload["model"],
+                           "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+                          for word in words]
+                try:
+                    for i, event in enumerate(events):
+                        if i:
+                            time.sleep(server.token_delay)
+                        self.chunk(f"data: {json.dumps(event)}\n\n")
+                    self.chunk("data: [DONE]\n\n")
+                    self.chunk("")
+                    server.streams_finished += 1
+                except (BrokenPipeError, ConnectionResetError):
+                    server.streams_aborted += 1
+                    self.close_connection = True
+
+            def chunk(self, text):
+                data = text.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def respond(self, key, body):
+        if key == self.bad_key:
+            return 401, {"error": {"message": "Invalid API Key", "type": "invalid_request_error"}}
+        prompt = body["messages"][0]["content"]
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        if "Messages:\n" in prompt:
+            lines = prompt.split("Messages:\n", 1)[1].split("\n\nJSON:", 1)[0].splitlines()
+            texts = {i: json.loads(text) for i, text in (line.split(": ", 1) for line in lines)}
+            answer = json.dumps({i: text.upper() for i, text in texts.items()}, ensure_ascii=False)
+        else:
+            texts, answer = {}, " and then some"
+        truncated = self.truncate_over is not None and len(texts) > self.truncate_over
+        if truncated:
+            answer = answer[: len(answer) // 2]
+        self.requests.append({"key": key, "texts": list(texts.values()), "ok": not truncated,
+                              "max_tokens": body["max_tokens"]})
+        return 200, {
+            "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "length" if truncated else "stop",
+                         "message": {"role": "assistant", "content": answer}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }
+
+
+@override_settings(TRANSLATION_CHUNK_ITEMS=20, TRANSLATION_WORKERS=4, TRANSLATION_RETRIES=2,
+                   KEY_POOL_RPM=6000, KEY_POOL_BURST=50)
+class ChunkedTranslationTests(TestCase):
+    def setUp(self):
+        translation_cache.clear()
+
+    def service(self, server, keys="key-a,key-b"):
+        env = {"GROQ_API_KEYS": keys, "GROQ_BASE_URL": server.url}
+        with mock.patch.dict(os.environ, env):
+            return GroqService()
+
+    def run_batch(self, texts, **server_options):
+        server = FakeOpenAIServer(**server_options)
+        self.addCleanup(server.close)
+        result = self.service(server).translate_batch({str(i): t for i, t in enumerate(texts)}, "hi")
+        return server, result
+
+    def test_large_batch_runs_as_concurrent_chunks_across_keys(self):
+        texts = [f"message number {i}" for i in range(120)]
+        server, result = self.run_batch(texts)
+        self.assertEqual(result, {str(i): t.upper() for i, t in enumerate(texts)})
+        self.assertEqual(len(server.requests), 6)
+        self.assertGreater(server.peak, 1)
+        self.assertEqual({r["key"] for r in server.requests}, {"key-a", "key-b"})
+
+    def test_only_failed_chunks_are_retried_in_smaller_pieces(self):
+        texts = [f"message number {i}" for i in range(40)]
+        server, result = self.run_batch(texts, truncate_over=7)
+        self.assertEqual(len(result), 40)
+        # 2 chunks of 20 are cut off, then 4 of 10, then 8 of 5 succeed.
+        self.assertEqual([len(r["texts"]) for r in server.requests if r["ok"]], [5] * 8)
+        self.assertEqual(len(server.requests), 14)
+
+    def test_partial_and_total_failure(self):
+        texts = [f"message number {i}" for i in range(40)]
+        server, result = self.run_batch(texts, truncate_over=2)
+        self.assertIsNone(result)  # nothing fits even after two splits
+        self.assertEqual(sum(1 for r in server.requests if r["ok"]), 0)
+
+        server = FakeOpenAIServer(bad_key="key-a")
+        self.addCleanup(server.close)
+        result = self.service(server).translate_batch({"1": "hello"}, "hi")
+        self.assertEqual(result, {"1": "HELLO"})
+
+
+@override_settings(KEY_POOL_RPM=6000, KEY_POOL_BURST=50)
+class PooledClientTests(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeOpenAIServer(delay=0.1)
+        self.addCleanup(self.server.close)
+        self.env = mock.patch.dict(os.environ, {"GROQ_API_KEYS": "key-a,key-b", "GROQ_BASE_URL": self.server.url})
+        self.env.start()
+        self.addCleanup(self.env.stop)
+
+    def test_async_service_reuses_one_connection_per_key_and_does_not_block(self):
+        async def scenario():
+            for _ in range(6):
+                self.assertEqual(await AsyncGroqService().generate_continuation("see you", ""), "and then some")
+            self.assertEqual(len(self.server.connections), 2)  # one per key
+            self.assertEqual({r["key"] for r in self.server.requests}, {"key-a", "key-b"})
+            started = time.perf_counter()
+            results = await asyncio.gather(*(
+                AsyncGroqService().summarize_conversation(["hi", "hello"]) for _ in range(8)
+            ))
+            return results, time.perf_counter() - started
+
+        results, elapsed = asyncio.run(scenario())
+        self.assertEqual(set(results), {"and then some"})
+        self.assertLess(elapsed, 0.5)  # 8 calls of 0.1 s each ran side by side
+
+    def test_sync_facade_shares_clients_between_instances(self):
+        for _ in range(6):
+            self.assertEqual(GroqService().generate_continuation("see you", ""), "and then some")
+        self.assertEqual(len(self.server.connections), 2)
+
+
+@override_settings(KEY_POOL_RPM=6000, KEY_POOL_BURST=50)
+class StreamingTests(SimpleTestCase):
+    def start(self, **options):
+        self.server = FakeOpenAIServer(delay=0.01, token_delay=0.1, **options)
+        self.addCleanup(self.server.close)
+        env = mock.patch.dict(os.environ, {"GROQ_API_KEYS": "key-a,key-b", "GROQ_BASE_URL": self.server.url})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_tokens_arrive_as_they_are_generated(self):
+        self.start(bad_key="key-a")  # fails before the first token, so key-b takes over
+        time_to_first_token.reset()
+
+        async def scenario():
+            started, arrivals = time.perf_counter(), []
+            async for delta in AsyncGroqService().stream_continuation("see you", ""):
+                arrivals.append((delta, time.perf_counter() - started))
+            return arrivals
+
+        arrivals = asyncio.run(scenario())
+        self.assertEqual([delta for delta, _ in arrivals], [" and", " then", " some"])
+        # The first word is forwarded while the other two are still being generated.
+        self.assertGreater(arrivals[-1][1] - arrivals[0][1], 0.18)
+        stats = time_to_first_token.snapshot()
+        self.assertEqual(stats["count"], 1)
+        self.assertLess(stats["p95_ms"], arrivals[-1][1] * 1000 - 150)
+
+    def test_cancelling_closes_the_stream_and_frees_the_key(self):
+        self.start()
+
+        async def scenario():
+            first = asyncio.Event()
+
+            async def listen():
+                async for _ in AsyncGroqService().stream_summary(["hi", "hello"]):
+                    first.set()
+
+            task = asyncio.create_task(listen())
+            await first.wait()
+            task.cancel()  # e.g. the websocket went away
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.3)
+
+        asyncio.run(scenario())
+        self.assertEqual(self.server.streams_aborted, 1)
+        self.assertEqual(self.server.streams_finished, 0)
+        self.assertEqual({s["in_flight"] for s in get_key_pool().snapshot().values()}, {0})
+
+
+class StubLibreTranslate:
+    """A LibreTranslate-compatible /translate endpoint that upper-cases, with keep-alive."""
+
+    def __init__(self, fail=False, delay=0.02):
+        self.fail, self.delay = fail, delay
+        self.requests, self.connections = [], set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests.append(body)
+                server.connections.add(self.client_address)
+                time.sleep(server.delay)
+                if server.fail:
+                    status, payload = 500, {"error": "boom"}
+                else:
+                    texts = body["q"] if isinstance(body["q"], list) else [body["q"]]
+                    status, payload = 200, {"translatedText": [f"{body['target']}:{t.upper()}" for t in texts]}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@override_settings(TRANSLATION_HTTP_BATCH=10)
+class TranslationBackendTests(TransactionTestCase):
+    def setUp(self):
+        translation_cache.clear()
+
+    def backend(self, **stub_options):
+        self.stub = StubLibreTranslate(**stub_options)
+        self.addCleanup(self.stub.close)
+        return TranslationBackend(LibreTranslateProvider(url=self.stub.url))
+
+    def test_concurrent_calls_are_batched_over_one_pooled_connection(self):
+        backend = self.backend()
+        texts = [f"message {i}" for i in range(25)]
+
+        async def scenario():
+            first = await asyncio.gather(*(backend.translate(t, "hi") for t in texts + texts[:5]))
+            again = await asyncio.gather(*(backend.translate(t, "hi") for t in texts))
+            return first, again
+
+        first, again = asyncio.run(scenario())
+        self.assertEqual(first[:25], [f"hi:MESSAGE {i}" for i in range(25)])
+        self.assertEqual(first[25:], first[:5])
+        self.assertEqual(again, first[:25])
+        # 25 distinct texts in batches of 10, then everything from the cache.
+        self.assertEqual(sorted(len(r["q"]) for r in self.stub.requests), [5, 10, 10])
+        self.assertLessEqual(len(self.stub.connections), 3)
+
+    def test_failures_fall_back_to_the_original_and_are_not_cached(self):
+        backend = self.backend(fail=True)
+        result = asyncio.run(backend.translate_many(["hello", "hello", ""], "kn"))
+        self.assertEqual(result, {"hello": "hello"})
+        self.assertFalse(CachedTranslation.objects.exists())
+        self.assertEqual(asyncio.run(backend.translate("hello", "en")), "hello")  # same language: no call
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_cancelled_calls_are_left_out_of_the_batch(self):
+        backend = self.backend()
+
+        async def scenario():
+            dropped = [asyncio.create_task(backend.translate(t, "ta")) for t in ("never mind", "forget it")]
+            kept = asyncio.create_task(backend.translate("hello", "ta"))
+            await asyncio.sleep(0)
+            for task in dropped:
+                task.cancel()
+            return await kept
+
+        self.assertEqual(asyncio.run(scenario()), "ta:HELLO")
+        self.assertEqual([r["q"] for r in self.stub.requests], [["hello"]])
+
+    def test_a_loop_closing_mid_batch_does_not_stall_the_next_one(self):
+        backend = self.backend()
+
+        async def abandoned():
+            asyncio.create_task(backend.translate("hello", "kn"))
+            await asyncio.sleep(0)  # the loop closes before the batch window ends
+
+        async def next_loop():
+            return await asyncio.wait_for(backend.translate("hello", "kn"), 5)
+
+        asyncio.run(abandoned())
+        self.assertEqual(asyncio.run(next_loop()), "kn:HELLO")
+        self.assertEqual(len(self.stub.requests), 1)
+
+    @override_settings(TRANSLATION_PROVIDER="libretranslate")
+    def test_translate_text_uses_the_configured_provider(self):
+        self.stub = StubLibreTranslate()
+        self.addCleanup(self.stub.close)
+        with override_settings(LIBRETRANSLATE_URL=self.stub.url), \
+                mock.patch("apps.ai.translation._backend", None):
+            self.assertEqual(asyncio.run(translate_text("good night", "hi")), "hi:GOOD NIGHT")
+
+    @override_settings(KEY_POOL_RPM=6000, KEY_POOL_BURST=50)
+    def test_groq_provider(self):
+        server = FakeOpenAIServer(delay=0.01)
+        self.addCleanup(server.close)
+        with mock.patch.dict(os.environ, {"GROQ_API_KEYS": "key-a", "GROQ_BASE_URL": server.url}):
+            backend = TranslationBackend(GroqTranslationProvider())
+            result = asyncio.run(backend.translate_many(["see you", "thanks"], "hi"))
+            # History translation shares the cache entries.
+            history = GroqService().translate_batch({1: "see you"}, "hi")
+        self.assertEqual(result, {"see you": "SEE YOU", "thanks": "THANKS"})
+        self.assertEqual(history, {"1": "SEE YOU"})
+        self.assertEqual(len(server.requests), 1)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ApiError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class KeyPoolTests(SimpleTestCase):
+    def pool(self, keys=("key-a", "key-b"), **options):
+        self.clock = FakeClock()
+        options = {"rpm": 60, "burst": 2, "failure_threshold": 2, "cooldown": 10,
+                   "max_cooldown": 25, "max_wait": 0, "clock": self.clock, **options}
+        return KeyPool(keys, **options)
+
+    def state(self, pool, key):
+        return pool.snapshot()[key_id(key)]["state"]
+
+    def test_least_loaded_key_is_picked(self):
+        pool = self.pool(burst=10)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.release(first)
+        self.assertEqual(pool.acquire(), first)  # second is still busy
+        pool.release(first)
+        pool.release(second)
+        picks = [pool.acquire() for _ in range(4)]
+        self.assertEqual(sorted(picks), ["key-a", "key-a", "key-b", "key-b"])
+
+    def test_token_bucket_limits_each_key(self):
+        pool = self.pool(keys=("key-a",))
+        for _ in range(2):
+            pool.release(pool.acquire())
+        with self.assertRaises(KeyPoolExhausted):
+            pool.acquire()  # burst used up, and no waiting allowed
+        self.clock.now += 1  # 60 rpm refills one token a second
+        pool.release(pool.acquire())
+        self.assertEqual(pool.snapshot()[key_id("key-a")]["requests"], 3)
+
+    def fail(self, pool, key, status):
+        pool.keys[key].in_flight += 1  # as if acquire() had handed it out
+        pool.release(key, ApiError(status))
+
+    def test_breaker_opens_probes_half_open_and_backs_off(self):
+        pool = self.pool(burst=100)
+        self.fail(pool, "key-a", 500)
+        self.assertEqual(self.state(pool, "key-a"), CLOSED)
+        self.fail(pool, "key-a", 503)
+        self.assertEqual(self.state(pool, "key-a"), OPEN)
+        self.assertEqual({pool.acquire() for _ in range(3)}, {"key-b"})
+
+        self.clock.now += 10  # key-b still has 3 in flight, so key-a is the least loaded
+        self.assertEqual(self.state(pool, "key-a"), HALF_OPEN)
+        self.assertEqual(pool.acquire(), "key-a")  # the one probe
+        self.assertEqual(pool.acquire(), "key-b")  # no second probe while it runs
+        pool.release("key-a", ApiError(502))
+        self.assertEqual(pool.snapshot()[key_id("key-a")]["open_for"], 20)  # cooldown doubled
+
+        self.clock.now += 20
+        self.assertEqual(pool.acquire(), "key-a")
+        pool.release("key-a")
+        self.assertEqual(self.state(pool, "key-a"), CLOSED)
+
+    def test_abandoned_probe_leaves_the_breaker_half_open(self):
+        pool = self.pool(keys=("key-a",), burst=100)
+        self.fail(pool, "key-a", 500)
+        self.fail(pool, "key-a", 500)
+        self.clock.now += 10
+        self.assertEqual(pool.acquire(), "key-a")  # the probe...
+        pool.abandon("key-a")  # ...is cancelled
+        snapshot = pool.snapshot()[key_id("key-a")]
+        self.assertEqual((snapshot["state"], snapshot["successes"], snapshot["in_flight"]), (HALF_OPEN, 0, 0))
+        self.assertEqual(pool.acquire(), "key-a")  # free to probe again
+
+    def test_auth_errors_disable_and_exhaustion_raises(self):
+        pool = self.pool(keys=("key-a",))
+        pool.release(pool.acquire(), ApiError(401))
+        self.assertEqual(self.state(pool, "key-a"), DISABLED)
+        with self.assertRaises(KeyPoolExhausted):
+            pool.acquire()
+
+    @override_settings(CACHES={"shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                          "LOCATION": "key-pool-tests"}})
+    def test_shared_store_spreads_limits_and_breakers_across_workers(self):
+        store = caches["shared"]
+        store.clear()
+        worker_1 = self.pool(rpm=3, burst=10, failure_threshold=1, store=store)
+        worker_2 = self.pool(rpm=3, burst=10, failure_threshold=1, store=store)
+        worker_1.release(worker_1.acquire(), ApiError(500))  # key-a opens in worker 1...
+        self.assertEqual(worker_2.acquire(), "key-b")  # ...and worker 2 skips it
+        worker_2.release("key-b")
+        worker_2.release(worker_2.acquire())  # key-b: 2 of 3 this minute
+        worker_1.release(worker_1.acquire())  # 3 of 3, from the other worker
+        with self.assertRaises(KeyPoolExhausted):
+            worker_2.acquire()
+
+        async def scenario():
+            with self.assertRaises(KeyPoolExhausted):
+                await worker_1.aacquire()
+
+        asyncio.run(scenario())
+        # The picks the shared limit vetoed gave their local tokens back.
+        self.assertEqual(worker_2.snapshot()[key_id("key-b")]["tokens"], 8)
+
+
+
+@override_settings(AI_RATE_LIMITS={"user": (6, 2), "room": (12, 3), "global": (60, 4)})
+class AIRateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def admit(self, limiter, user_id, room_id):
+        return asyncio.run(limiter.admit(user_id, room_id))
+
+    def test_each_tier_refuses_with_its_reason_without_blocking(self):
+        limiter = AIRateLimiter(clock=self.clock)
+        self.assertTrue(self.admit(limiter, 1, 10).allowed)
+        self.assertTrue(self.admit(limiter, 1, 10).allowed)
+        refused = self.admit(limiter, 1, 10)
+        self.assertEqual((refused.allowed, refused.tier), (False, "user"))
+        self.assertAlmostEqual(refused.retry_after, 10)  # 6 a minute
+        self.assertIn("user rate limit", refused.reason)
+
+        self.assertTrue(self.admit(limiter, 2, 10).allowed)
+        self.assertEqual(self.admit(limiter, 3, 10).tier, "room")
+        self.assertTrue(self.admit(limiter, 3, 11).allowed)  # 4th call overall
+        self.assertEqual(self.admit(limiter, 4, 12).tier, "global")
+
+        self.clock.now += 10
+        self.assertTrue(self.admit(limiter, 1, 12).allowed)
+
+    def test_refused_call_takes_no_tokens(self):
+        limiter = AIRateLimiter(clock=self.clock)
+        for user_id in (1, 2, 3):
+            self.admit(limiter, user_id, 10)  # room bucket now empty
+        self.assertEqual(self.admit(limiter, 4, 10).tier, "room")
+        self.assertTrue(self.admit(limiter, 4, 11).allowed)  # the refusal cost user 4 nothing
+        self.assertEqual(self.admit(limiter, 4, 11).tier, "global")  # 4 of 4 used
+
+    def test_cost_takes_several_tokens(self):
+        limiter = AIRateLimiter(clock=self.clock)
+        self.assertTrue(asyncio.run(limiter.admit(1, 10, cost=2)).allowed)
+        self.assertEqual(self.admit(limiter, 1, 10).tier, "user")
+        self.assertEqual(asyncio.run(limiter.admit(2, 10, cost=2)).tier, "room")  # 1 of 3 left
+        # More than a bucket holds is capped at its burst rather than refused forever.
+        fresh = AIRateLimiter(clock=self.clock)
+        self.assertTrue(asyncio.run(fresh.admit(3, 11, cost=5)).allowed)
+        self.assertEqual(self.admit(fresh, 4, 12).tier, "global")
+
+        from django.core.cache.backends.locmem import LocMemCache
+        shared = AIRateLimiter(store=CacheBuckets(LocMemCache("ai-rate-cost", {})), clock=self.clock)
+        self.assertTrue(asyncio.run(shared.admit(1, 10, cost=2)).allowed)
+        self.assertEqual(self.admit(shared, 1, 10).tier, "user")
+        self.assertTrue(self.admit(shared, 2, 10).allowed)  # the refusal was rolled back in full
+
+    def test_acquire_defers_short_waits_and_gives_up_on_long_ones(self):
+        limiter = AIRateLimiter(clock=self.clock)
+        self.admit(limiter, 1, 10)
+        self.admit(limiter, 1, 10)
+
+        async def sleep(seconds):
+            self.clock.now += seconds
+
+        with mock.patch("apps.ai.rate_limit.asyncio.sleep", sleep):
+            self.assertFalse(asyncio.run(limiter.acquire(1, 10, max_wait=5)).allowed)
+            self.assertEqual(self.clock.now, 1000)
+            self.assertTrue(asyncio.run(limiter.acquire(1, 10, max_wait=15)).allowed)
+            self.assertEqual(self.clock.now, 1010)
+
+    @override_settings(CACHES={"shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                          "LOCATION": "ai-rate-tests"}})
+    def test_shared_cache_is_one_budget_for_all_workers(self):
+        caches["shared"].clear()
+        worker_1 = AIRateLimiter(store=CacheBuckets(caches["shared"]), clock=self.clock)
+        worker_2 = AIRateLimiter(store=CacheBuckets(caches["shared"]), clock=self.clock)
+        self.assertTrue(self.admit(worker_1, 1, 10).allowed)
+        self.assertTrue(self.admit(worker_2, 1, 10).allowed)
+        self.assertEqual(self.admit(worker_1, 1, 10).tier, "user")
+        self.assertTrue(self.admit(worker_2, 2, 10).allowed)  # the refusal was not counted
+        self.clock.now += 20  # next user window
+        self.assertTrue(self.admit(worker_2, 1, 11).allowed)
+
+
+class TokenBudgetTests(SimpleTestCase):
+    def test_chunks_respect_budget_and_item_cap(self):
+        texts = ["short"] * 10 + ["नमस्ते " * 40] + ["x" * 400]
+        chunks = split_by_budget(texts, budget=120, max_items=4)
+        self.assertEqual([len(c) for c in chunks], [4, 4, 2, 1, 1])
+        self.assertEqual([t for c in chunks for t in c], texts)
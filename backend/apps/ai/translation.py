@@ -1,33 +1,207 @@
-import httpx
+"""
+Machine translation for async code (consumers, background tasks).
+
+``TranslationBackend`` sits in front of a provider:
+
+* ``LibreTranslateProvider`` - any LibreTranslate-compatible ``/translate``
+  endpoint (``LIBRETRANSLATE_URL``), sent many texts per request;
+* ``GroqTranslationProvider`` - the LLM, through ``AsyncGroqService``.
+
+``TRANSLATION_PROVIDER`` picks one. Results go through ``translation_cache``
+(LRU in memory, then the shared table), so a text is translated once per
+language and provider. ``translate_text`` calls made within
+``TRANSLATION_BATCH_WINDOW`` seconds of each other are sent as one batch.
+HTTP clients are kept per event loop and reused, so requests share pooled
+connections.
+"""
+import asyncio
 import logging
+import weakref
+
+import httpx
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .batching import split_by_budget
+from .translation_cache import translation_cache
 
 logger = logging.getLogger(__name__)
 
-async def translate_text(text, target_lang, source_lang='en'):
-    """Translate text using LibreTranslate with fallback."""
-    if not text or target_lang == source_lang:
-        return text
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client():
+    """A long-lived httpx client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = _http_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(getattr(settings, "TRANSLATION_HTTP_TIMEOUT", 10.0), connect=3.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return client
+
+
+class TranslationProvider:
+    """Translates a list of texts. Subclasses set ``name`` and implement ``translate_batch``."""
+
+    name = None
+    max_batch = 50
+
+    async def translate_batch(self, texts, target_lang, source_lang):
+        """Return ``{text: translation}``; texts that could not be translated are left out."""
+        raise NotImplementedError
+
+    def batches(self, texts):
+        return [texts[i:i + self.max_batch] for i in range(0, len(texts), self.max_batch)]
+
+    async def translate_many(self, texts, target_lang, source_lang):
+        batches = self.batches(texts)
+        results = await asyncio.gather(
+            *(self.translate_batch(batch, target_lang, source_lang) for batch in batches),
+            return_exceptions=True,
+        )
+        translated = {}
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error(f"{self.name} translation of {len(batch)} text(s) failed: {result}")
+            else:
+                translated.update(result)
+        return translated
+
+
+class LibreTranslateProvider(TranslationProvider):
+    name = "libretranslate"
+
+    def __init__(self, url=None, api_key=None):
+        self.url = (url or getattr(settings, "LIBRETRANSLATE_URL", "https://libretranslate.com")).rstrip("/")
+        self.api_key = api_key if api_key is not None else getattr(settings, "LIBRETRANSLATE_API_KEY", None)
+        self.max_batch = getattr(settings, "TRANSLATION_HTTP_BATCH", 50)
+
+    async def translate_batch(self, texts, target_lang, source_lang):
+        payload = {"q": texts, "source": source_lang, "target": target_lang, "format": "text"}
+        if self.api_key:
+            payload["api_key"] = self.api_key
+        response = await get_http_client().post(f"{self.url}/translate", json=payload)
+        response.raise_for_status()
+        translated = response.json().get("translatedText")
+        if isinstance(translated, str):
+            translated = [translated]
+        if not isinstance(translated, list) or len(translated) != len(texts):
+            raise ValueError(f"expected {len(texts)} translations, got {translated!r:.200}")
+        return {text: result for text, result in zip(texts, translated) if isinstance(result, str)}
 
-    # You can replace this URL with your own translation service
-    url = "https://libretranslate.com/translate"
-    payload = {
-        "q": text,
-        "source": source_lang,
-        "target": target_lang,
-        "format": "text"
-    }
 
+class GroqTranslationProvider(TranslationProvider):
+    name = "groq"
+
+    def __init__(self):
+        from .services import AsyncGroqService
+        self.service = AsyncGroqService()
+        # Cached under the model name, the same as GroqService.translate_batch.
+        self.name = self.service.model
+
+    def batches(self, texts):
+        # Sized by prompt tokens rather than count, like GroqService.translate_batch.
+        return split_by_budget(texts, getattr(settings, "TRANSLATION_CHUNK_TOKENS", 1500),
+                               getattr(settings, "TRANSLATION_CHUNK_ITEMS", 50))
+
+    async def translate_batch(self, texts, target_lang, source_lang):
+        return await self.service.translate_texts(texts, target_lang)
+
+
+PROVIDERS = {
+    "libretranslate": LibreTranslateProvider,
+    "groq": GroqTranslationProvider,
+}
+
+
+class TranslationBackend:
+    def __init__(self, provider, cache=translation_cache, window=None):
+        self.provider = provider
+        self.cache = cache
+        self._window = window
+        # Per event loop, like the HTTP clients: (pending, flushes), where pending
+        # is (target_lang, source_lang) -> {text: [futures]}.
+        self._batches = weakref.WeakKeyDictionary()
+
+    @property
+    def window(self):
+        return self._window if self._window is not None else getattr(settings, "TRANSLATION_BATCH_WINDOW", 0.01)
+
+    async def translate_many(self, texts, target_lang, source_lang="en"):
+        """``{text: translation}`` for every text; texts that fail come back unchanged."""
+        texts = list(dict.fromkeys(t for t in texts if t))
+        if target_lang == source_lang or not texts:
+            return {text: text for text in texts}
+        cached = await database_sync_to_async(self.cache.get_many)(texts, target_lang, self.provider.name)
+        misses = [text for text in texts if text not in cached]
+        if misses:
+            fresh = await self.provider.translate_many(misses, target_lang, source_lang)
+            if fresh:
+                await database_sync_to_async(self.cache.set_many)(fresh, target_lang, self.provider.name)
+            cached.update(fresh)
+        return {text: cached.get(text, text) for text in texts}
+
+    def _loop_batches(self):
+        loop = asyncio.get_running_loop()
+        batches = self._batches.get(loop)
+        if batches is None:
+            batches = self._batches[loop] = ({}, {})
+        return batches
+
+    async def translate(self, text, target_lang, source_lang="en"):
+        """One text, batched with whatever else is requested in the same short window."""
+        if not text or target_lang == source_lang:
+            return text
+        pending, flushes = self._loop_batches()
+        key = (target_lang, source_lang)
+        future = asyncio.get_running_loop().create_future()
+        pending.setdefault(key, {}).setdefault(text, []).append(future)
+        if key not in flushes:
+            flushes[key] = asyncio.create_task(self._flush_later(key))
+        return await future
+
+    async def _flush_later(self, key):
+        pending, flushes = self._loop_batches()
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            # Also when cancelled, e.g. by the loop shutting down: nothing is left behind.
+            del flushes[key]
+            batch = pending.pop(key, {})
+        # Leave out texts whose callers have all been cancelled in the meantime.
+        waiting = {text: futures for text, futures in batch.items()
+                   if not all(future.done() for future in futures)}
+        if not waiting:
+            return
+        try:
+            results = await self.translate_many(list(waiting), *key)
+        except Exception as e:
+            logger.error(f"Translation batch to {key[0]} failed: {e}")
+            results = {}
+        for text, futures in waiting.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(text, text))
+
+
+_backend = None
+
+
+def get_translation_backend():
+    global _backend
+    name = getattr(settings, "TRANSLATION_PROVIDER", "libretranslate")
+    if _backend is None or _backend.provider_key != name:
+        _backend = TranslationBackend(PROVIDERS[name]())
+        _backend.provider_key = name
+    return _backend
+
+
+async def translate_text(text, target_lang, source_lang='en'):
+    """Translate text with the configured provider, falling back to the original."""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            return result.get("translatedText", text)
-    except httpx.TimeoutException:
-        logger.error(f"Translation timeout for text: {text[:50]}...")
-    except httpx.HTTPStatusError as e:
-        logger.error(f"Translation HTTP error {e.response.status_code}: {e.response.text}")
+        return await get_translation_backend().translate(text, target_lang, source_lang)
     except Exception as e:
         logger.error(f"Translation unexpected error: {e}")
-
-    return text  # fallback
\ No newline at end of file
+        return text
@@ -0,0 +1,92 @@
+"""
+Content-addressed cache of LLM translations.
+
+Entries are keyed by ``(sha256(content), target_lang, model)``. Lookups hit a
+per-process LRU first and fall back to the ``CachedTranslation`` table, which
+all workers share; misses are the only texts sent to the model.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import CachedTranslation
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    def __init__(self, max_entries=None):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_entries(self):
+        return self._max_entries or getattr(settings, "TRANSLATION_CACHE_SIZE", 10000)
+
+    # ---------- memory tier ----------
+
+    def _remember(self, key, translation):
+        with self._lock:
+            self._entries[key] = translation
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _recall(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    # ---------- public API ----------
+
+    def get_many(self, texts, target_lang, model):
+        """Return ``{text: translation}`` for the texts that are cached in either tier."""
+        found, missing = {}, {}
+        for text in texts:
+            key = (content_hash(text), target_lang, model)
+            translation = self._recall(key)
+            if translation is None:
+                missing[key[0]] = text
+            else:
+                found[text] = translation
+        if missing:
+            rows = CachedTranslation.objects.filter(
+                content_hash__in=list(missing), target_lang=target_lang, model=model
+            ).values_list("content_hash", "translation")
+            for digest, translation in rows:
+                self._remember((digest, target_lang, model), translation)
+                found[missing[digest]] = translation
+        return found
+
+    def set_many(self, translations, target_lang, model):
+        """Store ``{text: translation}`` in both tiers."""
+        rows = []
+        for text, translation in translations.items():
+            digest = content_hash(text)
+            self._remember((digest, target_lang, model), translation)
+            rows.append(CachedTranslation(
+                content_hash=digest, target_lang=target_lang, model=model, translation=translation
+            ))
+        CachedTranslation.objects.bulk_create(rows, ignore_conflicts=True)
+
+    def invalidate(self, text):
+        """Forget every translation of text, in all languages and models."""
+        digest = content_hash(text)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == digest]:
+                del self._entries[key]
+        CachedTranslation.objects.filter(content_hash=digest).delete()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+translation_cache = TranslationCache()
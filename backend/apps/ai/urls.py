@@ -1,4 +1,7 @@
 from django.urls import path
+from .views import KeyPoolStatsView, StreamingStatsView
 
 urlpatterns = [
+    path('key-pool/', KeyPoolStatsView.as_view()),
+    path('streaming/', StreamingStatsView.as_view()),
 ]
@@ -1,3 +1,25 @@
-from django.shortcuts import render
+from rest_framework import generics, permissions
+from rest_framework.response import Response
 
-# Create your views here.
+from .key_pool import get_key_pool
+from .metrics import time_to_first_token
+
+
+class KeyPoolStatsView(generics.GenericAPIView):
+    """Per-key rate limit and circuit breaker state of this worker's key pool."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        try:
+            pool = get_key_pool()
+        except ValueError:
+            return Response({"keys": {}})
+        return Response({"rpm": pool.rpm, "burst": pool.capacity, "keys": pool.snapshot()})
+
+
+class StreamingStatsView(generics.GenericAPIView):
+    """Time to first token of this worker's streamed completions."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({"time_to_first_token": time_to_first_token.snapshot()})
@@ -13,7 +13,7 @@ class ChatRoomAdmin(admin.ModelAdmin):
 
 @admin.register(ChatParticipant)
 class ChatParticipantAdmin(admin.ModelAdmin):
-    list_display = ('id', 'chat_room', 'user', 'joined_at')
+    list_display = ('id', 'chat_room', 'user', 'joined_at', 'last_delivered_message_id', 'last_read_message_id')
     list_filter = ('chat_room',)
     search_fields = ('user__username',)
     raw_id_fields = ('chat_room', 'user')
@@ -0,0 +1,199 @@
+"""
+Conversation analysis (mood, reply and activity suggestions) per room.
+
+Messages sent through a worker are collected per room for
+``ANALYSIS_WINDOW`` seconds and analysed together, once per language the
+recipients read. The resulting reply suggestions go to every participant
+other than the last sender, and the mood goes to everyone. The room's recent
+messages and a rolling mood score are kept in memory, so the database is only
+read the first time a room is analysed. A window is skipped when it adds
+nothing worth a model call: fewer than ``ANALYSIS_MIN_NEW_WORDS`` words and no
+question, or exactly the conversation that was analysed last time.
+
+State is per process: with several workers, each one coalesces the messages
+that were sent through it.
+"""
+import asyncio
+import hashlib
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from apps.ai.rate_limit import ai_rate_limiter
+from apps.ai.services import AsyncGroqService
+
+from .fanout import group_send_many, user_groups
+from .models import Message
+
+User = get_user_model()
+
+CONTEXT_MESSAGES = 6
+
+
+def mood_label(score):
+    if score >= 60:
+        return "positive"
+    if score <= 40:
+        return "negative"
+    return "neutral"
+
+
+class RoomState:
+    def __init__(self):
+        self.context = deque(maxlen=CONTEXT_MESSAGES)
+        self.seeded = False
+        self.pending = []
+        self.participant_ids = set()
+        self.channel_layer = None
+        self.task = None
+        self.mood_score = None
+        self.fingerprint = None
+        self.last_activity = 0.0
+
+
+class RoomAnalyzer:
+    def __init__(self, analyze=None, window=None, clock=time.monotonic):
+        self._analyze = analyze
+        self._window = window
+        self.clock = clock
+        self.rooms = {}
+        self.counts = {"messages": 0, "analyses": 0, "model_calls": 0, "skipped": 0, "rate_limited": 0}
+
+    @property
+    def window(self):
+        return self._window if self._window is not None else getattr(settings, "ANALYSIS_WINDOW", 5)
+
+    async def analyze(self, conversation, lang):
+        if self._analyze is not None:
+            return await self._analyze(conversation, lang)
+        return await AsyncGroqService().analyze_conversation(conversation, lang)
+
+    def add(self, channel_layer, room_id, message, participant_ids):
+        """Queue a just-sent (serialized) message for the room's next analysis."""
+        room_id = int(room_id)
+        self._prune()
+        state = self.rooms.setdefault(room_id, RoomState())
+        state.pending.append(message)
+        state.participant_ids = set(participant_ids)
+        state.channel_layer = channel_layer
+        state.last_activity = self.clock()
+        self.counts["messages"] += 1
+        if state.task is None:
+            state.task = asyncio.create_task(self._flush_later(room_id, state))
+
+    def _prune(self):
+        idle = getattr(settings, "ANALYSIS_IDLE_TTL", 600)
+        now = self.clock()
+        for room_id in [r for r, s in self.rooms.items() if s.task is None and now - s.last_activity > idle]:
+            del self.rooms[room_id]
+
+    async def _flush_later(self, room_id, state):
+        try:
+            await asyncio.sleep(self.window)
+            state.task = None
+            await self.flush(room_id, state)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ AI analysis for room {room_id} failed: {e}")
+
+    def is_material(self, messages):
+        texts = [m["content"] for m in messages if m.get("message_type", "text") == "text" and m.get("content")]
+        words = sum(len(text.split()) for text in texts)
+        return words >= getattr(settings, "ANALYSIS_MIN_NEW_WORDS", 4) or any("?" in text for text in texts)
+
+    async def flush(self, room_id, state):
+        pending, state.pending = state.pending, []
+        if not pending:
+            return
+        if not state.seeded:
+            state.context.extend(await self.load_context(room_id, pending[0]["id"]))
+            state.seeded = True
+        state.context.extend(
+            m["content"] for m in pending if m.get("message_type", "text") == "text" and m.get("content")
+        )
+        conversation = "\n".join(state.context)
+        fingerprint = hashlib.sha1(conversation.encode()).hexdigest()
+        if not self.is_material(pending) or fingerprint == state.fingerprint:
+            self.counts["skipped"] += 1
+            print(f"⏭️ AI analysis for room {room_id} skipped: nothing new worth analysing")
+            return
+
+        last = pending[-1]
+        sender_id = last["sender"]["id"]
+        recipients = state.participant_ids - {sender_id}
+        if not recipients:
+            return
+        by_lang = {}
+        for user_id, lang in (await self.load_languages(recipients)).items():
+            by_lang.setdefault(lang or "en", []).append(user_id)
+        langs = list(by_lang)
+        # One model call per language, so one token per language.
+        decision = await ai_rate_limiter.acquire(
+            sender_id, room_id, max_wait=getattr(settings, "AI_RATE_MAX_DEFER", 10), cost=len(langs)
+        )
+        if not decision.allowed:
+            self.counts["rate_limited"] += 1
+            print(f"🚦 AI analysis for room {room_id} skipped: {decision.reason}")
+            return
+        results = await asyncio.gather(*(self.analyze(conversation, lang) for lang in langs))
+        state.fingerprint = fingerprint
+        self.counts["analyses"] += 1
+        self.counts["model_calls"] += len(langs)
+
+        mood = self.update_mood(state, results[0]["mood"])
+        layer = state.channel_layer
+        await asyncio.gather(
+            *(
+                group_send_many(layer, user_groups(by_lang[lang]), {
+                    "type": "ai_suggestions",
+                    "room_id": room_id,
+                    "message_id": last["id"],
+                    "replies": analysis["replies"],
+                    "suggestions": analysis["suggestions"],
+                })
+                for lang, analysis in zip(langs, results)
+            ),
+            group_send_many(layer, user_groups(state.participant_ids),
+                            {"type": "ai_summary", "room_id": room_id, "summary": mood}),
+        )
+        print(f"🧠 Analysed {len(pending)} message(s) in room {room_id} for {len(recipients)} user(s)")
+
+    def update_mood(self, state, mood):
+        """Blend the window's mood into the room's rolling score."""
+        try:
+            score = float(mood["score"])
+        except (KeyError, TypeError, ValueError):
+            score = 50.0
+        if state.mood_score is None:
+            state.mood_score = score
+        else:
+            weight = getattr(settings, "ANALYSIS_MOOD_SMOOTHING", 0.5)
+            state.mood_score = weight * score + (1 - weight) * state.mood_score
+        rounded = round(state.mood_score)
+        return {"score": rounded, "label": mood_label(rounded)}
+
+    @database_sync_to_async
+    def load_context(self, room_id, before_id):
+        messages = Message.objects.filter(
+            chat_room_id=room_id, id__lt=before_id, is_deleted=False, message_type="text"
+        ).exclude(content__isnull=True).exclude(content__exact="").order_by("-created_at", "-id")
+        return list(messages.values_list("content", flat=True)[:CONTEXT_MESSAGES])[::-1]
+
+    @database_sync_to_async
+    def load_languages(self, user_ids):
+        return dict(User.objects.filter(id__in=user_ids).values_list("id", "preferred_language"))
+
+    async def flush_all(self):
+        """Run every pending analysis now instead of at the end of its window."""
+        for room_id, state in list(self.rooms.items()):
+            if state.task is not None:
+                state.task.cancel()
+                state.task = None
+            await self.flush(room_id, state)
+
+
+room_analyzer = RoomAnalyzer()
@@ -1,60 +1,35 @@
 import json
 import asyncio
-import time
 import traceback
 import re
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.utils import timezone
 from django.contrib.auth.models import AnonymousUser
 
-from .models import ChatRoom, MessageReadStatus, Message
+from . import read_state
+from .analysis import room_analyzer
+from .fanout import group_send_many, user_groups
+from .models import ChatRoom, ChatParticipant, Message
+from .presence import presence_service
+from .pretranslate import PreTranslation
+from .receipts import DeliveryReceiptBatcher, group_by_sender, send_receipts
+from .related import related_users
 from .serializers import SendMessageSerializer, RoomMessageSerializer
-from apps.ai.services import GroqService
+from .suggestions import GhostSuggestionScheduler
+from .summaries import last_read_message_id, summary_tree
+from apps.ai.rate_limit import ai_rate_limiter
+from apps.ai.services import AsyncGroqService
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
-class RateLimiter:
-    def __init__(self, max_calls, period):
-        self.max_calls = max_calls
-        self.period = period
-        self.calls = []
-        self.lock = asyncio.Lock()
-
-    async def acquire(self):
-        async with self.lock:
-            now = time.time()
-            self.calls = [t for t in self.calls if now - t < self.period]
-            if len(self.calls) >= self.max_calls:
-                sleep_time = self.period - (now - self.calls[0])
-                print(f"⏳ Rate limit reached, waiting {sleep_time:.2f}s")
-                await asyncio.sleep(sleep_time)
-            self.calls.append(now)
-
-
-class RateLimiter:
-    def __init__(self, max_calls, period):
-        self.max_calls = max_calls
-        self.period = period
-        self.calls = []
-        self.lock = asyncio.Lock()
-
-    async def acquire(self):
-        async with self.lock:
-            now = time.time()
-            self.calls = [t for t in self.calls if now - t < self.period]
-            if len(self.calls) >= self.max_calls:
-                sleep_time = self.period - (now - self.calls[0])
-                print(f"⏳ Rate limit reached, waiting {sleep_time:.2f}s")
-                await asyncio.sleep(sleep_time)
-            self.calls.append(now)
+
 
 def extract_mentions(text):
     return re.findall(r'@(\w+)', text)
 
 class ChatConsumer(AsyncWebsocketConsumer):
-    ai_rate_limiter = RateLimiter(max_calls=14, period=60)
+    ai_rate_limiter = ai_rate_limiter
 
     async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
@@ -66,11 +41,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        if not await self.is_participant():
+        await self.load_room_context()
+        if not self.is_participant():
             print(f"❌ User {self.user.id} not a participant of room {self.room_id}")
             await self.close()
             return
 
+        self.receipts = DeliveryReceiptBatcher(self.channel_layer, self.user)
+        self.suggestions = GhostSuggestionScheduler(
+            self.load_suggestion_context, self.generate_suggestion, self.send_suggestion, self.admit_suggestion,
+            stream=self.stream_suggestion, send_delta=self.send_suggestion_delta,
+        )
+        self.ai_streams = set()
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         print(f"✅ User {self.user.id} ({self.user.username}) JOINED room group {self.room_group_name}")
         await self.accept()
@@ -80,6 +62,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         user_id = self.user.id if self.user else "Unknown"
         print(f"❌ User {user_id} LEFT room group {self.room_group_name} (close_code: {close_code})")
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if hasattr(self, "receipts"):
+            await self.receipts.close()
+        if hasattr(self, "suggestions"):
+            await self.suggestions.close()
+        # Nobody is left to read them; stop paying for the tokens.
+        for task in getattr(self, "ai_streams", ()):
+            task.cancel()
 
     async def receive(self, text_data):
         try:
@@ -115,7 +104,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
         try:
             message_text = data["message"]
             temp_id = data.get("temp_id")
-            target_lang = data.get("target_lang")
             reply_to_id = data.get("reply_to_id")
             message_type = data.get("message_type", "text")
             duration = data.get("duration")
@@ -133,54 +121,77 @@ class ChatConsumer(AsyncWebsocketConsumer):
             # Remove None values
             extra = {k: v for k, v in extra.items() if v is not None}
 
-            message = await self.create_message(message_text, extra)
-            serialized = await self.serialize_message(message)
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {"type": "chat_message", "message": serialized, "temp_id": temp_id}
+            # Started before the save so the translation overlaps it.
+            pretranslation = PreTranslation.start(
+                message_text, self.participant_languages, self.user_language, message_type
             )
-            print(f"📤 Broadcast chat_message to room {self.room_group_name}")
-
-            participant_ids = await self.get_participant_ids()
-            for user_id in participant_ids:
-                if user_id != self.user.id:
-                    await self.channel_layer.group_send(
-                        f"user_{user_id}",
-                        {
-                            "type": "new_message_notification",
-                            "message": serialized,
-                            "room_id": self.room_id,
-                            "sender_id": self.user.id
-                        }
-                    )
-            print(f"📤 Sent new_message_notification to users: {[uid for uid in participant_ids if uid != self.user.id]}")
-
-            other_user_ids = [uid for uid in participant_ids if uid != self.user.id]
+            try:
+                message = await self.create_message(message_text, extra)
+                serialized = await self.serialize_message(message)
+            except Exception:
+                if pretranslation is not None:
+                    pretranslation.cancel()
+                raise
+            if pretranslation is not None:
+                # Whatever is already done goes out now; nothing waits for the rest.
+                serialized["translations"] = pretranslation.ready()
+                pretranslation.complete(self.channel_layer, self.room_group_name, message.id,
+                                        serialized["translations"])
+            other_user_ids = [uid for uid in self.participant_ids if uid != self.user.id]
+
+            # Room broadcast and per-user notifications go out concurrently;
+            # the notifications are a single fan-out call however big the room.
+            await asyncio.gather(
+                self.channel_layer.group_send(
+                    self.room_group_name,
+                    {"type": "chat_message", "message": serialized, "temp_id": temp_id}
+                ),
+                group_send_many(
+                    self.channel_layer,
+                    user_groups(other_user_ids),
+                    {
+                        "type": "new_message_notification",
+                        "message": serialized,
+                        "room_id": self.room_id,
+                        "sender_id": self.user.id
+                    }
+                ),
+            )
+            print(f"📤 Broadcast chat_message to room {self.room_group_name}, notified {len(other_user_ids)} users")
+
             if other_user_ids:
-                asyncio.create_task(self.run_ai_analysis(serialized, other_user_ids[0], target_lang))
+                room_analyzer.add(self.channel_layer, self.room_id, serialized, self.participant_ids)
+            summary_tree.schedule(self.room_id)
 
             # Handle mentions
             mentions = extract_mentions(message_text)
             if mentions:
                 users = await self.get_users_by_usernames(mentions)
-                for user in users:
-                    if user.id != self.user.id and user.id in participant_ids:
-                        await self.channel_layer.group_send(
-                            f"user_{user.id}",
-                            {
-                                "type": "mention_notification",
-                                "room_id": self.room_id,
-                                "message_id": message.id,
-                                "mentioned_by": self.user.username,
-                            }
-                        )
+                mentioned_ids = [user.id for user in users if user.id in other_user_ids]
+                await group_send_many(
+                    self.channel_layer,
+                    user_groups(mentioned_ids),
+                    {
+                        "type": "mention_notification",
+                        "room_id": self.room_id,
+                        "message_id": message.id,
+                        "mentioned_by": self.user.username,
+                    }
+                )
         except Exception as e:
             print(f"❌ Error in handle_chat_message: {e}")
             traceback.print_exc()
 
+    async def message_translated(self, event):
+        await self.send(text_data=json.dumps({
+            "type": "message_translated",
+            "message_id": event["message_id"],
+            "translations": event["translations"],
+        }))
+
     async def chat_message(self, event):
         try:
+            self.suggestions.invalidate_context()
             await self.send(text_data=json.dumps({
                 "type": "chat_message",
                 "message": event["message"],
@@ -188,17 +199,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }))
             print(f"📤 Delivered chat_message to client {self.user.id}")
 
-            if self.user.id != event["message"]["sender"]["id"]:
-                await self.mark_message_delivered(event["message"]["id"])
-                await self.channel_layer.group_send(
-                    f"user_{event['message']['sender']['id']}",
-                    {
-                        "type": "delivered_receipt",
-                        "message_id": event["message"]["id"],
-                        "delivered_to": self.user.username
-                    }
-                )
-                print(f"📤 Sent delivered_receipt for msg {event['message']['id']} to user {event['message']['sender']['id']}")
+            self.receipts.add(event["message"]["sender"]["id"], self.room_id, event["message"]["id"])
         except Exception as e:
             print(f"❌ Error in chat_message: {e}")
 
@@ -240,38 +241,99 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def handle_typing_suggestion(self, data):
         try:
-            partial = data.get("partial", "")
-            target_lang = data.get("target_lang")
-            if len(partial) < 3:
-                return
-            recent_msgs = await self.get_recent_messages(self.room_id, limit=5)
-            recent_msgs = [msg for msg in recent_msgs if msg and isinstance(msg, str)]
-            context = "\n".join(recent_msgs) if recent_msgs else ""
-            ai = GroqService()
-            user_lang = target_lang if target_lang else await self.get_user_language(self.user.id)
-            continuation = await asyncio.to_thread(ai.generate_continuation, partial, context, user_lang)
-            if continuation:
-                await self.send(text_data=json.dumps({"type": "ghost_suggestion", "continuation": continuation}))
+            user_lang = data.get("target_lang") or self.user_language
+            await self.suggestions.submit(data.get("partial", ""), user_lang, streaming=bool(data.get("stream")))
         except Exception as e:
             print(f"❌ Error in handle_typing_suggestion: {e}")
 
+    async def load_suggestion_context(self):
+        recent_msgs = await self.get_recent_messages(self.room_id, limit=5)
+        return "\n".join(msg for msg in recent_msgs if msg and isinstance(msg, str))
+
+    async def generate_suggestion(self, partial, context, lang):
+        return await AsyncGroqService().generate_continuation(partial, context, lang)
+
+    def stream_suggestion(self, partial, context, lang):
+        return AsyncGroqService().stream_continuation(partial, context, lang)
+
+    async def send_suggestion_delta(self, partial, delta):
+        await self.send(text_data=json.dumps({"type": "ghost_suggestion_delta", "partial": partial, "delta": delta}))
+
+    async def send_suggestion(self, partial, continuation):
+        await self.send(text_data=json.dumps({"type": "ghost_suggestion", "partial": partial, "continuation": continuation}))
+
+    async def admit_suggestion(self):
+        # A suggestion is stale by the time a retry would run, so just drop it.
+        decision = await self.ai_rate_limiter.admit(self.user.id, self.room_id)
+        if not decision.allowed:
+            print(f"🚦 Ghost suggestion for user {self.user.id} skipped: {decision.reason}")
+        return decision.allowed
+
     async def handle_request_summary(self, data):
+        """
+        ``since`` absent: the last 40 messages. ``since: "last_read"`` or a
+        message id: everything after it, from the room's stored summary tree.
+        With ``stream: true`` the summary also arrives as chat_summary_delta frames.
+        """
         try:
-            recent_msgs = await self.get_recent_messages(self.room_id, limit=40)
-            recent_msgs = [msg for msg in recent_msgs if msg and isinstance(msg, str)]
-            if not recent_msgs:
-                await self.send(text_data=json.dumps({"type": "chat_summary", "summary": "Not enough messages to summarize."}))
+            since = data.get("since")
+            if since is None:
+                lines = await self.get_recent_messages(self.room_id, limit=40)
+                lines = [msg for msg in lines if msg and isinstance(msg, str)]
+                if not lines:
+                    await self.send(text_data=json.dumps({"type": "chat_summary", "summary": "Not enough messages to summarize."}))
+                    return
+            else:
+                if since == "last_read":
+                    after_id = await database_sync_to_async(last_read_message_id)(self.user.id, self.room_id)
+                else:
+                    after_id = int(since)
+                summary_tree.schedule(self.room_id)
+                lines = await database_sync_to_async(summary_tree.cover)(self.room_id, after_id)
+                if not lines:
+                    await self.send_summary("Nothing new since you were last here.", since)
+                    return
+            decision = await self.ai_rate_limiter.admit(self.user.id, self.room_id)
+            if not decision.allowed:
+                await self.send(text_data=json.dumps({
+                    "type": "rate_limited",
+                    "action": "request_summary",
+                    "reason": decision.reason,
+                    "retry_after": round(decision.retry_after, 1),
+                }))
                 return
-            ai = GroqService()
-            user_lang = await self.get_user_language(self.user.id)
-            summary = await asyncio.to_thread(ai.summarize_conversation, recent_msgs, user_lang)
-            await self.channel_layer.group_send(
-                f"user_{self.user.id}",
-                {"type": "chat_summary", "room_id": self.room_id, "summary": summary}
-            )
+            if data.get("stream"):
+                # Streamed in the background so this connection keeps handling frames.
+                task = asyncio.create_task(self.stream_summary(lines, since))
+                self.ai_streams.add(task)
+                task.add_done_callback(self.ai_streams.discard)
+            else:
+                summary = await AsyncGroqService().summarize_conversation(lines, self.user_language)
+                await self.send_summary(summary, since)
         except Exception as e:
             print(f"❌ Error in handle_request_summary: {e}")
 
+    async def stream_summary(self, lines, since):
+        try:
+            parts = []
+            async for delta in AsyncGroqService().stream_summary(lines, self.user_language):
+                parts.append(delta)
+                await self.send(text_data=json.dumps({
+                    "type": "chat_summary_delta", "room_id": self.room_id, "delta": delta, "since": since
+                }))
+            await self.send_summary("".join(parts).strip() or "No summary available.", since)
+        except asyncio.CancelledError:
+            print(f"🛑 Summary stream for user {self.user.id} cancelled")
+            raise
+        except Exception as e:
+            print(f"❌ Error in stream_summary: {e}")
+
+    async def send_summary(self, summary, since):
+        await self.channel_layer.group_send(
+            f"user_{self.user.id}",
+            {"type": "chat_summary", "room_id": self.room_id, "summary": summary, "since": since}
+        )
+
     async def handle_edit_message(self, data):
         try:
             await self.channel_layer.group_send(
@@ -292,12 +354,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def message_edited(self, event):
         try:
+            self.suggestions.invalidate_context()
             await self.send(text_data=json.dumps({"type": "message_edited", "message_id": event["message_id"], "new_content": event["new_content"], "edited": event["edited"]}))
         except Exception as e:
             print(f"❌ Error in message_edited: {e}")
 
     async def message_deleted(self, event):
         try:
+            self.suggestions.invalidate_context()
             await self.send(text_data=json.dumps({"type": "message_deleted", "message_id": event["message_id"]}))
         except Exception as e:
             print(f"❌ Error in message_deleted: {e}")
@@ -321,41 +385,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f"❌ Error in reaction_update: {e}")
 
-    async def run_ai_analysis(self, message, target_user_id, target_lang=None):
-        try:
-            await self.ai_rate_limiter.acquire()
-            ai = GroqService()
-            recent_msgs = await self.get_recent_messages(self.room_id, limit=3)
-            recent_msgs = [msg for msg in recent_msgs if msg and isinstance(msg, str)]
-            if message['content'] not in recent_msgs:
-                recent_msgs.append(message['content'])
-                recent_msgs = recent_msgs[-3:]
-            conversation = "\n".join(recent_msgs)
-            lang = target_lang if target_lang else await self.get_user_language(target_user_id)
-            analysis = await asyncio.to_thread(ai.analyze_conversation, conversation, lang)
-
-            await self.channel_layer.group_send(
-                f"user_{target_user_id}",
-                {
-                    "type": "ai_suggestions",
-                    "room_id": self.room_id,
-                    "message_id": message['id'],
-                    "replies": analysis['replies'],
-                    "suggestions": analysis['suggestions']
-                }
-            )
-            await self.channel_layer.group_send(
-                f"user_{target_user_id}",
-                {"type": "ai_summary", "room_id": self.room_id, "summary": analysis['mood']}
-            )
-            await self.channel_layer.group_send(
-                f"user_{self.user.id}",
-                {"type": "ai_summary", "room_id": self.room_id, "summary": analysis['mood']}
-            )
-        except Exception as e:
-            print(f"❌ AI task failed: {e}")
-            traceback.print_exc()
-
     async def mention_notification(self, event):
         await self.send(text_data=json.dumps({
             "type": "mention_notification",
@@ -364,9 +393,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
             "mentioned_by": event["mentioned_by"]
         }))
 
-    @database_sync_to_async
+    async def membership_changed(self, event):
+        """Someone joined or left the room: drop the cached context and reload it."""
+        await self.load_room_context()
+        if not self.is_participant():
+            print(f"❌ User {self.user.id} no longer in room {self.room_id}, closing")
+            await self.close()
+
     def is_participant(self):
-        return ChatRoom.objects.filter(id=self.room_id, participants__user=self.user).exists()
+        return self.room is not None and self.user.id in self.participant_ids
+
+    @database_sync_to_async
+    def load_room_context(self):
+        """
+        Cache the room, its participant ids and the user's language for the
+        lifetime of the connection, so the send path does not re-query them.
+        Reloaded on membership_changed events.
+        """
+        self.room = ChatRoom.objects.filter(id=self.room_id).first()
+        participants = list(ChatParticipant.objects.filter(chat_room_id=self.room_id).values_list(
+            "user_id", "user__preferred_language"
+        ))
+        self.participant_ids = {user_id for user_id, _ in participants}
+        self.participant_languages = {lang for _, lang in participants}
+        self.user_language = self.user.preferred_language
 
     @database_sync_to_async
     def create_message(self, message_text, extra=None):
@@ -374,27 +424,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         data = {"room_id": self.room_id, "content": message_text}
         if extra:
             data.update(extra)
-        serializer = SendMessageSerializer(data=data, context={"user": self.user})  # <-- fixed
+        serializer = SendMessageSerializer(data=data, context={"user": self.user, "room": self.room})
         serializer.is_valid(raise_exception=True)
         return serializer.save()
 
     @database_sync_to_async
     def serialize_message(self, message):
-        message = Message.objects.select_related("sender").get(id=message.id)
+        # The freshly created instance already carries its sender and room.
         return RoomMessageSerializer(message, context={'user': self.user}).data
     
     @database_sync_to_async
     def mark_message_as_read(self, message_id):
-        MessageReadStatus.objects.filter(message_id=message_id, user=self.user, is_read=False).update(is_read=True, read_at=timezone.now())
-
-    @database_sync_to_async
-    def mark_message_delivered(self, message_id):
-        MessageReadStatus.objects.filter(message_id=message_id, user=self.user, is_delivered=False).update(is_delivered=True, delivered_at=timezone.now())
-
-    @database_sync_to_async
-    def get_participant_ids(self):
-        room = ChatRoom.objects.get(id=self.room_id)
-        return list(room.participants.values_list("user_id", flat=True))
+        read_state.mark_read(self.user.id, self.room_id, message_id)
 
     @database_sync_to_async
     def get_recent_messages(self, room_id, limit=5):
@@ -403,14 +444,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
         ).exclude(content__isnull=True).exclude(content__exact='').order_by('-created_at')[:limit]
         return [msg.content for msg in reversed(messages)]
 
-    @database_sync_to_async
-    def get_user_language(self, user_id):
-        try:
-            user = User.objects.get(id=user_id)
-            return user.preferred_language
-        except User.DoesNotExist:
-            return 'en'
-
     @database_sync_to_async
     def toggle_reaction(self, message_id, emoji, user):
         from .models import MessageReaction, Message
@@ -434,122 +467,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         return list(User.objects.filter(username__in=usernames))
 
 class GlobalConsumer(AsyncWebsocketConsumer):
-    active_connections = {}
-
-    async def connect(self):
-        self.user = self.scope["user"]
-        if self.user.is_anonymous:
-            print("❌ GlobalConsumer: anonymous user rejected")
-            await self.close()
-            return
-        self.user_group = f"user_{self.user.id}"
-        await self.channel_layer.group_add(self.user_group, self.channel_name)
-        await self.accept()
-        print(f"🌍 GlobalConsumer connected: user {self.user.id} ({self.user.username})")
-        is_first = await self.increment_connection()
-        if is_first:
-            await self.broadcast_presence(True)
-        for uid, count in self.active_connections.items():
-            if uid != self.user.id and count > 0:
-                await self.channel_layer.group_send(
-                    self.user_group,
-                    {"type": "presence_update", "user_id": uid, "is_online": True}
-                )
-        await self.broadcast_delivered()
-
-    async def disconnect(self, close_code):
-        print(f"🌍 GlobalConsumer disconnected: user {self.user.id}")
-        await self.channel_layer.group_discard(self.user_group, self.channel_name)
-        is_last = await self.decrement_connection()
-        if is_last:
-            await self.update_last_seen()
-            await self.broadcast_presence(False)
-
-    async def new_message_notification(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "new_message_notification", "message": event["message"], "room_id": event["room_id"]
-        }))
-        await self.channel_layer.group_send(
-            f"user_{event['sender_id']}",
-            {"type": "delivered_receipt", "message_id": event["message"]["id"], "delivered_to": self.user.username}
-        )
-
-    async def delivered_receipt(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def broadcast_delivered(self):
-        pending = await self.get_pending_messages()
-        for msg_id, sender_id in pending:
-            await self.mark_delivered(msg_id)
-            await self.channel_layer.group_send(
-                f"user_{sender_id}",
-                {"type": "delivered_receipt", "message_id": msg_id, "delivered_to": self.user.username}
-            )
-
-    async def presence_update(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def broadcast_presence(self, is_online):
-        related_users = await self.get_related_user_ids()
-        for user_id in related_users:
-            await self.channel_layer.group_send(
-                f"user_{user_id}",
-                {"type": "presence_update", "user_id": self.user.id, "is_online": is_online}
-            )
-
-    async def ai_suggestions(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def ai_summary(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def chat_summary(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def mention_notification(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    async def increment_connection(self):
-        user_id = self.user.id
-        count = self.active_connections.get(user_id, 0) + 1
-        self.active_connections[user_id] = count
-        return count == 1
-
-    async def decrement_connection(self):
-        user_id = self.user.id
-        count = self.active_connections.get(user_id, 1) - 1
-        if count <= 0:
-            self.active_connections.pop(user_id, None)
-            return True
-        self.active_connections[user_id] = count
-        return False
-
-    @database_sync_to_async
-    def update_last_seen(self):
-        self.user.last_seen = timezone.now()
-        self.user.save(update_fields=["last_seen"])
-
-    @database_sync_to_async
-    def get_related_user_ids(self):
-        rooms = ChatRoom.objects.filter(participants__user=self.user)
-        user_ids = set()
-        for room in rooms:
-            for participant in room.participants.all():
-                if participant.user_id != self.user.id:
-                    user_ids.add(participant.user_id)
-        return list(user_ids)
-
-    @database_sync_to_async
-    def get_pending_messages(self):
-        pending = MessageReadStatus.objects.filter(user=self.user, is_delivered=False).select_related("message")
-        return [(status.message_id, status.message.sender_id) for status in pending]
-
-    @database_sync_to_async
-    def mark_delivered(self, message_id):
-        MessageReadStatus.objects.filter(message_id=message_id, user=self.user, is_delivered=False).update(is_delivered=True, delivered_at=timezone.now())
-        
-class GlobalConsumer(AsyncWebsocketConsumer):
-    active_connections = {}
+    # Connection counts are kept in the shared presence registry rather than
+    # on the class, so every worker process agrees on who is online; the
+    # service debounces and batches what related users are told.
+    presence = presence_service
 
     async def connect(self):
         self.user = self.scope["user"]
@@ -559,70 +480,45 @@ class GlobalConsumer(AsyncWebsocketConsumer):
             return
 
         self.user_group = f"user_{self.user.id}"
+        self.receipts = DeliveryReceiptBatcher(self.channel_layer, self.user)
         await self.channel_layer.group_add(self.user_group, self.channel_name)
         await self.accept()
         print(f"🌍 GlobalConsumer connected: user {self.user.id} ({self.user.username})")
 
-        is_first = await self.increment_connection()
-        if is_first:
-            await self.broadcast_presence(True)
-
-        for uid, count in self.active_connections.items():
-            if uid != self.user.id and count > 0:
-                await self.channel_layer.group_send(
-                    self.user_group,
-                    {"type": "presence_update", "user_id": uid, "is_online": True}
-                )
-                print(f"🌍 Sent presence_update for user {uid} to new user {self.user.id}")
+        online_ids = await self.presence.connected(self.channel_layer, self.user.id, await self.get_related_user_ids())
+        await self.send(text_data=json.dumps({"type": "presence_snapshot", "online": sorted(online_ids)}))
+        print(f"🌍 Sent presence snapshot ({len(online_ids)} online) to user {self.user.id}")
 
         await self.broadcast_delivered()
 
     async def disconnect(self, close_code):
         print(f"🌍 GlobalConsumer disconnected: user {self.user.id}")
         await self.channel_layer.group_discard(self.user_group, self.channel_name)
-        is_last = await self.decrement_connection()
-        if is_last:
-            await self.update_last_seen()
-            await self.broadcast_presence(False)
+        await self.receipts.close()
+        is_last = await self.presence.disconnected(self.channel_layer, self.user.id, await self.get_related_user_ids())
+        print(f"🔢 User {self.user.id} disconnected (last connection: {is_last})")
 
     async def new_message_notification(self, event):
         await self.send(text_data=json.dumps({
             "type": "new_message_notification", "message": event["message"], "room_id": event["room_id"]
         }))
         print(f"🌍 Sent new_message_notification to user {self.user.id}")
+        self.receipts.add(event["sender_id"], event["room_id"], event["message"]["id"])
 
-        await self.channel_layer.group_send(
-            f"user_{event['sender_id']}",
-            {"type": "delivered_receipt", "message_id": event["message"]["id"], "delivered_to": self.user.username}
-        )
-        print(f"🌍 Sent delivered_receipt for msg {event['message']['id']} to sender {event['sender_id']}")
-
-    async def delivered_receipt(self, event):
+    async def delivered_receipts(self, event):
         await self.send(text_data=json.dumps(event))
-        print(f"🌍 Forwarded delivered_receipt to user {self.user.id}")
+        print(f"🌍 Forwarded {len(event['message_ids'])} delivered receipts to user {self.user.id}")
 
     async def broadcast_delivered(self):
-        pending = await self.get_pending_messages()
-        for msg_id, sender_id in pending:
-            await self.mark_delivered(msg_id)
-            await self.channel_layer.group_send(
-                f"user_{sender_id}",
-                {"type": "delivered_receipt", "message_id": msg_id, "delivered_to": self.user.username}
-            )
-            print(f"🌍 Broadcast delivered receipt for message {msg_id} to user {sender_id}")
+        pending = await self.deliver_pending()
+        if pending:
+            by_sender = group_by_sender(pending)
+            await send_receipts(self.channel_layer, by_sender, self.user.username)
+            print(f"🌍 Broadcast {len(pending)} delivered receipts to {len(by_sender)} senders")
 
-    async def presence_update(self, event):
+    async def presence_batch(self, event):
         await self.send(text_data=json.dumps(event))
 
-    async def broadcast_presence(self, is_online):
-        related_users = await self.get_related_user_ids()
-        for user_id in related_users:
-            await self.channel_layer.group_send(
-                f"user_{user_id}",
-                {"type": "presence_update", "user_id": self.user.id, "is_online": is_online}
-            )
-        print(f"🌍 Broadcast presence {is_online} to {len(related_users)} users")
-
     async def ai_suggestions(self, event):
         await self.send(text_data=json.dumps(event))
 
@@ -632,45 +528,12 @@ class GlobalConsumer(AsyncWebsocketConsumer):
     async def chat_summary(self, event):
         await self.send(text_data=json.dumps(event))
 
-    async def increment_connection(self):
-        user_id = self.user.id
-        count = self.active_connections.get(user_id, 0) + 1
-        self.active_connections[user_id] = count
-        print(f"🔢 User {user_id} connections: {count}")
-        return count == 1
-
-    async def decrement_connection(self):
-        user_id = self.user.id
-        count = self.active_connections.get(user_id, 1) - 1
-        if count <= 0:
-            self.active_connections.pop(user_id, None)
-            print(f"🔢 User {user_id} connections: 0 (offline)")
-            return True
-        self.active_connections[user_id] = count
-        print(f"🔢 User {user_id} connections: {count}")
-        return False
-
-    @database_sync_to_async
-    def update_last_seen(self):
-        self.user.last_seen = timezone.now()
-        self.user.save(update_fields=["last_seen"])
-        print(f"🕒 Updated last_seen for user {self.user.id}")
-
-    @database_sync_to_async
-    def get_related_user_ids(self):
-        rooms = ChatRoom.objects.filter(participants__user=self.user)
-        user_ids = set()
-        for room in rooms:
-            for participant in room.participants.all():
-                if participant.user_id != self.user.id:
-                    user_ids.add(participant.user_id)
-        return list(user_ids)
+    async def mention_notification(self, event):
+        await self.send(text_data=json.dumps(event))
 
-    @database_sync_to_async
-    def get_pending_messages(self):
-        pending = MessageReadStatus.objects.filter(user=self.user, is_delivered=False).select_related("message")
-        return [(status.message_id, status.message.sender_id) for status in pending]
+    async def get_related_user_ids(self):
+        return await related_users.aget(self.user.id)
 
     @database_sync_to_async
-    def mark_delivered(self, message_id):
-        MessageReadStatus.objects.filter(message_id=message_id, user=self.user, is_delivered=False).update(is_delivered=True, delivered_at=timezone.now())
\ No newline at end of file
+    def deliver_pending(self):
+        return read_state.deliver_pending(self.user)
@@ -0,0 +1,24 @@
+"""
+Delivering one event to many per-user groups.
+
+``group_send_many`` hands the whole batch to the channel layer in one call when
+the layer supports it (see ``apps.chat.layers``), so the event is serialized
+once and published in a single round-trip. Other layers fall back to
+concurrent ``group_send`` calls instead of awaiting them one by one.
+"""
+import asyncio
+
+
+def user_groups(user_ids, exclude=None):
+    return [f"user_{user_id}" for user_id in user_ids if user_id != exclude]
+
+
+async def group_send_many(channel_layer, groups, message):
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return
+    send_many = getattr(channel_layer, "group_send_many", None)
+    if send_many is not None:
+        await send_many(groups, message)
+    else:
+        await asyncio.gather(*(channel_layer.group_send(group, message) for group in groups))
@@ -0,0 +1,66 @@
+"""
+Redis pub/sub channel layer with a batched ``group_send_many`` extension, which
+``apps.chat.fanout.group_send_many`` uses to send one event to many groups in
+a single operation.
+
+Batching goes through channels_redis internals (pinned in requirements.txt).
+If a release no longer has them, ``group_send_many`` falls back to concurrent
+``group_send`` calls instead of failing.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+
+from channels_redis import pubsub
+
+logger = logging.getLogger(__name__)
+
+LAYER_INTERNALS = ("_get_group_channel_name", "_get_shard")
+SHARD_INTERNALS = ("_lock", "_ensure_redis", "_redis")
+
+
+def has_internals(obj, names):
+    return all(hasattr(obj, name) for name in names)
+
+
+class RedisPubSubChannelLayer(pubsub.RedisPubSubChannelLayer):
+    batching_unavailable = False
+
+    async def group_send_many(self, groups, message):
+        """Serialize once and PUBLISH to every group in one pipelined round-trip per shard."""
+        by_shard = None if self.batching_unavailable else self._channels_by_shard(groups)
+        if by_shard is None:
+            await asyncio.gather(*(self.group_send(group, message) for group in groups))
+            return
+        payload = self.serialize(message)
+        await asyncio.gather(*(
+            self._publish_many(shard, channels, payload) for shard, channels in by_shard.items()
+        ))
+
+    def _channels_by_shard(self, groups):
+        """``{shard: [group channel, ...]}``, or None if channels_redis lacks what batching needs."""
+        layer = self._get_layer() if hasattr(self, "_get_layer") else None
+        if layer is None or not has_internals(layer, LAYER_INTERNALS):
+            return self._unavailable()
+        by_shard = defaultdict(list)
+        for group in groups:
+            group_channel = layer._get_group_channel_name(group)
+            by_shard[layer._get_shard(group_channel)].append(group_channel)
+        if not all(has_internals(shard, SHARD_INTERNALS) for shard in by_shard):
+            return self._unavailable()
+        return by_shard
+
+    def _unavailable(self):
+        if not self.batching_unavailable:
+            logger.warning("channels_redis internals changed; group_send_many falls back to group_send")
+            self.batching_unavailable = True
+        return None
+
+    @staticmethod
+    async def _publish_many(shard, channels, payload):
+        async with shard._lock:
+            shard._ensure_redis()
+            pipe = shard._redis.pipeline(transaction=False)
+            for channel in channels:
+                pipe.publish(channel, payload)
+            await pipe.execute()
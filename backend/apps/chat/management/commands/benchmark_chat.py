@@ -0,0 +1,247 @@
+import random
+import statistics
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.chat.fanout import group_send_many, user_groups
+from apps.chat.models import ChatRoom, ChatParticipant, Message
+from apps.chat import search
+from apps.chat.pagination import MessageCursorPagination
+from apps.chat.read_state import record_new_message
+from apps.chat.serializers import SendMessageSerializer
+from apps.chat.views import RoomMessagesView, UserChatRoomsView
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Benchmark hot chat paths on throwaway data. Everything is rolled back afterwards."
+
+    scenarios = ("send", "fanout", "roomlist", "history", "search")
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=self.scenarios)
+        parser.add_argument("--sizes", default="2,10,50,200",
+                            help="Comma-separated room sizes (members), room counts for roomlist, "
+                                 "or messages in the corpus for history and search.")
+        parser.add_argument("--iterations", type=int, default=50)
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options["sizes"].split(",") if s.strip()]
+        bench = getattr(self, f"bench_{options['scenario']}")
+        with transaction.atomic():
+            bench(sizes, options["iterations"])
+            transaction.set_rollback(True)
+
+    # ---------- helpers ----------
+
+    def make_users(self, count):
+        tag = uuid.uuid4().hex[:8]
+        users = [
+            User(
+                username=f"bench_{tag}_{i}",
+                email=f"bench_{tag}_{i}@example.com",
+                phone_number=f"b{tag}{i}"[:15],
+                password="!",
+            )
+            for i in range(count)
+        ]
+        User.objects.bulk_create(users)
+        return list(User.objects.filter(username__startswith=f"bench_{tag}_").order_by("id"))
+
+    def make_room(self, users):
+        room = ChatRoom.objects.create(room_type="group", name="bench", creator=users[0])
+        ChatParticipant.objects.bulk_create(
+            [ChatParticipant(chat_room=room, user=u) for u in users]
+        )
+        return room
+
+    def report(self, label, timings, queries):
+        timings = sorted(timings)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        self.stdout.write(
+            f"{label:>12}  mean {statistics.mean(timings) * 1000:8.2f} ms"
+            f"  p95 {p95 * 1000:8.2f} ms  queries/op {queries / len(timings):6.1f}"
+        )
+
+    # ---------- scenarios ----------
+
+    def bench_send(self, sizes, iterations):
+        """Send latency through SendMessageSerializer as a function of group size."""
+        for size in sizes:
+            users = self.make_users(size)
+            room = self.make_room(users)
+            sender = users[0]
+            timings = []
+            with CaptureQueriesContext(connection) as ctx:
+                for i in range(iterations):
+                    start = time.perf_counter()
+                    serializer = SendMessageSerializer(
+                        data={"room_id": room.id, "content": f"bench {i}"},
+                        context={"user": sender},
+                    )
+                    serializer.is_valid(raise_exception=True)
+                    serializer.save()
+                    timings.append(time.perf_counter() - start)
+            self.report(f"{size} members", timings, len(ctx.captured_queries))
+
+    def bench_fanout(self, sizes, iterations):
+        """One notification to every member's user group: per-user loop vs group_send_many."""
+        async_to_sync(self._bench_fanout)(sizes, iterations)
+
+    async def _bench_fanout(self, sizes, iterations):
+        layer = get_channel_layer()
+        event = {"type": "new_message_notification", "message": {"id": 1, "content": "x" * 200}, "room_id": 1}
+        for size in sizes:
+            groups = user_groups(range(size))
+            channels = []
+            for group in groups:
+                channel = await layer.new_channel()
+                await layer.group_add(group, channel)
+                channels.append(channel)
+
+            async def drain():
+                for channel in channels:
+                    await layer.receive(channel)
+
+            for label, send in (
+                ("loop", lambda: self._send_each(layer, groups, event)),
+                ("batched", lambda: group_send_many(layer, groups, event)),
+            ):
+                timings = []
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    await send()
+                    timings.append(time.perf_counter() - start)
+                    await drain()
+                self.report(f"{size} {label}", timings, 0)
+            await layer.flush()
+
+    @staticmethod
+    async def _send_each(layer, groups, event):
+        for group in groups:
+            await layer.group_send(group, event)
+
+    def bench_roomlist(self, sizes, iterations):
+        """GET /api/chat/rooms/ for a user with N private chats, each with a message."""
+        view = UserChatRoomsView.as_view()
+        factory = APIRequestFactory()
+        for count in sizes:
+            me, *others = self.make_users(count + 1)
+            for other in others:
+                room = ChatRoom.objects.create(room_type="private")
+                ChatParticipant.objects.bulk_create([
+                    ChatParticipant(chat_room=room, user=me),
+                    ChatParticipant(chat_room=room, user=other),
+                ])
+                record_new_message(Message.objects.create(chat_room=room, sender=other, content="hello"))
+            timings = []
+            with CaptureQueriesContext(connection) as ctx:
+                for _ in range(iterations):
+                    request = factory.get("/api/chat/rooms/", {"page_size": count}, SERVER_NAME="localhost")
+                    force_authenticate(request, user=me)
+                    start = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    timings.append(time.perf_counter() - start)
+            self.report(f"{count} rooms", timings, len(ctx.captured_queries))
+
+    def bench_history(self, sizes, iterations, page_size=50):
+        """
+        One page of room history at the newest, middle and oldest end, by page
+        number (OFFSET) and by keyset cursor. Try e.g. --sizes 10000,1000000.
+        """
+        view = RoomMessagesView.as_view()
+        factory = APIRequestFactory()
+        for size in sizes:
+            users = self.make_users(2)
+            room = self.make_room(users)
+            for start in range(0, size, 10000):
+                Message.objects.bulk_create(
+                    Message(chat_room=room, sender=users[i % 2], content=f"message {i}")
+                    for i in range(start, min(start + 10000, size))
+                )
+            newest_first = Message.objects.filter(chat_room=room).order_by("-created_at", "-id")
+            pages = max(1, -(-size // page_size))
+            for depth, page in (("newest", 1), ("middle", (pages + 1) // 2), ("oldest", pages)):
+                offset = (page - 1) * page_size
+                before = "" if not offset else MessageCursorPagination.encode_cursor(newest_first[offset - 1])
+                for label, params in (
+                    ("page", {"page": page, "page_size": page_size}),
+                    ("cursor", {"before": before, "page_size": page_size}),
+                ):
+                    timings = []
+                    reset_queries()  # the bulk insert above fills the query log
+                    with CaptureQueriesContext(connection) as ctx:
+                        for _ in range(iterations):
+                            request = factory.get("/", params, SERVER_NAME="localhost")
+                            force_authenticate(request, user=users[0])
+                            start = time.perf_counter()
+                            response = view(request, room_id=room.id)
+                            response.render()
+                            timings.append(time.perf_counter() - start)
+                    self.report(f"{size} {depth} {label}", timings, len(ctx.captured_queries))
+
+    def bench_search(self, sizes, iterations, rooms=50):
+        """
+        Search latency over a synthetic corpus spread across `rooms` rooms, for
+        each index backend and for the old icontains scan. Multi-million
+        corpora take a while to generate: try --sizes 100000,2000000.
+        """
+        rng = random.Random(42)
+        syllables = ["ka", "lo", "mi", "ra", "te", "sun", "vel", "dor", "pi", "an", "qu", "zo"]
+        vocab = sorted({"".join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(20000)})
+        rng.shuffle(vocab)
+        weights = [1 / (rank + 1) for rank in range(len(vocab))]  # Zipf-ish word frequencies
+        queries = {
+            "common": vocab[0],
+            "rare": vocab[-1],
+            "prefix": vocab[3][:3],
+            "two words": f"{vocab[2]} {vocab[40]}",
+        }
+        for size in sizes:
+            users = self.make_users(2)
+            room_ids = [self.make_room(users).id for _ in range(rooms)]
+            for start in range(0, size, 10000):
+                Message.objects.bulk_create(
+                    Message(chat_room_id=room_ids[i % rooms], sender=users[i % 2],
+                            content=" ".join(rng.choices(vocab, weights, k=rng.randint(3, 15))))
+                    for i in range(start, min(start + 10000, size))
+                )
+            room_id = room_ids[0]
+            for backend in ("fts5", "postings"):
+                with override_settings(CHAT_SEARCH_BACKEND=backend):
+                    if backend == "fts5" and not search.fts5_available():
+                        continue
+                    started = time.perf_counter()
+                    search.rebuild()
+                    self.stdout.write(f"{size} messages: {backend} index built in {time.perf_counter() - started:.1f} s")
+                    for name, query in queries.items():
+                        for scope, scoped_room in (("room", room_id), ("all", None)):
+                            timings = []
+                            reset_queries()
+                            with CaptureQueriesContext(connection) as ctx:
+                                for _ in range(iterations):
+                                    start = time.perf_counter()
+                                    search.search_messages(users[0], query, room_id=scoped_room, limit=20)
+                                    timings.append(time.perf_counter() - start)
+                            self.report(f"{backend} {name} {scope}", timings, len(ctx.captured_queries))
+                    search.get_index().clear()
+            # The old SearchMessagesView: a substring scan, newest first, unranked.
+            for name, query in queries.items():
+                for scope, rooms_filter in (("room", {"chat_room_id": room_id}), ("all", {"chat_room_id__in": room_ids})):
+                    timings = []
+                    for _ in range(min(iterations, 5)):
+                        start = time.perf_counter()
+                        list(Message.objects.filter(content__icontains=query, is_deleted=False, **rooms_filter)
+                             .order_by("-created_at").values_list("id", flat=True)[:20])
+                        timings.append(time.perf_counter() - start)
+                    self.report(f"icontains {name} {scope}", timings, 0)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.chat.search import get_index, rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the message search index from scratch (e.g. after changing CHAT_SEARCH_BACKEND)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild(options["batch_size"])
+        self.stdout.write(f"Indexed {count} message(s) into the {get_index().name} index.")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.chat.read_state import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the denormalized inbox counters (each room's last message and "
+        "each participant's unread count) from the messages, fixing any drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("room_ids", nargs="*", type=int,
+                            help="Only reconcile these rooms (default: all).")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rooms, participants = reconcile_counters(options["room_ids"] or None)
+        self.stdout.write(f"Fixed {rooms} room(s) and {participants} participant(s).")
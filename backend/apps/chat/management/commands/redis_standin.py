@@ -0,0 +1,23 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from apps.chat.redis_standin import serve
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the in-process Redis stand-in so several Daphne workers can share a "
+        "channel layer and presence state locally (set REDIS_URL to point at it)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=6379)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Redis stand-in on redis://{options['host']}:{options['port']}/0")
+        try:
+            asyncio.run(serve(options["host"], options["port"]))
+        except KeyboardInterrupt:
+            pass
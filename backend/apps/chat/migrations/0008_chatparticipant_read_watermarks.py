@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:04
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_watermarks(apps, schema_editor):
+    """Derive each participant's watermarks from the legacy MessageReadStatus rows."""
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    MessageReadStatus = apps.get_model('chat', 'MessageReadStatus')
+
+    def highest(condition):
+        rows = MessageReadStatus.objects.filter(
+            condition,
+            user_id=OuterRef('user_id'),
+            message__chat_room_id=OuterRef('chat_room_id'),
+        ).values('user_id').annotate(top=Max('message_id')).values('top')
+        return Coalesce(Subquery(rows[:1]), Value(0))
+
+    ChatParticipant.objects.update(
+        last_read_message_id=highest(Q(is_read=True)),
+        last_delivered_message_id=highest(Q(is_read=True) | Q(is_delivered=True)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatroom_pinned_messages_message_duration_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_delivered_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
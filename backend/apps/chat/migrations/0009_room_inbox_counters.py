@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def backfill_counters(apps, schema_editor):
+    """Fill in each room's last message and each participant's unread count."""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    Message = apps.get_model('chat', 'Message')
+
+    newest = Message.objects.filter(chat_room_id=OuterRef('pk')).order_by('-id')
+    ChatRoom.objects.update(
+        last_message_id=Subquery(newest.values('id')[:1]),
+        last_message_preview=Substr(Subquery(newest.values('content')[:1]), 1, 255),
+        last_message_at=Subquery(newest.values('created_at')[:1]),
+    )
+    unread = (
+        Message.objects.filter(
+            chat_room_id=OuterRef('chat_room_id'),
+            id__gt=OuterRef('last_read_message_id'),
+            is_deleted=False,
+        )
+        .exclude(sender_id=OuterRef('user_id'))
+        .values('chat_room_id')
+        .annotate(total=Count('id'))
+        .values('total')
+    )
+    ChatParticipant.objects.update(
+        unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), Value(0))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chatparticipant_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
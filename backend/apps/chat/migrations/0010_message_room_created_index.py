@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_room_inbox_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_room', 'created_at', 'id'], name='chat_msg_room_created_id'),
+        ),
+    ]
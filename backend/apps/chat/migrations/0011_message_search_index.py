@@ -0,0 +1,97 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:29
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import OperationalError, migrations, models
+
+FTS_TABLE = 'chat_message_fts'
+MAX_TERM_LENGTH = 64
+WORD = re.compile(r'[^\W_]+')
+
+
+def tokenize(text):
+    """
+    A frozen copy of apps.chat.search.tokenize as it was when this migration
+    was written, so later changes to the tokenizer don't change what it builds.
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [word[:MAX_TERM_LENGTH] for word in WORD.findall(text)]
+
+
+def build_search_index(apps, schema_editor):
+    """
+    On SQLite create the FTS5 table and fill it; elsewhere (or if SQLite was
+    built without FTS5) fill the postings table instead.
+    """
+    Message = apps.get_model('chat', 'Message')
+    MessagePosting = apps.get_model('chat', 'MessagePosting')
+    searchable = Message.objects.filter(message_type='text', is_deleted=False).exclude(
+        content__isnull=True).exclude(content='')
+
+    if schema_editor.connection.vendor == 'sqlite':
+        try:
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                "content, chat_room_id UNINDEXED, "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+        except OperationalError:
+            pass
+        else:
+            schema_editor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, content, chat_room_id) "
+                "SELECT id, content, chat_room_id FROM chat_message "
+                "WHERE message_type = 'text' AND NOT is_deleted "
+                "AND content IS NOT NULL AND content != ''"
+            )
+            return
+
+    postings = []
+    for message in searchable.only('id', 'chat_room_id', 'content').iterator(chunk_size=2000):
+        counts = {}
+        for term in tokenize(message.content):
+            counts[term] = counts.get(term, 0) + 1
+        postings.extend(
+            MessagePosting(term=term, message_id=message.id, chat_room_id=message.chat_room_id,
+                           frequency=min(count, 32767))
+            for term, count in counts.items()
+        )
+        if len(postings) >= 5000:
+            MessagePosting.objects.bulk_create(postings)
+            postings = []
+    MessagePosting.objects.bulk_create(postings)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_room_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessagePosting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('frequency', models.PositiveSmallIntegerField(default=1)),
+                ('chat_room', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='chat.chatroom')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.message')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'chat_room'], name='chat_posting_term_room')],
+                'unique_together': {('message', 'term')},
+            },
+        ),
+        migrations.RunPython(build_search_index, drop_search_index),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('start_message_id', models.BigIntegerField()),
+                ('end_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('summary', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='chat.chatroom')),
+            ],
+            options={
+                'unique_together': {('chat_room', 'level', 'start_message_id')},
+            },
+        ),
+    ]
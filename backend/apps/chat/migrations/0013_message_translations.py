@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_room_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='translations',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -16,6 +16,11 @@ class ChatRoom(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     pinned_messages = models.ManyToManyField('Message', related_name='pinned_in_rooms', blank=True)
+    # Denormalized copy of the newest message for the inbox, kept up to date by
+    # read_state and repairable with ``manage.py reconcile_chat_counters``.
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_preview = models.CharField(max_length=255, null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         if self.room_type == "private":
@@ -26,6 +31,12 @@ class ChatParticipant(models.Model):
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="participants")
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     joined_at = models.DateTimeField(auto_now_add=True)
+    # Read-state watermarks: every message in the room with an id at or below
+    # these values counts as delivered to / read by this participant.
+    last_delivered_message_id = models.BigIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(default=0)
+    # Messages from others above last_read_message_id that are not deleted.
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("chat_room", "user")
@@ -54,12 +65,54 @@ class Message(models.Model):
     file_name = models.CharField(max_length=255, null=True, blank=True)
     file_size = models.IntegerField(null=True, blank=True)
     mime_type = models.CharField(max_length=100, null=True, blank=True)
+    # {language: text}, filled in at send time when CHAT_PRETRANSLATE is on.
+    translations = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of room history (MessageCursorPagination).
+            models.Index(fields=["chat_room", "created_at", "id"], name="chat_msg_room_created_id"),
+        ]
+
     def __str__(self):
         return f"Message {self.id} in Room {self.chat_room.id}"
 
+class MessagePosting(models.Model):
+    # Inverted index for message search on databases without a native
+    # full-text engine (SQLite uses FTS5 instead). See apps.chat.search.
+    term = models.CharField(max_length=64)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="+")
+    # Only ever filtered together with a term, via the index below. No index of
+    # its own, so the planner never scans a whole room's postings; rows are
+    # deleted along with their message.
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.DO_NOTHING, db_index=False, related_name="+")
+    frequency = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        unique_together = ("message", "term")
+        indexes = [
+            models.Index(fields=["term", "chat_room"], name="chat_posting_term_room"),
+        ]
+
+class RoomSummary(models.Model):
+    # One node of a room's summary tree (see apps.chat.summaries): level 0
+    # summarizes a block of messages, level n merges consecutive level n-1
+    # nodes. Both cover the message ids start..end inclusive.
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="summaries")
+    level = models.PositiveSmallIntegerField()
+    start_message_id = models.BigIntegerField()
+    end_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    summary = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("chat_room", "level", "start_message_id")
+
 class MessageReadStatus(models.Model):
+    # Legacy per-message read state, superseded by the ChatParticipant
+    # watermarks. Kept so existing data can be migrated and inspected.
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="read_status")
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     is_read = models.BooleanField(default=False)
@@ -1,8 +1,102 @@
 # pagination.py
 
-from rest_framework.pagination import PageNumberPagination
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class ChatPagination(PageNumberPagination):
     page_size = 20
     page_size_query_param = "page_size"
     max_page_size = 100
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over ``(created_at, id)``, newest first.
+
+    ``?before=<cursor>`` returns the page just older than the cursor and
+    ``?after=<cursor>`` the page just newer; an empty ``before=`` starts at the
+    newest message. Each page is an index range scan on
+    ``Message(chat_room, created_at, id)``, so deep history costs the same as
+    the first page and pages do not shift when new messages arrive.
+    """
+    page_size = ChatPagination.page_size
+    page_size_query_param = ChatPagination.page_size_query_param
+    max_page_size = ChatPagination.max_page_size
+    directions = ("before", "after")
+
+    @classmethod
+    def requested(cls, request):
+        return any(direction in request.query_params for direction in cls.directions)
+
+    @staticmethod
+    def encode_cursor(message):
+        raw = f"{message.created_at.isoformat()}|{message.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            created_at, message_id = raw.rsplit("|", 1)
+            return datetime.fromisoformat(created_at), int(message_id)
+        except (ValueError, UnicodeDecodeError):
+            raise ValidationError({"cursor": "Invalid cursor."})
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        size = self.get_page_size(request)
+        self.after = request.query_params.get("after") or None
+        self.before = None if self.after else request.query_params.get("before") or None
+
+        # Row-value comparison on (created_at, id), spelled with a plain range
+        # on created_at first so every backend can seek the index to it.
+        if self.after:
+            created_at, message_id = self.decode_cursor(self.after)
+            rows = queryset.filter(
+                Q(created_at__gt=created_at) | Q(id__gt=message_id), created_at__gte=created_at
+            ).order_by("created_at", "id")
+        else:
+            rows = queryset.order_by("-created_at", "-id")
+            if self.before:
+                created_at, message_id = self.decode_cursor(self.before)
+                rows = rows.filter(
+                    Q(created_at__lt=created_at) | Q(id__lt=message_id), created_at__lte=created_at
+                )
+
+        page = list(rows[:size + 1])
+        self.has_more = len(page) > size
+        page = page[:size]
+        if self.after:
+            page.reverse()
+        self.page = page
+        return page
+
+    def _link(self, direction, message):
+        url = self.request.build_absolute_uri()
+        for other in self.directions:
+            url = remove_query_param(url, other)
+        return replace_query_param(url, direction, self.encode_cursor(message))
+
+    def get_paginated_response(self, data):
+        older = newer = None
+        if self.page:
+            # The side we came from is known to exist; the far side exists if
+            # we over-fetched.
+            if self.after or self.has_more:
+                older = self._link("before", self.page[-1])
+            if self.before or (self.after and self.has_more):
+                newer = self._link("after", self.page[0])
+        return Response({"next": older, "previous": newer, "results": data})
@@ -0,0 +1,278 @@
+"""
+Who is online, shared across workers.
+
+Connection counts per user live in a Django cache (``PRESENCE_CACHE``). With
+the default local-memory cache that is per process, which is fine for a single
+Daphne worker; point it at the Redis cache (see ``REDIS_URL`` in settings) and
+every worker on every node sees the same counts.
+
+``PresenceService`` turns those counts into what clients see. A user who
+drops their last connection is only announced offline after
+``PRESENCE_OFFLINE_GRACE`` seconds, and only if they have not come back (on
+any worker) by then, so a flapping mobile connection produces no events at
+all. Announcements are queued per recipient (the user's related users) and
+sent every ``PRESENCE_BATCH_WINDOW`` seconds as one ``presence_batch`` event,
+in which a user who came and went within the window appears once, in their
+latest state.
+
+``PresenceStateStore`` keeps last-seen times in the same cache and writes
+them, with the announced online state, to the User table behind the scenes:
+changes are collected for ``LAST_SEEN_FLUSH_INTERVAL`` seconds and saved in a
+batch. ``lookup`` answers "online? last seen?" for a page of users from one
+cache read.
+"""
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from .fanout import group_send_many, user_groups
+
+
+class PresenceRegistry:
+    key_prefix = "presence:connections:"
+
+    def __init__(self, cache=None):
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache or caches[getattr(settings, "PRESENCE_CACHE", "default")]
+
+    @property
+    def ttl(self):
+        # Counts expire eventually so a crashed worker cannot pin users online forever.
+        return getattr(settings, "PRESENCE_TTL", 60 * 60 * 24)
+
+    def _key(self, user_id):
+        return f"{self.key_prefix}{user_id}"
+
+    async def connect(self, user_id):
+        """Register a connection. Returns True if it is the user's first one."""
+        key = self._key(user_id)
+        if await self.cache.aadd(key, 1, self.ttl):
+            return True
+        try:
+            count = await self.cache.aincr(key)
+        except ValueError:
+            # Expired between add() and incr().
+            await self.cache.aset(key, 1, self.ttl)
+            return True
+        await self.cache.atouch(key, self.ttl)
+        return count == 1
+
+    async def disconnect(self, user_id):
+        """Drop a connection. Returns True if it was the user's last one."""
+        key = self._key(user_id)
+        try:
+            count = await self.cache.adecr(key)
+        except ValueError:
+            return True
+        if count < 0:
+            await self.cache.aset(key, 0, self.ttl)
+        # Zero counts are left to expire rather than deleted, so a concurrent
+        # connect() on another worker never loses its increment.
+        return count <= 0
+
+    async def online_user_ids(self, user_ids):
+        keys = {self._key(uid): uid for uid in user_ids}
+        counts = await self.cache.aget_many(list(keys))
+        return {keys[key] for key, count in counts.items() if count and count > 0}
+
+    async def is_online(self, user_id):
+        return bool(await self.online_user_ids([user_id]))
+
+
+presence_registry = PresenceRegistry()
+
+
+class PresenceStateStore:
+    last_seen_prefix = "presence:last_seen:"
+
+    def __init__(self, registry=presence_registry, interval=None):
+        self.registry = registry
+        self._interval = interval
+        self._dirty = {}  # user_id -> {field: value} not yet saved
+        self._flush = None
+
+    @property
+    def interval(self):
+        return self._interval if self._interval is not None else getattr(settings, "LAST_SEEN_FLUSH_INTERVAL", 30)
+
+    def _last_seen_key(self, user_id):
+        return f"{self.last_seen_prefix}{user_id}"
+
+    async def went_online(self, user_id):
+        self._mark(user_id, is_online=True)
+
+    async def went_offline(self, user_id):
+        self._mark(user_id, is_online=False)
+
+    async def seen(self, user_id, when):
+        """The user's last connection closed at ``when``."""
+        await self.registry.cache.aset(self._last_seen_key(user_id), when, self.registry.ttl)
+        self._mark(user_id, last_seen=when)
+
+    def _mark(self, user_id, **fields):
+        self._dirty.setdefault(user_id, {}).update(fields)
+        if self._flush is None:
+            self._flush = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.interval)
+            self._flush = None
+            await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Saving presence state failed: {e}")
+
+    async def flush(self):
+        """Save every pending change now; failed changes are kept for the next flush."""
+        pending, self._dirty = self._dirty, {}
+        if not pending:
+            return
+        try:
+            await database_sync_to_async(self.save)(pending)
+        except Exception:
+            for user_id, fields in pending.items():
+                self._dirty[user_id] = {**fields, **self._dirty.get(user_id, {})}
+            if self._flush is None:
+                self._flush = asyncio.create_task(self._flush_later())
+            raise
+        print(f"🕒 Saved presence state for {len(pending)} user(s)")
+
+    def save(self, pending):
+        User = get_user_model()
+        by_fields = {}
+        for user_id, fields in pending.items():
+            by_fields.setdefault(tuple(sorted(fields)), []).append(User(id=user_id, **fields))
+        with transaction.atomic():
+            for fields, users in by_fields.items():
+                User.objects.bulk_update(users, fields, batch_size=500)
+
+    def lookup(self, user_ids):
+        """``{user_id: {"is_online": bool, "last_seen": datetime | None}}`` from the cache alone."""
+        user_ids = list(user_ids)
+        count_keys = {self.registry._key(uid): uid for uid in user_ids}
+        seen_keys = {self._last_seen_key(uid): uid for uid in user_ids}
+        values = self.registry.cache.get_many([*count_keys, *seen_keys])
+        state = {uid: {"is_online": False, "last_seen": None} for uid in user_ids}
+        for key, value in values.items():
+            if key in count_keys:
+                state[count_keys[key]]["is_online"] = bool(value and value > 0)
+            else:
+                state[seen_keys[key]]["last_seen"] = value
+        return state
+
+
+presence_state = PresenceStateStore()
+
+
+class PresenceService:
+    # The state last announced for a user, shared like the counts so that
+    # workers do not repeat each other's announcements.
+    announced_prefix = "presence:announced:"
+
+    def __init__(self, registry=presence_registry, grace=None, window=None, state=presence_state):
+        self.registry = registry
+        self.state = state
+        self._grace = grace
+        self._window = window
+        self.channel_layer = None
+        self._offline_timers = {}  # user_id -> task
+        self._pending = {}  # recipient_id -> {user_id: is_online}
+        self._flush = None
+
+    @property
+    def grace(self):
+        return self._grace if self._grace is not None else getattr(settings, "PRESENCE_OFFLINE_GRACE", 5)
+
+    @property
+    def window(self):
+        return self._window if self._window is not None else getattr(settings, "PRESENCE_BATCH_WINDOW", 1.0)
+
+    async def connected(self, channel_layer, user_id, related_ids):
+        """Register a connection. Returns which of ``related_ids`` are online, for the snapshot."""
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        if await self.registry.connect(user_id) and await self._announce(user_id, True):
+            self.queue(channel_layer, user_id, True, related_ids)
+            await self.state.went_online(user_id)
+        return await self.registry.online_user_ids(related_ids)
+
+    async def disconnected(self, channel_layer, user_id, related_ids):
+        """Drop a connection. Returns True if it was the user's last one."""
+        is_last = await self.registry.disconnect(user_id)
+        if is_last:
+            await self.state.seen(user_id, timezone.now())
+        if is_last and user_id not in self._offline_timers:
+            self._offline_timers[user_id] = asyncio.create_task(
+                self._offline_later(channel_layer, user_id, related_ids)
+            )
+        return is_last
+
+    async def _offline_later(self, channel_layer, user_id, related_ids):
+        try:
+            await asyncio.sleep(self.grace)
+            self._offline_timers.pop(user_id, None)
+            if not await self.registry.is_online(user_id) and await self._announce(user_id, False):
+                self.queue(channel_layer, user_id, False, related_ids)
+                await self.state.went_offline(user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._offline_timers.pop(user_id, None)
+            print(f"❌ Presence update for user {user_id} failed: {e}")
+
+    async def _announce(self, user_id, is_online):
+        """Record ``is_online`` as announced. False if that was already the announced state."""
+        key = f"{self.announced_prefix}{user_id}"
+        cache = self.registry.cache
+        if await cache.aget(key) == int(is_online):
+            return False
+        await cache.aset(key, int(is_online), self.registry.ttl)
+        return True
+
+    def queue(self, channel_layer, user_id, is_online, recipient_ids):
+        self.channel_layer = channel_layer
+        for recipient_id in recipient_ids:
+            if recipient_id != user_id:
+                self._pending.setdefault(recipient_id, {})[user_id] = is_online
+        if self._pending and self._flush is None:
+            self._flush = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+            self._flush = None
+            await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Presence fan-out failed: {e}")
+
+    async def flush(self):
+        """Send every queued change now: one event per recipient, one fan-out per distinct event."""
+        pending, self._pending = self._pending, {}
+        by_change = {}
+        for recipient_id, changes in pending.items():
+            online = tuple(sorted(uid for uid, state in changes.items() if state))
+            offline = tuple(sorted(uid for uid, state in changes.items() if not state))
+            by_change.setdefault((online, offline), []).append(recipient_id)
+        await asyncio.gather(*(
+            group_send_many(self.channel_layer, user_groups(recipients),
+                            {"type": "presence_batch", "online": list(online), "offline": list(offline)})
+            for (online, offline), recipients in by_change.items()
+        ))
+        if pending:
+            print(f"🌍 Sent presence changes to {len(pending)} user(s) in {len(by_change)} fan-out(s)")
+
+
+presence_service = PresenceService()
@@ -0,0 +1,92 @@
+"""
+Send-time translation of chat messages.
+
+With ``CHAT_PRETRANSLATE`` on, a text message is translated once into each
+language its room's participants read (other than the sender's) as soon as
+the consumer receives it, so the provider call overlaps saving the message.
+The ``chat_message`` broadcast is never held back for it: translations that
+are already done by then (cache hits, typically) go out with it, and the rest
+follow as a ``message_translated`` event. All of them are stored in
+``Message.translations``, so history pages carry them too and readers never
+have to ask for a translation.
+"""
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from apps.ai.translation import translate_text
+
+from .models import Message
+
+# Keeps fire-and-forget completion tasks alive until they finish.
+_background = set()
+
+
+def target_languages(languages, source_lang):
+    return sorted({lang for lang in languages if lang and lang != source_lang})
+
+
+class PreTranslation:
+    def __init__(self, text, languages, source_lang, translate=translate_text):
+        self.text = text
+        self.tasks = {lang: asyncio.create_task(translate(text, lang, source_lang)) for lang in languages}
+
+    @classmethod
+    def start(cls, text, languages, source_lang, message_type="text"):
+        """Start translating ``text``, or return None when there is nothing to do."""
+        if not getattr(settings, "CHAT_PRETRANSLATE", False) or message_type != "text" or not text:
+            return None
+        targets = target_languages(languages, source_lang)
+        return cls(text, targets, source_lang) if targets else None
+
+    def ready(self):
+        """``{language: text}`` for the translations that have finished."""
+        translations = {}
+        for lang, task in self.tasks.items():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                result = task.result()
+                # translate_text hands back the original text when it fails.
+                if result and result != self.text:
+                    translations[lang] = result
+        return translations
+
+    def cancel(self):
+        """
+        Stop translating, e.g. because the message could not be saved. Texts
+        still waiting for their batch are left out of it; a provider request
+        that has already gone out is not.
+        """
+        for task in self.tasks.values():
+            task.cancel()
+
+    def complete(self, channel_layer, group_name, message_id, sent):
+        """In the background: store every translation, and send those not already in ``sent``."""
+        task = asyncio.create_task(self._complete(channel_layer, group_name, message_id, sent))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+        return task
+
+    async def _complete(self, channel_layer, group_name, message_id, sent):
+        try:
+            await asyncio.wait(self.tasks.values())
+            translations = self.ready()
+            if not translations:
+                return
+            await store_translations(message_id, translations)
+            late = {lang: text for lang, text in translations.items() if lang not in sent}
+            if late:
+                await channel_layer.group_send(group_name, {
+                    "type": "message_translated",
+                    "message_id": message_id,
+                    "translations": late,
+                })
+            print(f"🌐 Message {message_id} translated into {', '.join(sorted(translations))}")
+        except Exception as e:
+            print(f"❌ Pre-translation of message {message_id} failed: {e}")
+
+
+@database_sync_to_async
+def store_translations(message_id, translations):
+    # A message edited or deleted in the meantime has had its translations cleared.
+    Message.objects.filter(id=message_id, edited=False, is_deleted=False).update(translations=translations)
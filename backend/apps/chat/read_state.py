@@ -0,0 +1,192 @@
+"""
+Read/delivery state for chat messages.
+
+Each ChatParticipant carries two watermarks, ``last_delivered_message_id`` and
+``last_read_message_id``. Every message in the room with an id at or below a
+watermark counts as delivered/read for that participant, so marking messages
+is a single-row UPDATE and unread counts are a range count on Message.
+
+The inbox does not count anything per request, though: ChatParticipant keeps an
+``unread_count`` and ChatRoom a copy of its newest message. The send, read,
+edit and delete paths below keep both current, and ``reconcile_counters``
+rebuilds them from the messages if they ever drift.
+"""
+from django.db.models import (
+    BigIntegerField, Case, Count, Exists, F, IntegerField, Min, OuterRef, Subquery, Value, When,
+)
+from django.db.models.functions import Coalesce, Greatest, Substr
+from django.utils import timezone
+
+from .models import ChatRoom, ChatParticipant, Message
+
+
+PREVIEW_LENGTH = ChatRoom._meta.get_field("last_message_preview").max_length
+
+
+def preview_of(content):
+    return content[:PREVIEW_LENGTH] if content is not None else None
+
+
+def record_new_message(message):
+    """
+    Advance the sender's watermarks to a freshly created message, count it as
+    unread for everyone else and make it the room's last message. Costs three
+    UPDATEs no matter how many members the room has. Call inside a transaction.
+    """
+    participants = ChatParticipant.objects.filter(chat_room_id=message.chat_room_id)
+    participants.filter(user_id=message.sender_id).update(
+        last_read_message_id=Greatest(F("last_read_message_id"), Value(message.id)),
+        last_delivered_message_id=Greatest(F("last_delivered_message_id"), Value(message.id)),
+        unread_count=0,
+    )
+    participants.exclude(user_id=message.sender_id).filter(
+        last_read_message_id__lt=message.id
+    ).update(unread_count=F("unread_count") + 1)
+    ChatRoom.objects.filter(id=message.chat_room_id).update(
+        updated_at=timezone.now(),
+        last_message_id=message.id,
+        last_message_preview=preview_of(message.content),
+        last_message_at=message.created_at,
+    )
+
+
+def record_edited_message(message):
+    """Refresh the room's preview if the edited message is its last one."""
+    ChatRoom.objects.filter(id=message.chat_room_id, last_message_id=message.id).update(
+        last_message_preview=preview_of(message.content)
+    )
+
+
+def record_deleted_message(message):
+    """
+    Account for a message that has just been soft-deleted: it no longer counts
+    as unread for anyone who had not read it, and the room preview is cleared
+    if it was the last message. Call once, when is_deleted flips to True.
+    """
+    ChatParticipant.objects.filter(
+        chat_room_id=message.chat_room_id, last_read_message_id__lt=message.id, unread_count__gt=0
+    ).exclude(user_id=message.sender_id).update(unread_count=F("unread_count") - 1)
+    record_edited_message(message)
+
+
+def _message_in_room(message_id):
+    return Exists(Message.objects.filter(id=message_id, chat_room_id=OuterRef("chat_room_id")))
+
+
+def _unread_after(watermark, user_id):
+    """Count of live messages from others in the outer participant's room above watermark."""
+    unread = (
+        Message.objects.filter(chat_room_id=OuterRef("chat_room_id"), id__gt=watermark, is_deleted=False)
+        .exclude(sender_id=user_id)
+        .values("chat_room_id")
+        .annotate(total=Count("id"))
+        .values("total")
+    )
+    return Coalesce(Subquery(unread, output_field=IntegerField()), Value(0))
+
+
+def mark_read(user_id, room_id, message_id):
+    """
+    Mark everything up to message_id in the room as read (and delivered). The
+    unread counter is recounted over the messages above the new watermark,
+    which is usually none, so it stays exact without a full scan.
+    """
+    return ChatParticipant.objects.filter(
+        _message_in_room(message_id),
+        chat_room_id=room_id, user_id=user_id, last_read_message_id__lt=message_id,
+    ).update(
+        last_read_message_id=message_id,
+        last_delivered_message_id=Greatest(F("last_delivered_message_id"), Value(message_id)),
+        unread_count=_unread_after(Value(message_id), user_id),
+    )
+
+
+def mark_delivered_many(user_id, room_marks):
+    """
+    Advance the delivery watermark in several rooms at once, given a
+    ``{room_id: message_id}`` mapping. One UPDATE regardless of room count.
+    """
+    if not room_marks:
+        return 0
+    new_mark = Case(
+        *(When(chat_room_id=room_id, then=Value(message_id)) for room_id, message_id in room_marks.items()),
+        default=F("last_delivered_message_id"),
+        output_field=BigIntegerField(),
+    )
+    return ChatParticipant.objects.filter(user_id=user_id, chat_room_id__in=list(room_marks)).update(
+        last_delivered_message_id=Greatest(F("last_delivered_message_id"), new_mark)
+    )
+
+
+def deliver_pending(user):
+    """
+    Advance the user's delivery watermark in every room and return the
+    ``(message_id, sender_id)`` pairs that had not been delivered yet.
+    """
+    pending = list(
+        Message.objects.filter(
+            chat_room__participants__user=user,
+            id__gt=F("chat_room__participants__last_delivered_message_id"),
+        ).exclude(sender=user).order_by("id").values_list("id", "sender_id")
+    )
+    if pending:
+        # Only advance as far as what was fetched, so a message that lands
+        # between the SELECT and the UPDATE still gets a receipt later.
+        high = pending[-1][0]
+        newest = Message.objects.filter(
+            chat_room_id=OuterRef("chat_room_id"), id__lte=high
+        ).order_by("-id").values("id")[:1]
+        ChatParticipant.objects.filter(user=user).update(
+            last_delivered_message_id=Greatest(
+                F("last_delivered_message_id"), Coalesce(Subquery(newest), Value(0))
+            )
+        )
+    return pending
+
+
+def reconcile_counters(room_ids=None):
+    """
+    Recompute every denormalized counter from the messages themselves, for all
+    rooms or just ``room_ids``. Returns ``(rooms_fixed, participants_fixed)``.
+    """
+    rooms = ChatRoom.objects.all()
+    participants = ChatParticipant.objects.all()
+    if room_ids is not None:
+        rooms = rooms.filter(id__in=room_ids)
+        participants = participants.filter(chat_room_id__in=room_ids)
+
+    newest = Message.objects.filter(chat_room_id=OuterRef("pk")).order_by("-id")
+    expected_room = {
+        "last_message_id": Subquery(newest.values("id")[:1]),
+        "last_message_preview": Substr(Subquery(newest.values("content")[:1]), 1, PREVIEW_LENGTH),
+        "last_message_at": Subquery(newest.values("created_at")[:1]),
+    }
+    drifted_rooms = rooms.annotate(**{f"expected_{k}": v for k, v in expected_room.items()})
+    drifted_rooms = [
+        room.id for room in drifted_rooms
+        if any(getattr(room, field) != getattr(room, f"expected_{field}") for field in expected_room)
+    ]
+    if drifted_rooms:
+        ChatRoom.objects.filter(id__in=drifted_rooms).update(**expected_room)
+
+    expected_unread = _unread_after(OuterRef("last_read_message_id"), OuterRef("user_id"))
+    drifted = list(
+        participants.annotate(expected=expected_unread)
+        .exclude(unread_count=F("expected")).values_list("id", flat=True)
+    )
+    if drifted:
+        ChatParticipant.objects.filter(id__in=drifted).update(
+            unread_count=_unread_after(OuterRef("last_read_message_id"), OuterRef("user_id"))
+        )
+    return len(drifted_rooms), len(drifted)
+
+
+def room_watermarks(room_id, exclude_user):
+    """
+    The lowest delivered/read watermarks among the room's other participants,
+    i.e. the highest message ids that everyone else has received and read.
+    """
+    marks = ChatParticipant.objects.filter(chat_room_id=room_id).exclude(user=exclude_user).aggregate(
+        delivered=Min("last_delivered_message_id"), read=Min("last_read_message_id")
+    )
+    return marks["delivered"] or 0, marks["read"] or 0
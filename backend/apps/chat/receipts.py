@@ -0,0 +1,92 @@
+"""
+Coalesced delivery receipts.
+
+Each connection collects the messages it has delivered for a short window
+(``DELIVERY_RECEIPT_WINDOW`` seconds), then advances the recipient's delivery
+watermarks in one UPDATE and sends each sender a single
+``{"type": "delivered_receipts", "message_ids": [...]}`` event, instead of an
+UPDATE and an event per message.
+"""
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import read_state
+
+
+def group_by_sender(pairs):
+    """``[(message_id, sender_id), ...]`` -> ``{sender_id: [message_id, ...]}``."""
+    by_sender = {}
+    for message_id, sender_id in pairs:
+        by_sender.setdefault(sender_id, []).append(message_id)
+    return by_sender
+
+
+async def send_receipts(channel_layer, by_sender, delivered_to):
+    await asyncio.gather(*(
+        channel_layer.group_send(f"user_{sender_id}", {
+            "type": "delivered_receipts",
+            "message_ids": sorted(message_ids),
+            "delivered_to": delivered_to,
+        })
+        for sender_id, message_ids in by_sender.items()
+    ))
+
+
+class DeliveryReceiptBatcher:
+    def __init__(self, channel_layer, user, window=None):
+        self.channel_layer = channel_layer
+        self.user = user
+        self.window = window if window is not None else getattr(settings, "DELIVERY_RECEIPT_WINDOW", 0.25)
+        self.by_sender = {}
+        self.room_marks = {}
+        self._task = None
+
+    def add(self, sender_id, room_id, message_id):
+        if sender_id == self.user.id:
+            return
+        self.by_sender.setdefault(sender_id, set()).add(message_id)
+        room_id = int(room_id)
+        self.room_marks[room_id] = max(self.room_marks.get(room_id, 0), message_id)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+            self._task = None
+            await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Delivery receipts for {self.user.username} failed: {e}")
+
+    async def flush(self):
+        """Save and send everything buffered; receipts that could not be saved are kept for the next flush."""
+        by_sender, room_marks = self.by_sender, self.room_marks
+        self.by_sender, self.room_marks = {}, {}
+        if not by_sender:
+            return
+        try:
+            await database_sync_to_async(read_state.mark_delivered_many)(self.user.id, room_marks)
+        except Exception:
+            for sender_id, message_ids in by_sender.items():
+                self.by_sender.setdefault(sender_id, set()).update(message_ids)
+            for room_id, message_id in room_marks.items():
+                self.room_marks[room_id] = max(self.room_marks.get(room_id, 0), message_id)
+            if self._task is None:
+                self._task = asyncio.create_task(self._flush_later())
+            raise
+        await send_receipts(self.channel_layer, by_sender, self.user.username)
+
+    async def close(self):
+        """Cancel the pending timer and flush whatever is buffered; a failed flush is retried later."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # Don't cut the caller's disconnect handling short.
+            print(f"❌ Delivery receipts for {self.user.username} failed: {e}")
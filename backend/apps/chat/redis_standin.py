@@ -0,0 +1,240 @@
+"""
+A tiny in-process server that speaks enough of the Redis protocol (RESP2/3) for
+the pub/sub channel layer and the Redis cache backend used by presence.
+
+It exists so several Daphne workers can share one channel layer on a dev
+machine without installing Redis, and so the multi-worker paths can be tested.
+It is single-node, keeps everything in memory and is not meant for production.
+"""
+import asyncio
+import fnmatch
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RespError(Exception):
+    pass
+
+
+class Push(list):
+    """An out-of-band pub/sub frame: ``>`` under RESP3, a plain array under RESP2."""
+
+
+def encode(value, resp3=False):
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-" + str(value).encode() + b"\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+" + value.encode() + b"\r\n"
+    if isinstance(value, dict):
+        if not resp3:
+            return encode([item for pair in value.items() for item in pair])
+        return b"%%%d\r\n" % len(value) + b"".join(
+            encode(k, resp3) + encode(v, resp3) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        marker = b">" if resp3 and isinstance(value, Push) else b"*"
+        return marker + b"%d\r\n" % len(value) + b"".join(encode(v, resp3) for v in value)
+    return b"$%d\r\n" % len(value) + bytes(value) + b"\r\n"
+
+
+class RedisStandIn:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}  # channel -> {writer: speaks RESP3}
+        self.clients = set()
+
+    # ---------- server plumbing ----------
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()  # inline command, e.g. from telnet
+        args = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            length = int(header[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def handle_client(self, reader, writer):
+        client = {"resp3": False, "channels": set()}
+        self.clients.add(writer)
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].decode().upper()
+                if name in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                    writer.write(self.pubsub(name, args[1:], client, writer))
+                else:
+                    try:
+                        reply = self.hello(args[1:], client) if name == "HELLO" else self.dispatch(name, args[1:])
+                    except RespError as e:
+                        reply = e
+                    except (ValueError, IndexError):
+                        reply = RespError("ERR syntax error")
+                    writer.write(encode(reply, client["resp3"]))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            for channel in client["channels"]:
+                self.subscribers.get(channel, {}).pop(writer, None)
+            writer.close()
+
+    def hello(self, args, client):
+        version = int(args[0]) if args else 2
+        if version not in (2, 3):
+            raise RespError("NOPROTO unsupported protocol version")
+        client["resp3"] = version == 3
+        return {"server": "redis", "version": "7.0.0", "proto": version, "id": 1,
+                "mode": "standalone", "role": "master", "modules": []}
+
+    # ---------- pub/sub ----------
+
+    def pubsub(self, name, names, client, writer):
+        channels, out = client["channels"], []
+        if name == "SUBSCRIBE":
+            for channel in names:
+                channels.add(channel)
+                self.subscribers.setdefault(channel, {})[writer] = client["resp3"]
+                out.append(encode(Push([b"subscribe", channel, len(channels)]), client["resp3"]))
+        else:
+            for channel in names or list(channels) or [None]:
+                if channel is not None:
+                    channels.discard(channel)
+                    self.subscribers.get(channel, {}).pop(writer, None)
+                out.append(encode(Push([b"unsubscribe", channel, len(channels)]), client["resp3"]))
+        return b"".join(out)
+
+    def publish(self, channel, message):
+        writers = self.subscribers.get(channel, {})
+        frame = Push([b"message", channel, message])
+        for writer, resp3 in list(writers.items()):
+            writer.write(encode(frame, resp3))
+        return len(writers)
+
+    # ---------- keyspace ----------
+
+    def _alive(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _expire(self, key, seconds):
+        if self._alive(key):
+            self.expires[key] = time.monotonic() + seconds
+            return 1
+        return 0
+
+    def _incr(self, key, delta):
+        value = int(self.data[key]) if self._alive(key) else 0
+        value += delta
+        self.data[key] = str(value).encode()
+        return value
+
+    def dispatch(self, name, args):
+        if name == "PING":
+            return args[0] if args else "PONG"
+        if name == "ECHO":
+            return args[0]
+        if name in ("SELECT", "CLIENT", "READONLY"):
+            return "OK"
+        if name == "PUBLISH":
+            return self.publish(args[0], args[1])
+        if name == "GET":
+            return self.data[args[0]] if self._alive(args[0]) else None
+        if name == "MGET":
+            return [self.data[k] if self._alive(k) else None for k in args]
+        if name == "SET":
+            return self._set(args)
+        if name in ("INCR", "DECR"):
+            return self._incr(args[0], 1 if name == "INCR" else -1)
+        if name in ("INCRBY", "DECRBY"):
+            delta = int(args[1])
+            return self._incr(args[0], delta if name == "INCRBY" else -delta)
+        if name == "EXISTS":
+            return sum(1 for k in args if self._alive(k))
+        if name in ("DEL", "UNLINK"):
+            removed = 0
+            for key in args:
+                if self._alive(key):
+                    removed += 1
+                self.data.pop(key, None)
+                self.expires.pop(key, None)
+            return removed
+        if name == "EXPIRE":
+            return self._expire(args[0], int(args[1]))
+        if name == "PEXPIRE":
+            return self._expire(args[0], int(args[1]) / 1000)
+        if name == "PERSIST":
+            return 1 if self._alive(args[0]) and self.expires.pop(args[0], None) else 0
+        if name == "TTL":
+            if not self._alive(args[0]):
+                return -2
+            deadline = self.expires.get(args[0])
+            return -1 if deadline is None else int(deadline - time.monotonic())
+        if name == "KEYS":
+            pattern = args[0].decode()
+            return [k for k in list(self.data) if self._alive(k) and fnmatch.fnmatchcase(k.decode(), pattern)]
+        if name in ("FLUSHDB", "FLUSHALL"):
+            self.data.clear()
+            self.expires.clear()
+            return "OK"
+        raise RespError(f"ERR unknown command '{name}'")
+
+    def _set(self, args):
+        key, value, options = args[0], args[1], [a.decode().upper() for a in args[2:]]
+        ttl = None
+        if "EX" in options:
+            ttl = int(options[options.index("EX") + 1])
+        if "PX" in options:
+            ttl = int(options[options.index("PX") + 1]) / 1000
+        exists = self._alive(key)
+        if ("NX" in options and exists) or ("XX" in options and not exists):
+            return None
+        self.data[key] = value
+        if ttl is not None:
+            self.expires[key] = time.monotonic() + ttl
+        elif "KEEPTTL" not in options:
+            self.expires.pop(key, None)
+        return "OK"
+
+
+async def serve(host="127.0.0.1", port=6379):
+    standin = RedisStandIn()
+    server = await standin.start(host, port)
+    logger.info("Redis stand-in listening on %s:%s", host, standin.port)
+    async with server:
+        await server.serve_forever()
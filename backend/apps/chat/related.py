@@ -0,0 +1,134 @@
+"""
+Who is related to whom, for presence fan-out.
+
+A user's related users are everyone they share a room with, plus their
+contacts in either direction. ``related_users`` keeps those sets in memory
+(LRU, ``RELATED_USERS_CACHE_SIZE`` users), and a miss loads a set in one query.
+The code that changes memberships or contacts updates the index directly:
+additions are applied to the cached sets, and removals drop the sets they
+touch so they are reloaded next time.
+
+Each process has its own index. Entries also expire after
+``RELATED_USERS_TTL`` seconds, which bounds how long a change made through
+another worker can go unnoticed.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from apps.contacts.models import Contact
+
+from .models import ChatParticipant
+
+
+def load_related_user_ids(user_id):
+    rooms = ChatParticipant.objects.filter(user_id=user_id).values("chat_room_id")
+    room_mates = ChatParticipant.objects.filter(chat_room_id__in=rooms).values_list("user_id", flat=True)
+    contacts = Contact.objects.filter(owner_id=user_id).values_list("contact_user_id", flat=True)
+    added_by = Contact.objects.filter(contact_user_id=user_id).values_list("owner_id", flat=True)
+    return frozenset(room_mates.union(contacts, added_by)) - {user_id}
+
+
+def room_member_ids(room_id):
+    return set(ChatParticipant.objects.filter(chat_room_id=room_id).values_list("user_id", flat=True))
+
+
+class RelatedUsersIndex:
+    def __init__(self, max_entries=None, ttl=None, load=load_related_user_ids, clock=time.monotonic):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self.load = load
+        self.clock = clock
+        self.entries = OrderedDict()  # user_id -> (loaded_at, frozenset of user ids)
+        self.lock = threading.Lock()
+        self.changes = 0
+
+    @property
+    def max_entries(self):
+        return self._max_entries or getattr(settings, "RELATED_USERS_CACHE_SIZE", 10000)
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else getattr(settings, "RELATED_USERS_TTL", 300)
+
+    def cached(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            if self.clock() - entry[0] > self.ttl:
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+    def _store(self, user_id, related):
+        self.entries[user_id] = (self.clock(), frozenset(related))
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, user_id):
+        related = self.cached(user_id)
+        if related is None:
+            changes = self.changes
+            related = self.load(user_id)
+            with self.lock:
+                # Don't cache a set that a change made while it was loading may have outdated.
+                if changes == self.changes:
+                    self._store(user_id, related)
+        return related
+
+    async def aget(self, user_id):
+        """Like ``get``, without leaving the event loop on a hit."""
+        related = self.cached(user_id)
+        if related is None:
+            related = await database_sync_to_async(self.get)(user_id)
+        return related
+
+    def _link(self, user_id, others):
+        """Add ``others`` to ``user_id``'s cached set, if there is one."""
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            self.entries[user_id] = (entry[0], entry[1] | (set(others) - {user_id}))
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            self.changes += 1
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    # ---------- changes ----------
+
+    def joined(self, room_id, user_ids):
+        """``user_ids`` were added to the room (call after saving them)."""
+        members = room_member_ids(room_id)
+        with self.lock:
+            self.changes += 1
+            for member_id in members:
+                self._link(member_id, user_ids if member_id not in user_ids else members)
+
+    def left(self, room_id, user_ids):
+        """``user_ids`` left the room (call after deleting them)."""
+        # Ids may come straight from request data.
+        self.invalidate({int(u) for u in user_ids if u is not None} | room_member_ids(room_id))
+
+    def room_deleted(self, member_ids):
+        """A room with these members is gone."""
+        self.invalidate(member_ids)
+
+    def contact_added(self, owner_id, contact_user_id):
+        with self.lock:
+            self.changes += 1
+            self._link(owner_id, [contact_user_id])
+            self._link(contact_user_id, [owner_id])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+related_users = RelatedUsersIndex()
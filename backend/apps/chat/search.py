@@ -0,0 +1,213 @@
+"""
+Full-text message search.
+
+Messages are tokenized into lowercase, accent-folded words and indexed when
+they are created, edited or deleted (``index_message`` / ``unindex_message``),
+and dropped with their room (``unindex_room``).
+Queries match every word as a prefix ("meet tom" finds "meeting tomorrow"),
+require all of them, and rank the hits.
+
+Two index backends share that contract:
+
+* ``FTS5Index`` - an SQLite FTS5 table ranked with bm25. Used automatically
+  on SQLite when the table exists.
+* ``PostingsIndex`` - a plain ``MessagePosting`` table, one row per
+  (message, term), that any database can serve with a B-tree range scan.
+  Exact word matches rank above prefix matches, then term frequency, then
+  recency.
+
+``CHAT_SEARCH_BACKEND`` ("fts5", "postings" or "auto") picks one explicitly.
+After switching, run ``manage.py rebuild_search_index``.
+"""
+import re
+import unicodedata
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, Value, When
+
+from .models import ChatParticipant, Message, MessagePosting
+
+MAX_TERM_LENGTH = MessagePosting._meta.get_field("term").max_length
+MAX_QUERY_TERMS = 8
+MAX_RESULTS = 500
+FTS_TABLE = "chat_message_fts"
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """Casefolded, accent-stripped words of text, the same way FTS5's unicode61 splits them."""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [word[:MAX_TERM_LENGTH] for word in WORD.findall(text)]
+
+
+def query_terms(query):
+    """
+    Distinct words of a search query. A word that is a prefix of another one
+    is dropped, since every word is prefix-matched and all must match anyway.
+    """
+    words = sorted(set(tokenize(query)), key=len, reverse=True)
+    terms = []
+    for word in words:
+        if not any(term.startswith(word) for term in terms):
+            terms.append(word)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def is_searchable(message):
+    return message.message_type == "text" and not message.is_deleted and bool(message.content)
+
+
+class PostingsIndex:
+    name = "postings"
+
+    def add(self, messages):
+        postings = []
+        for message in messages:
+            counts = {}
+            for term in tokenize(message.content):
+                counts[term] = counts.get(term, 0) + 1
+            postings.extend(
+                MessagePosting(term=term, message_id=message.id, chat_room_id=message.chat_room_id,
+                               frequency=min(count, 32767))
+                for term, count in counts.items()
+            )
+        MessagePosting.objects.bulk_create(postings, batch_size=1000)
+
+    def remove(self, message_ids):
+        MessagePosting.objects.filter(message_id__in=message_ids).delete()
+
+    def clear(self):
+        MessagePosting.objects.all().delete()
+
+    def search(self, terms, scope, limit):
+        # Prefix match as a range so it is an index seek on every backend.
+        ranges = [Q(term__gte=term, term__lt=term + "\uffff") for term in terms]
+        which = Case(
+            *(When(rng, then=Value(i)) for i, rng in enumerate(ranges)),
+            output_field=IntegerField(),
+        )
+        score = Sum(Case(
+            When(term__in=terms, then=F("frequency") * 2), default=F("frequency"), output_field=IntegerField()
+        ))
+        rows = (
+            MessagePosting.objects.filter(reduce(or_, ranges), chat_room_id__in=scope)
+            .values("message_id")
+            .annotate(matched=Count(which, distinct=True), score=score)
+            .filter(matched=len(terms))
+            .order_by("-score", "-message_id")
+        )
+        return list(rows.values_list("message_id", flat=True)[:limit])
+
+
+class FTS5Index:
+    name = "fts5"
+
+    def add(self, messages):
+        rows = [(m.id, m.content, m.chat_room_id) for m in messages]
+        if rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f"INSERT INTO {FTS_TABLE} (rowid, content, chat_room_id) VALUES (%s, %s, %s)", rows
+                )
+
+    def remove(self, message_ids):
+        message_ids = list(message_ids)
+        if message_ids:
+            placeholders = ", ".join(["%s"] * len(message_ids))
+            with connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", message_ids)
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    def search(self, terms, scope, limit):
+        match = " ".join(f'"{term}"*' for term in terms)
+        scope_sql, scope_params = scope.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                f"AND chat_room_id IN ({scope_sql}) "
+                f"ORDER BY bm25({FTS_TABLE}), rowid DESC LIMIT %s",
+                [match, *scope_params, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+_fts5_available = {}
+
+
+def fts5_available():
+    """Whether the FTS5 table exists on the default database (checked once)."""
+    if connection.vendor != "sqlite":
+        return False
+    if connection.alias not in _fts5_available:
+        _fts5_available[connection.alias] = FTS_TABLE in connection.introspection.table_names()
+    return _fts5_available[connection.alias]
+
+
+def get_index():
+    backend = getattr(settings, "CHAT_SEARCH_BACKEND", "auto")
+    if backend == "fts5" or (backend == "auto" and fts5_available()):
+        return FTS5Index()
+    return PostingsIndex()
+
+
+def index_message(message, created=False):
+    """(Re)index a message after it was created or edited. Call inside the same transaction."""
+    index = get_index()
+    if not created:
+        index.remove([message.id])
+    if is_searchable(message):
+        index.add([message])
+
+
+def unindex_message(message):
+    get_index().remove([message.id])
+
+
+def unindex_room(room_id, batch_size=500):
+    """Drop a room's messages from the index before deleting the room. Call inside the same transaction."""
+    index = get_index()
+    message_ids = list(Message.objects.filter(chat_room_id=room_id).values_list("id", flat=True))
+    for start in range(0, len(message_ids), batch_size):
+        index.remove(message_ids[start:start + batch_size])
+
+
+def rebuild(batch_size=5000):
+    """Drop and rebuild the active index from all messages. Returns the number indexed."""
+    index = get_index()
+    index.clear()
+    indexed = 0
+    messages = Message.objects.filter(message_type="text", is_deleted=False).exclude(content__isnull=True).exclude(content="")
+    batch = []
+    for message in messages.only("id", "chat_room_id", "content").iterator(chunk_size=batch_size):
+        batch.append(message)
+        if len(batch) >= batch_size:
+            index.add(batch)
+            indexed += len(batch)
+            batch = []
+    index.add(batch)
+    return indexed + len(batch)
+
+
+def search_messages(user, query, room_id=None, limit=MAX_RESULTS):
+    """
+    Ids of the best matching messages, best first, in one room or in every
+    room the user participates in. Callers check room membership.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    if room_id is not None:
+        scope = ChatParticipant.objects.filter(user=user, chat_room_id=room_id)
+    else:
+        scope = ChatParticipant.objects.filter(user=user)
+    return get_index().search(terms, scope.values("chat_room_id"), limit)
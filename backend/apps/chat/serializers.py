@@ -1,13 +1,20 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import ChatRoom, ChatParticipant, Message, MessageReadStatus, MessageReaction,Sticker, StickerPack
+from .models import ChatRoom, ChatParticipant, Message, MessageReaction,Sticker, StickerPack
+from .presence import presence_state
+from .read_state import record_deleted_message, record_new_message, room_watermarks
+from .related import related_users
+from .search import index_message, unindex_message
+from .summaries import invalidate_message as invalidate_summaries
 
 from apps.contacts.models import Contact
-from django.utils import timezone
+from django.db import transaction
+from django.db.models import Prefetch
 from apps.accounts.serializers import UserSerializer
 
 User = get_user_model()
 
+
 class CreatePrivateChatSerializer(serializers.Serializer):
     user_id = serializers.IntegerField()
 
@@ -35,6 +42,7 @@ class CreatePrivateChatSerializer(serializers.Serializer):
         room = ChatRoom.objects.create(room_type="private")
         ChatParticipant.objects.create(chat_room=room, user=request_user)
         ChatParticipant.objects.create(chat_room=room, user=other_user)
+        related_users.joined(room.id, [request_user.id, other_user.id])
         return room
 
 import json
@@ -85,6 +93,7 @@ class CreateGroupChatSerializer(serializers.Serializer):
         for user_id in user_ids:
             user = User.objects.get(id=user_id)
             ChatParticipant.objects.create(chat_room=room, user=user)
+        related_users.joined(room.id, [request_user.id, *user_ids])
 
         return room
 class SendMessageSerializer(serializers.Serializer):
@@ -111,12 +120,16 @@ class SendMessageSerializer(serializers.Serializer):
     def validate(self, attrs):
         user = self._get_user()
         room_id = attrs["room_id"]
-        try:
-            room = ChatRoom.objects.get(id=room_id)
-        except ChatRoom.DoesNotExist:
-            raise serializers.ValidationError("Room does not exist.")
-        if not room.participants.filter(user=user).exists():
-            raise serializers.ValidationError("Not a participant.")
+        # Callers that have already verified membership (the chat socket does
+        # on connect) pass the room in the context to skip the lookups.
+        room = self.context.get("room")
+        if room is None or room.id != room_id:
+            try:
+                room = ChatRoom.objects.get(id=room_id)
+            except ChatRoom.DoesNotExist:
+                raise serializers.ValidationError("Room does not exist.")
+            if not room.participants.filter(user=user).exists():
+                raise serializers.ValidationError("Not a participant.")
 
         content = attrs.get('content', '').strip()
         file = attrs.get('file')
@@ -152,34 +165,22 @@ class SendMessageSerializer(serializers.Serializer):
             except Sticker.DoesNotExist:
                 pass
 
-        message = Message.objects.create(
-            chat_room=room,
-            sender=user,
-            content=content,
-            file=file,
-            file_name=file.name if file else None,
-            file_size=file.size if file else None,
-            mime_type=file.content_type if file else None,
-            message_type=message_type,
-            reply_to=reply_to,
-            duration=duration,
-            gif_url=gif_url,
-        )
-
-        room.updated_at = timezone.now()
-        room.save(update_fields=["updated_at"])
-
-        # Sender status
-        MessageReadStatus.objects.create(
-            message=message, user=user, is_read=True, read_at=timezone.now(),
-            is_delivered=True, delivered_at=timezone.now()
-        )
-        # Other participants
-        other_users = room.participants.exclude(user=user)
-        for participant in other_users:
-            MessageReadStatus.objects.create(
-                message=message, user=participant.user, is_read=False, is_delivered=False
+        with transaction.atomic():
+            message = Message.objects.create(
+                chat_room=room,
+                sender=user,
+                content=content,
+                file=file,
+                file_name=file.name if file else None,
+                file_size=file.size if file else None,
+                mime_type=file.content_type if file else None,
+                message_type=message_type,
+                reply_to=reply_to,
+                duration=duration,
+                gif_url=gif_url,
             )
+            record_new_message(message)
+            index_message(message, created=True)
 
         return message
       
@@ -189,12 +190,12 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
     last_seen = serializers.SerializerMethodField()
     other_user_id = serializers.SerializerMethodField()
     is_group = serializers.SerializerMethodField()
-    last_message = serializers.CharField(read_only=True)
-    last_message_time = serializers.DateTimeField(read_only=True)
+    last_message = serializers.CharField(source='last_message_preview', read_only=True)
+    last_message_time = serializers.DateTimeField(source='last_message_at', read_only=True)
     unread_count = serializers.IntegerField(read_only=True)
     other_user_avatar = serializers.SerializerMethodField()
     avatar = serializers.SerializerMethodField()
-    creator_id = serializers.IntegerField(source='creator.id', read_only=True)
+    creator_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = ChatRoom
@@ -204,58 +205,79 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
         "avatar", "creator_id",
     ]
 
-    def get_is_online(self, obj):
+    def _get_other(self, obj):
+        """
+        The other participant of a private room. UserChatRoomsView prefetches
+        these as ``counterparts`` (with their users) for the whole page.
+        """
+        if obj.room_type == "group":
+            return None
+        if hasattr(obj, "counterparts"):
+            return obj.counterparts[0] if obj.counterparts else None
         request_user = self.context["request"].user
+        return obj.participants.exclude(user=request_user).select_related("user").first()
+
+    def _get_nicknames(self):
+        """The request user's contact nicknames, loaded once per serialization."""
+        if "_nicknames" not in self.context:
+            request_user = self.context["request"].user
+            self.context["_nicknames"] = dict(
+                Contact.objects.filter(owner=request_user).exclude(nickname="")
+                .values_list("contact_user_id", "nickname")
+            )
+        return self.context["_nicknames"]
+
+    def _get_presence(self, obj):
+        """
+        The other participant's online state and last seen time, from the
+        presence store. Looked up for the whole page at once.
+        """
+        other = self._get_other(obj)
+        if other is None:
+            return None
+        presence = self.context.setdefault("_presence", {})
+        if other.user_id not in presence:
+            page = getattr(self.parent, "instance", None) or [obj]
+            others = [o for o in map(self._get_other, page) if o is not None]
+            presence.update(presence_state.lookup({o.user_id for o in others} | {other.user_id}))
+        return presence[other.user_id]
+
+    def get_is_online(self, obj):
         if obj.room_type == "group":
             return None
-        other = obj.participants.exclude(user=request_user).first()
-        return False if not other else False  # Placeholder; implement Redis later
+        presence = self._get_presence(obj)
+        return presence["is_online"] if presence else False
 
     def get_last_seen(self, obj):
-        request_user = self.context["request"].user
-        if obj.room_type == "group":
+        presence = self._get_presence(obj)
+        if presence is None:
             return None
-        other = obj.participants.exclude(user=request_user).first()
-        return other.user.last_seen if other else None
+        # Falls back to the saved value once the cached one has expired.
+        return presence["last_seen"] or self._get_other(obj).user.last_seen
 
     def get_other_user_id(self, obj):
-        request_user = self.context["request"].user
-        if obj.room_type == "group":
-            return None
-        other = obj.participants.exclude(user=request_user).first()
-        return other.user.id if other else None
+        other = self._get_other(obj)
+        return other.user_id if other else None
 
     def get_is_group(self, obj):
         return obj.room_type == "group"
 
     def get_display_name(self, obj):
-        request_user = self.context["request"].user
         if obj.room_type == "group":
             return obj.name
-        other = obj.participants.exclude(user=request_user).first()
+        other = self._get_other(obj)
         if other:
-            # Try to get the contact from the current user's contact list
-            contact = Contact.objects.filter(owner=request_user, contact_user=other.user).first()
-            if contact and contact.nickname:
-                return contact.nickname
-            return other.user.username
+            # Prefer the nickname from the current user's contact list
+            return self._get_nicknames().get(other.user_id) or other.user.username
         return "Unknown"
 
     def get_other_user_avatar(self, obj):
         request = self.context.get("request")
-
-        if obj.room_type == "private":
-            other = obj.participants.exclude(
-                user=request.user
-            ).first()
-
-            if other and other.user.avatar:
-                return request.build_absolute_uri(
-                    other.user.avatar.url
-                )
-
+        other = self._get_other(obj)
+        if other and other.user.avatar:
+            return request.build_absolute_uri(other.user.avatar.url)
         return None
-    
+
     def get_avatar(self, obj):
         request = self.context.get("request")
         if obj.avatar:
@@ -284,9 +306,20 @@ class RoomMessageSerializer(serializers.ModelSerializer):
             "id", "content", "sender", "created_at", "is_delivered", "is_read",
             "is_deleted", "forwarded", "reactions", "file", "file_name",
             "file_size", "mime_type", "file_url", "message_type", "duration",
-            "gif_url", "reply_to", "pinned"
+            "gif_url", "reply_to", "pinned", "translations"
         ]
 
+    @staticmethod
+    def eager_load(queryset):
+        """
+        Load everything the serializer touches for a whole page up front:
+        sender, reply (and its sender) and reactions with their users.
+        Read state and pinned flags are looked up once per room via the context.
+        """
+        return queryset.select_related("sender", "reply_to__sender").prefetch_related(
+            Prefetch("reactions", queryset=MessageReaction.objects.select_related("user"))
+        )
+
     def _get_user(self):
         """Safely get user from context (supports both HTTP request and direct user)."""
         user = self.context.get("user")
@@ -299,19 +332,26 @@ class RoomMessageSerializer(serializers.ModelSerializer):
     def get_sender(self, obj):
         return {"id": obj.sender.id, "username": obj.sender.username}
 
+    def _get_watermarks(self, obj, user):
+        """Other participants' (delivered, read) watermarks, cached per room for the whole page."""
+        cache = self.context.setdefault("_room_watermarks", {})
+        if obj.chat_room_id not in cache:
+            cache[obj.chat_room_id] = room_watermarks(obj.chat_room_id, user)
+        return cache[obj.chat_room_id]
+
     def get_is_read(self, obj):
         user = self._get_user()
-        if not user or obj.sender != user:
+        if not user or obj.sender_id != user.id:
             return False
-        other_status = obj.read_status.exclude(user=user).first()
-        return other_status.is_read if other_status else False
+        _, read = self._get_watermarks(obj, user)
+        return obj.id <= read
 
     def get_is_delivered(self, obj):
         user = self._get_user()
-        if not user or obj.sender != user:
+        if not user or obj.sender_id != user.id:
             return False
-        other_status = obj.read_status.exclude(user=user).first()
-        return other_status.is_delivered if other_status else False
+        delivered, _ = self._get_watermarks(obj, user)
+        return obj.id <= delivered
 
     def get_file_url(self, obj):
         if not obj.file:
@@ -322,7 +362,7 @@ class RoomMessageSerializer(serializers.ModelSerializer):
         return obj.file.url
 
     def get_reply_to(self, obj):
-        if obj.reply_to:
+        if obj.reply_to_id:
             return {
                 'id': obj.reply_to.id,
                 'content': obj.reply_to.content,
@@ -331,8 +371,23 @@ class RoomMessageSerializer(serializers.ModelSerializer):
         return None
 
     def get_pinned(self, obj):
-        return obj.chat_room.pinned_messages.filter(id=obj.id).exists()
-        
+        cache = self.context.setdefault("_pinned_ids", {})
+        if obj.chat_room_id not in cache:
+            cache[obj.chat_room_id] = set(
+                ChatRoom.pinned_messages.through.objects.filter(
+                    chatroom_id=obj.chat_room_id
+                ).values_list("message_id", flat=True)
+            )
+        return obj.id in cache[obj.chat_room_id]
+
+
+class MessageSearchResultSerializer(RoomMessageSerializer):
+    """A search hit from any room, so it carries its room id."""
+    room_id = serializers.IntegerField(source="chat_room_id", read_only=True)
+
+    class Meta(RoomMessageSerializer.Meta):
+        fields = RoomMessageSerializer.Meta.fields + ["room_id"]
+
 class EditMessageSerializer(serializers.Serializer):
     message_id = serializers.IntegerField()
     new_content = serializers.CharField(max_length=5000)
@@ -364,9 +419,16 @@ class DeleteMessageSerializer(serializers.Serializer):
 
     def delete(self, validated_data):
         message = validated_data['message']
+        already_deleted = message.is_deleted
         message.is_deleted = True
         message.content = None
-        message.save()
+        message.translations = {}
+        with transaction.atomic():
+            message.save()
+            if not already_deleted:
+                record_deleted_message(message)
+                unindex_message(message)
+                invalidate_summaries(message)
         return message
 
 class LanguageSerializer(serializers.Serializer):
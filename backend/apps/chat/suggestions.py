@@ -0,0 +1,221 @@
+"""
+Ghost suggestions (typing completions) for one connection.
+
+Keystroke events are debounced for ``GHOST_SUGGESTION_DEBOUNCE`` seconds, and
+a newer partial cancels whatever the connection was still working on, the
+model call included. A completion is never sent for text the user has
+already typed past.
+
+Continuations are cached, process-wide, by (hash of the room's recent
+messages, language, partial). When the user types part of what was
+suggested ("see you" -> "tomorrow at 5", then "see you tom"), the rest of
+the earlier suggestion is reused rather than asking the model again. Cache
+answers skip the debounce. ``suggestion_metrics`` counts hits, model calls and
+cancellations and keeps recent end-to-end latencies for percentiles.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from apps.ai.metrics import LatencySamples
+
+MIN_PARTIAL_LENGTH = 3
+# How far back a partial is searched for a cached prefix to extend.
+MAX_PREFIX_LOOKBACK = 64
+
+
+def context_hash(context):
+    return hashlib.sha1(context.encode()).hexdigest()
+
+
+def extend_suggestion(previous_partial, continuation, partial):
+    """
+    What is left of ``continuation`` (suggested after ``previous_partial``)
+    once the user has typed ``partial``, or None if they typed something else.
+    """
+    for joined in (previous_partial + continuation, f"{previous_partial} {continuation}"):
+        if joined.startswith(partial):
+            rest = joined[len(partial):]
+            return rest if rest.strip() else None
+    return None
+
+
+class SuggestionCache:
+    def __init__(self, max_entries=None):
+        self._max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def max_entries(self):
+        return self._max_entries or getattr(settings, "GHOST_SUGGESTION_CACHE_SIZE", 5000)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, continuation):
+        with self.lock:
+            self.entries[key] = continuation
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def lookup(self, chash, lang, partial):
+        """``(continuation, "hit" | "prefix")`` from the cache, or None."""
+        exact = self.get((chash, lang, partial))
+        if exact is not None:
+            return exact, "hit"
+        for end in range(len(partial) - 1, max(MIN_PARTIAL_LENGTH, len(partial) - MAX_PREFIX_LOOKBACK) - 1, -1):
+            earlier = self.get((chash, lang, partial[:end]))
+            if earlier:
+                rest = extend_suggestion(partial[:end], earlier, partial)
+                if rest is not None:
+                    return rest, "prefix"
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SuggestionMetrics:
+    def __init__(self, samples=1000):
+        self.lock = threading.Lock()
+        self.latencies = LatencySamples(samples)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {"requests": 0, "hit": 0, "prefix": 0, "model": 0,
+                           "cancelled": 0, "rate_limited": 0, "failed": 0}
+        self.latencies.reset()
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def record(self, outcome, latency):
+        self.count(outcome)
+        self.latencies.record(latency)
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        latency = self.latencies.snapshot()
+        answered = counts["hit"] + counts["prefix"] + counts["model"]
+        return {
+            **counts,
+            "hit_rate": round((counts["hit"] + counts["prefix"]) / answered, 3) if answered else None,
+            "p50_ms": latency["p50_ms"],
+            "p95_ms": latency["p95_ms"],
+        }
+
+
+suggestion_cache = SuggestionCache()
+suggestion_metrics = SuggestionMetrics()
+
+
+class GhostSuggestionScheduler:
+    """
+    ``load_context()`` returns the room's recent messages as text,
+    ``generate(partial, context, lang)`` asks the model, ``send(partial,
+    continuation)`` delivers a suggestion and ``admit()`` (optional) says
+    whether a model call may go ahead. All are coroutines.
+
+    For streaming submissions, ``stream(partial, context, lang)`` is an async
+    iterator of text deltas, each passed to ``send_delta(partial, delta)`` as
+    it arrives; ``send`` still gets the whole continuation at the end.
+    """
+
+    def __init__(self, load_context, generate, send, admit=None, stream=None, send_delta=None,
+                 debounce=None, cache=suggestion_cache, metrics=suggestion_metrics, clock=time.perf_counter):
+        self.load_context = load_context
+        self.generate = generate
+        self.send = send
+        self.admit = admit
+        self.stream = stream
+        self.send_delta = send_delta
+        self.debounce = debounce if debounce is not None else getattr(settings, "GHOST_SUGGESTION_DEBOUNCE", 0.3)
+        self.cache = cache
+        self.metrics = metrics
+        self.clock = clock
+        self._context = None  # (text, hash) of the recent messages
+        self._task = None
+
+    def invalidate_context(self):
+        """Call when the room's recent messages change."""
+        self._context = None
+
+    async def submit(self, partial, lang, streaming=False):
+        started = self.clock()
+        self.cancel()
+        if len(partial) < MIN_PARTIAL_LENGTH:
+            return
+        self.metrics.count("requests")
+        if self._context is not None:
+            cached = self.cache.lookup(self._context[1], lang, partial)
+            if cached is not None:
+                await self._deliver(partial, cached, started)
+                return
+        streaming = streaming and self.stream is not None
+        self._task = asyncio.create_task(self._run(partial, lang, started, streaming))
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            self.metrics.count("cancelled")
+        self._task = None
+
+    async def close(self):
+        self.cancel()
+
+    async def _stream(self, partial, context, lang):
+        parts = []
+        async for delta in self.stream(partial, context, lang):
+            if not parts:
+                delta = delta.lstrip()
+                if not delta:
+                    continue
+            parts.append(delta)
+            await self.send_delta(partial, delta)
+        return "".join(parts)
+
+    async def _deliver(self, partial, cached, started):
+        continuation, outcome = cached
+        if continuation:
+            await self.send(partial, continuation)
+        self.metrics.record(outcome, self.clock() - started)
+
+    async def _run(self, partial, lang, started, streaming=False):
+        try:
+            await asyncio.sleep(self.debounce)
+            if self._context is None:
+                context = await self.load_context()
+                self._context = (context, context_hash(context))
+            context, chash = self._context
+            cached = self.cache.lookup(chash, lang, partial)
+            if cached is not None:
+                await self._deliver(partial, cached, started)
+                return
+            if self.admit is not None and not await self.admit():
+                self.metrics.count("rate_limited")
+                return
+            if streaming:
+                continuation = (await self._stream(partial, context, lang)).strip()
+            else:
+                continuation = (await self.generate(partial, context, lang) or "").strip()
+            self.cache.set((chash, lang, partial), continuation)
+            await self._deliver(partial, (continuation, "model"), started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.metrics.count("failed")
+            print(f"❌ Ghost suggestion failed: {e}")
@@ -0,0 +1,192 @@
+"""
+Stored, incremental conversation summaries per room.
+
+A room's text messages are cut, in order, into blocks of
+``SUMMARY_BLOCK_SIZE``. Each block is summarized once into a level-0
+``RoomSummary``, and every ``SUMMARY_FANOUT`` consecutive nodes of one level
+are merged into a node one level up. New nodes are only built for blocks that
+have filled up since the last update (``schedule`` coalesces updates per room),
+so upkeep costs about one model call per block.
+
+``catch_up`` covers "everything after message X" with the fewest stored nodes
+that fit, plus the raw messages that are not in a block yet, and turns them into
+one summary. That is a single small call however long the history is.
+Editing or deleting a message drops the nodes that cover it, and the next
+update rebuilds them.
+"""
+import asyncio
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from apps.ai.services import AsyncGroqService
+
+from .models import ChatParticipant, Message, RoomSummary
+
+
+def block_size():
+    return getattr(settings, "SUMMARY_BLOCK_SIZE", 50)
+
+
+def fanout():
+    return getattr(settings, "SUMMARY_FANOUT", 4)
+
+
+def summarizable(room_id):
+    return Message.objects.filter(chat_room_id=room_id, is_deleted=False, message_type="text").exclude(
+        content__isnull=True).exclude(content__exact="")
+
+
+def message_lines(messages):
+    return [f"{username}: {content}" for _, username, content in messages]
+
+
+def summary_line(node_count, summary):
+    return f"[Summary of {node_count} earlier messages] {summary}"
+
+
+def invalidate_message(message):
+    """Drop the stored summaries that include an edited or deleted message."""
+    RoomSummary.objects.filter(
+        chat_room_id=message.chat_room_id, start_message_id__lte=message.id, end_message_id__gte=message.id
+    ).delete()
+
+
+class SummaryTree:
+    def __init__(self, summarize=None, delay=None):
+        self._summarize = summarize
+        self._delay = delay
+        self._scheduled = {}
+
+    @property
+    def delay(self):
+        return self._delay if self._delay is not None else getattr(settings, "SUMMARY_UPDATE_DELAY", 30)
+
+    async def summarize(self, lines, lang="en"):
+        if self._summarize is not None:
+            return await self._summarize(lines, lang)
+        return await AsyncGroqService().summarize_conversation(lines, lang)
+
+    # ---------- building ----------
+
+    def schedule(self, room_id):
+        """Bring the room's tree up to date in a little while (once, however often it is called)."""
+        room_id = int(room_id)
+        if room_id not in self._scheduled:
+            self._scheduled[room_id] = asyncio.create_task(self._update_later(room_id))
+
+    async def _update_later(self, room_id):
+        try:
+            await asyncio.sleep(self.delay)
+            self._scheduled.pop(room_id, None)
+            built = await self.update(room_id)
+            if built:
+                print(f"🌳 Built {built} summary node(s) for room {room_id}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._scheduled.pop(room_id, None)
+            print(f"❌ Summary update for room {room_id} failed: {e}")
+
+    async def update(self, room_id):
+        """Summarize every full block without a summary, then merge upward. Returns nodes built."""
+        built = 0
+        for start, end, messages in await database_sync_to_async(self.missing_blocks)(room_id):
+            summary = await self.summarize(message_lines(messages))
+            await database_sync_to_async(self.save)(room_id, 0, start, end, len(messages), summary)
+            built += 1
+        level = 0
+        while True:
+            groups = await database_sync_to_async(self.missing_parents)(room_id, level)
+            if groups is None:
+                return built
+            for start, end, count, summaries in groups:
+                summary = await self.summarize([summary_line(c, s) for c, s in summaries])
+                await database_sync_to_async(self.save)(room_id, level + 1, start, end, count, summary)
+                built += 1
+            level += 1
+
+    def missing_blocks(self, room_id):
+        """``[(start_id, end_id, [(id, username, content), ...]), ...]`` for blocks that need a summary."""
+        size = block_size()
+        leaves = RoomSummary.objects.filter(chat_room_id=room_id, level=0).order_by("start_message_id")
+        messages = summarizable(room_id).order_by("id").values_list("id", "sender__username", "content")
+        blocks, previous_end = [], 0
+        # Holes left by invalidated blocks are summarized again, whatever their size.
+        for start, end in leaves.values_list("start_message_id", "end_message_id"):
+            if start > previous_end + 1:
+                gap = list(messages.filter(id__gt=previous_end, id__lt=start))
+                if gap:
+                    blocks.append((previous_end + 1, start - 1, gap))
+            previous_end = end
+        # New messages are summarized only in full blocks.
+        tail = list(messages.filter(id__gt=previous_end)[:size * getattr(settings, "SUMMARY_MAX_BLOCKS_PER_UPDATE", 20)])
+        for i in range(0, len(tail) - size + 1, size):
+            block = tail[i:i + size]
+            blocks.append((previous_end + 1, block[-1][0], block))
+            previous_end = block[-1][0]
+        return blocks
+
+    def missing_parents(self, room_id, level):
+        """
+        Groups of ``SUMMARY_FANOUT`` consecutive nodes at ``level`` that have no
+        parent yet, or None if the level is too small to have any parents.
+        """
+        size = fanout()
+        nodes = list(RoomSummary.objects.filter(chat_room_id=room_id, level=level).order_by("start_message_id")
+                     .values_list("start_message_id", "end_message_id", "message_count", "summary"))
+        if len(nodes) < size:
+            return None
+        parents = set(RoomSummary.objects.filter(chat_room_id=room_id, level=level + 1)
+                      .values_list("start_message_id", flat=True))
+        groups = []
+        for i in range(0, len(nodes) - size + 1, size):
+            children = nodes[i:i + size]
+            if children[0][0] not in parents:
+                groups.append((children[0][0], children[-1][1], sum(c[2] for c in children),
+                               [(c[2], c[3]) for c in children]))
+        return groups
+
+    def save(self, room_id, level, start, end, count, summary):
+        RoomSummary.objects.update_or_create(
+            chat_room_id=room_id, level=level, start_message_id=start,
+            defaults={"end_message_id": end, "message_count": count, "summary": summary},
+        )
+
+    # ---------- reading ----------
+
+    def cover(self, room_id, after_id):
+        """
+        The conversation after message ``after_id`` as prompt lines, oldest
+        first: the largest stored summaries that fit, and raw messages where
+        there are none.
+        """
+        picked = []
+        nodes = RoomSummary.objects.filter(chat_room_id=room_id, start_message_id__gt=after_id).order_by(
+            "-level", "start_message_id").values_list("start_message_id", "end_message_id", "message_count", "summary")
+        for start, end, count, summary in nodes:
+            if not any(start <= p_end and p_start <= end for p_start, p_end, _, _ in picked):
+                picked.append((start, end, count, summary))
+        raw = summarizable(room_id).filter(id__gt=after_id)
+        for start, end, _, _ in picked:
+            raw = raw.exclude(id__gte=start, id__lte=end)
+        limit = getattr(settings, "SUMMARY_MAX_RAW_MESSAGES", 2 * block_size())
+        raw = list(raw.order_by("-id").values_list("id", "sender__username", "content")[:limit])
+        items = [(start, summary_line(count, summary)) for start, _, count, summary in picked]
+        items += [(message_id, line) for (message_id, *_), line in zip(raw, message_lines(raw))]
+        return [line for _, line in sorted(items)]
+
+    async def catch_up(self, room_id, after_id, lang="en"):
+        """One summary of everything after message ``after_id``, or None if there is nothing."""
+        lines = await database_sync_to_async(self.cover)(room_id, after_id)
+        if not lines:
+            return None
+        return await self.summarize(lines, lang)
+
+
+def last_read_message_id(user_id, room_id):
+    return ChatParticipant.objects.filter(user_id=user_id, chat_room_id=room_id).values_list(
+        "last_read_message_id", flat=True).first() or 0
+
+
+summary_tree = SummaryTree()
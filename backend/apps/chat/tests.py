@@ -1,3 +1,1033 @@
-from django.test import TestCase
+import asyncio
+import importlib.util
+import unittest
+from unittest import mock
+
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import read_state, search
+from .analysis import RoomAnalyzer
+from .consumers import ChatConsumer, GlobalConsumer
+from .fanout import group_send_many, user_groups
+from .models import ChatRoom, ChatParticipant, Message
+from .presence import PresenceRegistry, PresenceService, PresenceStateStore, presence_registry, presence_state
+from .pretranslate import PreTranslation, target_languages
+from .receipts import DeliveryReceiptBatcher
+from .related import RelatedUsersIndex, related_users
+from .redis_standin import RedisStandIn
+from .serializers import SendMessageSerializer
+from .summaries import SummaryTree, invalidate_message
+from .suggestions import GhostSuggestionScheduler, SuggestionCache, SuggestionMetrics, extend_suggestion
+
+User = get_user_model()
+
+
+def make_user(name):
+    return User.objects.create_user(
+        username=name, email=f"{name}@example.com", phone_number=name[:15]
+    )
+
+
+def make_group(users, name="group"):
+    room = ChatRoom.objects.create(room_type="group", name=name, creator=users[0])
+    for user in users:
+        ChatParticipant.objects.create(chat_room=room, user=user)
+    return room
+
+
+def send(user, room, content="hello"):
+    serializer = SendMessageSerializer(
+        data={"room_id": room.id, "content": content}, context={"user": user}
+    )
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
+
+class SendMessageTests(TestCase):
+    def test_send_advances_only_sender_watermarks(self):
+        users = [make_user(f"user{i}") for i in range(4)]
+        room = make_group(users)
+        message = send(users[0], room)
+
+        sender = ChatParticipant.objects.get(chat_room=room, user=users[0])
+        self.assertEqual(sender.last_read_message_id, message.id)
+        self.assertEqual(sender.last_delivered_message_id, message.id)
+        self.assertFalse(
+            ChatParticipant.objects.filter(chat_room=room, last_read_message_id__gt=0)
+            .exclude(user=users[0]).exists()
+        )
+        room.refresh_from_db()
+        self.assertGreaterEqual(room.updated_at, message.created_at)
+
+    def test_send_query_count_independent_of_group_size(self):
+        small = make_group([make_user(f"s{i}") for i in range(2)], "small")
+        large = make_group([make_user(f"l{i}") for i in range(30)], "large")
+        small_sender = small.participants.first().user
+        large_sender = large.participants.first().user
+
+        with CaptureQueriesContext(connection) as small_ctx:
+            send(small_sender, small)
+        with CaptureQueriesContext(connection) as large_ctx:
+            send(large_sender, large)
+        self.assertEqual(len(small_ctx.captured_queries), len(large_ctx.captured_queries))
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+
+    async def connect(self, user):
+        from channels.testing import WebsocketCommunicator
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/")
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"room_id": str(self.room.id)}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_send_uses_cached_room_context(self):
+        from asgiref.sync import async_to_sync
+        consumer = ChatConsumer()
+        consumer.room_id, consumer.user = str(self.room.id), self.alice
+        async_to_sync(consumer.load_room_context)()
+        self.assertEqual(consumer.participant_ids, {self.alice.id, self.bob.id})
+
+        with CaptureQueriesContext(connection) as ctx:
+            message = async_to_sync(consumer.create_message)("hi there")
+        selects = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("SELECT")]
+        self.assertEqual(selects, [])
+        self.assertTrue(Message.objects.filter(id=message.id, chat_room=self.room).exists())
+
+    async def test_membership_change_reloads_and_closes_removed_user(self):
+        communicator = await self.connect(self.bob)
+        try:
+            await ChatParticipant.objects.filter(chat_room=self.room, user=self.bob).adelete()
+            await get_channel_layer().group_send(
+                f"chat_{self.room.id}", {"type": "membership_changed", "room_id": self.room.id}
+            )
+            output = await communicator.receive_output(timeout=2)
+            self.assertEqual(output["type"], "websocket.close")
+        finally:
+            await communicator.disconnect()
+
+
+@override_settings(PRESENCE_OFFLINE_GRACE=0, PRESENCE_BATCH_WINDOW=0, LAST_SEEN_FLUSH_INTERVAL=0)
+class GlobalConsumerTests(TransactionTestCase):
+    def setUp(self):
+        from django.core.cache import caches
+        self.addCleanup(caches["default"].clear)
+        related_users.clear()
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+
+    async def test_connect_sends_snapshot_and_relays_notifications(self):
+        from channels.testing import WebsocketCommunicator
+        await presence_registry.connect(self.bob.id)
+        communicator = WebsocketCommunicator(GlobalConsumer.as_asgi(), "/ws/global/")
+        communicator.scope["user"] = self.alice
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            snapshot = await communicator.receive_json_from(timeout=2)
+            self.assertEqual(snapshot, {"type": "presence_snapshot", "online": [self.bob.id]})
+
+            await get_channel_layer().group_send(f"user_{self.alice.id}", {"type": "mention_notification",
+                                                                            "room_id": self.room.id})
+            self.assertEqual((await communicator.receive_json_from(timeout=2))["type"], "mention_notification")
+        finally:
+            await communicator.disconnect()
+        await asyncio.sleep(0.2)  # grace period and last-seen flush
+        await self.alice.arefresh_from_db()
+        self.assertIsNotNone(self.alice.last_seen)
+        self.assertFalse(self.alice.is_online)
+
+
+class RoomMessagesQueryTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def fill(self, count):
+        from .models import MessageReaction
+        previous = None
+        for i in range(count):
+            sender = self.alice if i % 2 else self.bob
+            message = Message.objects.create(
+                chat_room=self.room, sender=sender, content=f"m{i}", reply_to=previous
+            )
+            MessageReaction.objects.create(message=message, user=self.bob, emoji="👍")
+            if i % 3 == 0:
+                self.room.pinned_messages.add(message)
+            previous = message
+
+    def queries_for_page(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f"/api/chat/rooms/{self.room.id}/messages/?page_size=100")
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data["results"]
+
+    def test_page_costs_constant_queries(self):
+        self.fill(3)
+        small, _ = self.queries_for_page()
+        Message.objects.all().delete()
+        self.fill(60)
+        large, results = self.queries_for_page()
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 10)
+
+        newest = results[0]
+        self.assertEqual(newest["reply_to"]["content"], "m58")
+        self.assertEqual(newest["reactions"][0]["username"], "bob")
+        self.assertEqual(sum(1 for m in results if m["pinned"]), 20)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+        self.sent = [send(self.alice, self.room, f"m{i}").id for i in range(25)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+        self.url = f"/api/chat/rooms/{self.room.id}/messages/"
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def ids(self, page):
+        return [m["id"] for m in page["results"]]
+
+    def test_walks_history_without_gaps_while_new_messages_arrive(self):
+        page = self.get(self.url, before="", page_size=10)
+        self.assertIsNone(page["previous"])
+        seen = self.ids(page)
+        send(self.alice, self.room, "late")  # would shift a page-number listing
+        while page["next"]:
+            page = self.get(page["next"])
+            seen += self.ids(page)
+        self.assertEqual(seen, self.sent[::-1])
+
+    def test_after_returns_only_newer_messages_newest_first(self):
+        oldest_page = self.get(self.url, before="", page_size=20)
+        page = self.get(oldest_page["next"])
+        self.assertEqual(self.ids(page), self.sent[4::-1])
+        page = self.get(page["previous"] + "&page_size=3")
+        self.assertEqual(self.ids(page), self.sent[7:4:-1])
+        self.assertIsNotNone(page["previous"])
+
+    def test_page_numbers_still_work_and_bad_cursors_are_rejected(self):
+        self.assertEqual(self.get(self.url, page=2, page_size=10)["count"], 25)
+        self.assertEqual(self.client.get(self.url, {"before": "nonsense"}).status_code, 400)
+
+
+class RoomListQueryTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+        self.me = make_user("me")
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def add_private_rooms(self, start, count):
+        from apps.contacts.models import Contact
+        for i in range(start, start + count):
+            other = make_user(f"friend{i}")
+            room = ChatRoom.objects.create(room_type="private")
+            ChatParticipant.objects.create(chat_room=room, user=self.me)
+            ChatParticipant.objects.create(chat_room=room, user=other)
+            send(other, room, f"hi {i}")
+            if i % 2 == 0:
+                Contact.objects.create(owner=self.me, contact_user=other, nickname=f"buddy{i}")
+
+    def load(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/api/chat/rooms/")
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data["results"]
+
+    def test_room_list_costs_constant_queries(self):
+        self.add_private_rooms(0, 2)
+        make_group([self.me, make_user("g1"), make_user("g2")])
+        small, _ = self.load()
+        self.add_private_rooms(2, 15)
+        large, rooms = self.load()
+        self.assertEqual(small, large)
+
+        by_other = {room["other_user_id"]: room for room in rooms if not room["is_group"]}
+        friend4 = User.objects.get(username="friend4")
+        friend5 = User.objects.get(username="friend5")
+        self.assertEqual(by_other[friend4.id]["display_name"], "buddy4")
+        self.assertEqual(by_other[friend5.id]["display_name"], "friend5")
+        self.assertEqual(by_other[friend5.id]["unread_count"], 1)
+        self.assertEqual(by_other[friend5.id]["last_message"], "hi 5")
+
+    def test_presence_comes_from_the_presence_store(self):
+        from asgiref.sync import async_to_sync
+        from django.core.cache import caches
+        from django.utils import timezone
+        self.addCleanup(caches["default"].clear)
+        self.add_private_rooms(0, 3)
+        online, away, never = (User.objects.get(username=f"friend{i}") for i in range(3))
+        left_at = timezone.now()
+        async_to_sync(presence_registry.connect)(online.id)
+        async_to_sync(presence_registry.cache.aset)(presence_state._last_seen_key(away.id), left_at)
+
+        rooms = self.client.get("/api/chat/rooms/").data["results"]
+        by_other = {room["other_user_id"]: room for room in rooms}
+        self.assertTrue(by_other[online.id]["is_online"])
+        self.assertFalse(by_other[away.id]["is_online"])
+        self.assertEqual(by_other[away.id]["last_seen"], left_at)
+        self.assertIsNone(by_other[never.id]["last_seen"])
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+        self.alice, self.bob, self.mallory = make_user("alice"), make_user("bob"), make_user("mallory")
+        self.room = make_group([self.alice, self.bob])
+        self.other = make_group([self.alice, self.mallory], "other")
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def hits(self, url, q):
+        response = self.client.get(url, {"q": q})
+        self.assertEqual(response.status_code, 200)
+        return [m["content"] for m in response.data["results"]]
+
+    def check_backend(self):
+        room_url = f"/api/chat/rooms/{self.room.id}/search/"
+        send(self.alice, self.room, "Meeting tomorrow at the café")
+        send(self.bob, self.room, "meeting meeting meeting")
+        send(self.alice, self.room, "the meetings were long, tomorrow too")
+        send(self.alice, self.other, "secret meeting tomorrow")
+        edited = send(self.alice, self.room, "lunch plans")
+        gone = send(self.alice, self.room, "lunch is cancelled")
+
+        # Prefix on every word, all words required, accents folded, ranked.
+        self.assertCountEqual(self.hits(room_url, "meet TOM"), [
+            "Meeting tomorrow at the café", "the meetings were long, tomorrow too",
+        ])
+        self.assertEqual(self.hits(room_url, "cafe"), ["Meeting tomorrow at the café"])
+        self.assertEqual(self.hits(room_url, "meeting")[0], "meeting meeting meeting")
+
+        self.client.force_authenticate(self.alice)
+        self.client.post("/api/chat/messages/edit/", {"message_id": edited.id, "new_content": "dinner plans"})
+        self.client.post("/api/chat/messages/delete/", {"message_id": gone.id})
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.hits(room_url, "lunch"), [])
+        self.assertEqual(self.hits(room_url, "dinner"), ["dinner plans"])
+
+        # Other people's rooms are neither searchable directly nor included globally.
+        self.assertEqual(self.client.get(f"/api/chat/rooms/{self.other.id}/search/", {"q": "secret"}).status_code, 403)
+        self.assertEqual(self.hits("/api/chat/search/", "secret"), [])
+        self.client.force_authenticate(self.alice)
+        everywhere = self.client.get("/api/chat/search/", {"q": "tomorrow", "page_size": 2}).data
+        self.assertEqual(everywhere["count"], 3)
+        self.assertEqual(len(everywhere["results"]), 2)
+        self.assertIn(self.other.id, {m["room_id"] for m in self.client.get("/api/chat/search/", {"q": "secret"}).data["results"]})
+
+    def test_fts5_index(self):
+        self.assertTrue(search.fts5_available())
+        with override_settings(CHAT_SEARCH_BACKEND="fts5"):
+            self.check_backend()
+            self.assertEqual(self.client.delete(f"/api/chat/rooms/{self.other.id}/delete/").status_code, 204)
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT count(*) FROM {search.FTS_TABLE} WHERE chat_room_id = %s", [self.other.id])
+                self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_postings_index(self):
+        with override_settings(CHAT_SEARCH_BACKEND="postings"):
+            self.check_backend()
+            self.assertEqual(search.rebuild(batch_size=2), 5)
+            # Term frequency, then exact over prefix matches, then newest first.
+            self.assertEqual(self.hits("/api/chat/search/", "meeting"), [
+                "meeting meeting meeting", "secret meeting tomorrow", "Meeting tomorrow at the café",
+                "the meetings were long, tomorrow too",
+            ])
+            self.other.delete()  # postings go with their messages
+            self.assertEqual(self.hits("/api/chat/search/", "secret"), [])
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = make_user("alice"), make_user("bob"), make_user("carol")
+        self.room = make_group([self.alice, self.bob, self.carol])
+
+    def unread(self, user):
+        return ChatParticipant.objects.get(chat_room=self.room, user=user).unread_count
+
+    def test_unread_count_is_range_over_watermark(self):
+        first = send(self.alice, self.room, "one")
+        send(self.alice, self.room, "two")
+        send(self.bob, self.room, "three")
+        self.assertEqual(self.unread(self.carol), 3)
+        # Sending implies having read everything before it.
+        self.assertEqual(self.unread(self.bob), 0)
+
+        read_state.mark_read(self.carol.id, self.room.id, first.id)
+        self.assertEqual(self.unread(self.carol), 2)
+        self.assertEqual(self.unread(self.alice), 1)
+
+    def test_watermarks_never_move_backwards_or_across_rooms(self):
+        first = send(self.alice, self.room, "one")
+        second = send(self.alice, self.room, "two")
+        other_room = make_group([self.alice, self.bob], "other")
+        foreign = send(self.alice, other_room, "elsewhere")
+
+        read_state.mark_read(self.bob.id, self.room.id, second.id)
+        read_state.mark_read(self.bob.id, self.room.id, first.id)
+        read_state.mark_read(self.bob.id, self.room.id, foreign.id)
+        bob = ChatParticipant.objects.get(chat_room=self.room, user=self.bob)
+        self.assertEqual(bob.last_read_message_id, second.id)
+        self.assertEqual(bob.last_delivered_message_id, second.id)
+
+    def test_deliver_pending_returns_and_advances(self):
+        first = send(self.alice, self.room, "one")
+        second = send(self.bob, self.room, "two")
+        pending = read_state.deliver_pending(self.carol)
+        self.assertEqual(pending, [(first.id, self.alice.id), (second.id, self.bob.id)])
+        self.assertEqual(read_state.deliver_pending(self.carol), [])
+
+        delivered, read = read_state.room_watermarks(self.room.id, self.alice)
+        self.assertEqual(read, 0)
+        self.assertEqual(delivered, second.id)
+
+
+class InboxCounterTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+        self.client = APIClient()
+
+    def unread(self, user):
+        return ChatParticipant.objects.get(chat_room=self.room, user=user).unread_count
+
+    def test_edit_and_delete_keep_preview_and_unread_in_step(self):
+        send(self.alice, self.room, "one")
+        last = send(self.alice, self.room, "two")
+        self.assertEqual(self.unread(self.bob), 2)
+
+        self.client.force_authenticate(self.alice)
+        self.client.post("/api/chat/messages/edit/", {"message_id": last.id, "new_content": "two!"})
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.last_message_id, self.room.last_message_preview), (last.id, "two!"))
+
+        for _ in range(2):  # deleting twice must only count once
+            self.client.post("/api/chat/messages/delete/", {"message_id": last.id})
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.last_message_preview)
+        self.assertEqual(self.unread(self.bob), 1)
+        self.assertEqual(read_state.reconcile_counters(), (0, 0))
+
+    def test_reconcile_repairs_drift(self):
+        message = send(self.alice, self.room, "hello")
+        ChatParticipant.objects.filter(chat_room=self.room).update(unread_count=7)
+        ChatRoom.objects.filter(id=self.room.id).update(last_message=None, last_message_preview="stale")
+
+        self.assertEqual(read_state.reconcile_counters(), (1, 2))
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.last_message_id, self.room.last_message_preview), (message.id, "hello"))
+        self.assertEqual((self.unread(self.alice), self.unread(self.bob)), (0, 1))
+
+    def test_new_member_starts_with_nothing_unread(self):
+        send(self.alice, self.room, "before you joined")
+        carol = make_user("carol")
+        self.client.force_authenticate(self.alice)
+        self.client.post(f"/api/chat/rooms/{self.room.id}/add_member/", {"user_id": carol.id})
+        self.assertEqual(self.unread(carol), 0)
+        self.assertEqual(read_state.reconcile_counters(), (0, 0))
+
+
+class DeliveryReceiptTests(TestCase):
+    def test_receipts_coalesce_per_sender_with_one_update(self):
+        from asgiref.sync import async_to_sync
+        from channels.layers import InMemoryChannelLayer
+
+        alice, bob, carol = make_user("alice"), make_user("bob"), make_user("carol")
+        room = make_group([alice, bob, carol])
+        sent = [send(alice, room, "a1"), send(bob, room, "b1"), send(alice, room, "a2")]
+        layer = InMemoryChannelLayer()
+
+        async def deliver():
+            channels = {}
+            for user in (alice, bob):
+                channels[user.id] = await layer.new_channel()
+                await layer.group_add(f"user_{user.id}", channels[user.id])
+            batcher = DeliveryReceiptBatcher(layer, carol, window=60)
+            for message in sent:
+                batcher.add(message.sender_id, room.id, message.id)
+            await batcher.close()
+            return {uid: await layer.receive(channel) for uid, channel in channels.items()}
+
+        with CaptureQueriesContext(connection) as ctx:
+            received = async_to_sync(deliver)()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        self.assertEqual(received[alice.id]["type"], "delivered_receipts")
+        self.assertEqual(received[alice.id]["message_ids"], [sent[0].id, sent[2].id])
+        self.assertEqual(received[bob.id]["message_ids"], [sent[1].id])
+
+        carol_state = ChatParticipant.objects.get(chat_room=room, user=carol)
+        self.assertEqual(carol_state.last_delivered_message_id, sent[2].id)
+        self.assertEqual(carol_state.last_read_message_id, 0)
+
+    def test_receipts_that_fail_to_save_are_kept_for_the_next_flush(self):
+        from asgiref.sync import async_to_sync
+        from channels.layers import InMemoryChannelLayer
+
+        alice, carol = make_user("alice"), make_user("carol")
+        room = make_group([alice, carol])
+        message = send(alice, room, "a1")
+        layer = InMemoryChannelLayer()
+        save, attempts = read_state.mark_delivered_many, []
+
+        def flaky_save(*args):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise OperationalError("database is locked")
+            return save(*args)
+
+        async def deliver():
+            channel = await layer.new_channel()
+            await layer.group_add(f"user_{alice.id}", channel)
+            batcher = DeliveryReceiptBatcher(layer, carol, window=60)
+            batcher.add(alice.id, room.id, message.id)
+            with mock.patch.object(read_state, "mark_delivered_many", side_effect=flaky_save):
+                with self.assertRaises(OperationalError):
+                    await batcher.flush()
+                await batcher.close()
+            return await layer.receive(channel)
+
+        received = async_to_sync(deliver)()
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(received["message_ids"], [message.id])
+        carol_state = ChatParticipant.objects.get(chat_room=room, user=carol)
+        self.assertEqual(carol_state.last_delivered_message_id, message.id)
+
+
+@unittest.skipUnless(importlib.util.find_spec("channels_redis"), "channels_redis not installed")
+class MultiWorkerFanOutTests(SimpleTestCase):
+    """Two 'workers' sharing state only through the Redis stand-in."""
+
+    async def start_standin(self):
+        self.standin = RedisStandIn()
+        await self.standin.start()
+        self.url = f"redis://127.0.0.1:{self.standin.port}/0"
+
+    def make_layer(self):
+        from .layers import RedisPubSubChannelLayer
+        return RedisPubSubChannelLayer(hosts=[self.url])
+
+    def make_registry(self):
+        from django.core.cache.backends.redis import RedisCache
+        return PresenceRegistry(cache=RedisCache(self.url, {}))
+
+    async def test_group_send_reaches_other_worker(self):
+        await self.start_standin()
+        worker_a, worker_b = self.make_layer(), self.make_layer()
+        try:
+            channel = await worker_a.new_channel()
+            await worker_a.group_add("user_42", channel)
+            await asyncio.sleep(0.2)  # let the subscription land
+
+            await worker_b.group_send("user_42", {"type": "new_message_notification", "room_id": 7})
+            event = await asyncio.wait_for(worker_a.receive(channel), timeout=5)
+            self.assertEqual(event["room_id"], 7)
+        finally:
+            await worker_a.flush()
+            await worker_b.flush()
+            await self.standin.close()
+
+    async def test_group_send_many_reaches_every_group(self):
+        await self.start_standin()
+        worker_a, worker_b = self.make_layer(), self.make_layer()
+        try:
+            channels = {}
+            for user_id in range(1, 6):
+                channels[user_id] = await worker_a.new_channel()
+                await worker_a.group_add(f"user_{user_id}", channels[user_id])
+            await asyncio.sleep(0.2)
+
+            await group_send_many(worker_b, user_groups(channels, exclude=3), {"type": "ping"})
+            for user_id, channel in channels.items():
+                if user_id == 3:
+                    continue
+                event = await asyncio.wait_for(worker_a.receive(channel), timeout=5)
+                self.assertEqual(event["type"], "ping")
+        finally:
+            await worker_a.flush()
+            await worker_b.flush()
+            await self.standin.close()
+
+    async def test_group_send_many_falls_back_without_channels_redis_internals(self):
+        await self.start_standin()
+        worker_a, worker_b = self.make_layer(), self.make_layer()
+        real_layer = worker_b._get_layer
+
+        class WithoutShards:
+            """The real per-loop layer, as if a release had renamed ``_get_shard``."""
+
+            def __getattr__(self, name):
+                if name == "_get_shard":
+                    raise AttributeError(name)
+                return getattr(real_layer(), name)
+
+        worker_b._get_layer = WithoutShards
+        try:
+            channels = {user_id: await worker_a.new_channel() for user_id in (1, 2)}
+            for user_id, channel in channels.items():
+                await worker_a.group_add(f"user_{user_id}", channel)
+            await asyncio.sleep(0.2)
+
+            await group_send_many(worker_b, user_groups(channels), {"type": "ping"})
+            for channel in channels.values():
+                self.assertEqual((await asyncio.wait_for(worker_a.receive(channel), timeout=5))["type"], "ping")
+            self.assertTrue(worker_b.batching_unavailable)
+        finally:
+            await worker_a.flush()
+            await worker_b.flush()
+            await self.standin.close()
+
+    async def test_presence_is_shared_between_workers(self):
+        await self.start_standin()
+        worker_a, worker_b = self.make_registry(), self.make_registry()
+        try:
+            self.assertTrue(await worker_a.connect(1))
+            self.assertFalse(await worker_b.connect(1))
+            self.assertEqual(await worker_b.online_user_ids([1, 2]), {1})
+
+            self.assertFalse(await worker_a.disconnect(1))
+            self.assertTrue(await worker_b.is_online(1))
+            self.assertTrue(await worker_b.disconnect(1))
+            self.assertFalse(await worker_a.is_online(1))
+            self.assertTrue(await worker_a.connect(1))
+        finally:
+            await self.standin.close()
+
+
+class FanOutTests(SimpleTestCase):
+    async def test_falls_back_to_concurrent_group_send(self):
+        from channels.layers import InMemoryChannelLayer
+        layer = InMemoryChannelLayer()
+        channels = [await layer.new_channel() for _ in range(3)]
+        for user_id, channel in enumerate(channels):
+            await layer.group_add(f"user_{user_id}", channel)
+
+        await group_send_many(layer, ["user_0", "user_1", "user_1", "user_2"], {"type": "ping"})
+        for channel in channels:
+            self.assertEqual((await layer.receive(channel))["type"], "ping")
+        self.assertTrue(all(queue.empty() for queue in layer.channels.values()))
+
+
+class LocalPresenceTests(SimpleTestCase):
+    async def test_counts_connections_per_user(self):
+        from django.core.cache.backends.locmem import LocMemCache
+        registry = PresenceRegistry(cache=LocMemCache("presence-test", {}))
+        self.assertTrue(await registry.connect(5))
+        self.assertFalse(await registry.connect(5))
+        self.assertFalse(await registry.disconnect(5))
+        self.assertEqual(await registry.online_user_ids([5, 6]), {5})
+        self.assertTrue(await registry.disconnect(5))
+        self.assertEqual(await registry.online_user_ids([5]), set())
+
+
+class PresenceServiceTests(SimpleTestCase):
+    def setUp(self):
+        from channels.layers import InMemoryChannelLayer
+        from django.core.cache.backends.locmem import LocMemCache
+        self.layer = InMemoryChannelLayer()
+        self.service = PresenceService(PresenceRegistry(cache=LocMemCache(f"presence-{id(self)}", {})),
+                                       grace=0.1, window=0.05)
+
+    async def inbox(self, user_id):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add(f"user_{user_id}", channel)
+        return channel
+
+    async def drain(self, channel):
+        events = []
+        while True:
+            try:
+                events.append(await asyncio.wait_for(self.layer.receive(channel), 0.05))
+            except asyncio.TimeoutError:
+                return events
+
+    async def test_changes_are_batched_per_recipient_and_scoped(self):
+        friend, stranger = await self.inbox(3), await self.inbox(9)
+        other = await self.inbox(4)
+        self.assertEqual(await self.service.connected(self.layer, 1, [3, 4]), set())
+        await self.service.connected(self.layer, 2, [3])
+        self.assertEqual(await self.service.connected(self.layer, 3, [1, 2]), {1, 2})
+        await asyncio.sleep(0.1)
+
+        self.assertEqual([(e["online"], e["offline"]) for e in await self.drain(friend)], [([1, 2], [])])
+        self.assertEqual([e["online"] for e in await self.drain(other)], [[1]])
+        self.assertEqual(await self.drain(stranger), [])
+
+    async def test_reconnect_within_grace_is_not_announced(self):
+        friend = await self.inbox(3)
+        await self.service.connected(self.layer, 1, [3])
+        await asyncio.sleep(0.1)
+        await self.drain(friend)
+
+        for _ in range(3):  # a flapping connection
+            self.assertTrue(await self.service.disconnected(self.layer, 1, [3]))
+            await self.service.connected(self.layer, 1, [3])
+        await asyncio.sleep(0.2)
+        self.assertEqual(await self.drain(friend), [])
+
+        await self.service.disconnected(self.layer, 1, [3])
+        await asyncio.sleep(0.2)
+        self.assertEqual([(e["online"], e["offline"]) for e in await self.drain(friend)], [([], [1])])
+
+
+class PresenceStateStoreTests(TransactionTestCase):
+    def test_changes_are_saved_in_one_batch(self):
+        from django.core.cache.backends.locmem import LocMemCache
+        from django.utils import timezone
+        users = [make_user(f"user{i}") for i in range(5)]
+        store = PresenceStateStore(PresenceRegistry(cache=LocMemCache("presence-state-test", {})), interval=0.05)
+        left_at = timezone.now()
+
+        async def scenario():
+            for user in users[:3]:
+                await store.went_online(user.id)
+            for user in users[1:3]:
+                await store.seen(user.id, left_at)
+                await store.went_offline(user.id)
+            await store.seen(users[3].id, left_at)  # reconnected within the grace period
+            self.assertEqual(await User.objects.filter(is_online=True).acount(), 0)  # not written yet
+            await asyncio.sleep(0.2)
+
+        asyncio.run(scenario())
+        saved = {u.id: (u.is_online, u.last_seen) for u in User.objects.filter(id__in=[u.id for u in users])}
+        self.assertEqual(saved[users[0].id], (True, None))
+        self.assertEqual(saved[users[1].id], (False, left_at))
+        self.assertEqual(saved[users[3].id], (False, left_at))
+        self.assertEqual(saved[users[4].id], (False, None))
+        self.assertEqual(store.lookup([users[1].id, users[4].id]), {
+            users[1].id: {"is_online": False, "last_seen": left_at},
+            users[4].id: {"is_online": False, "last_seen": None},
+        })
+
+
+class RelatedUsersIndexTests(TestCase):
+    def setUp(self):
+        from apps.contacts.models import Contact
+        self.me = make_user("me")
+        self.mates = [make_user(f"mate{i}") for i in range(6)]
+        self.rooms = [make_group([self.me, *self.mates[i:i + 2]], f"g{i}") for i in range(0, 6, 2)]
+        self.friend, self.fan, self.stranger = make_user("friend"), make_user("fan"), make_user("stranger")
+        Contact.objects.create(owner=self.me, contact_user=self.friend)
+        Contact.objects.create(owner=self.fan, contact_user=self.me)
+        self.index = RelatedUsersIndex()
+
+    def ids(self, *users):
+        return {user.id for user in users}
+
+    def test_one_query_then_served_from_memory(self):
+        with CaptureQueriesContext(connection) as ctx:
+            related = self.index.get(self.me.id)
+            self.assertEqual(self.index.get(self.me.id), related)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(related, self.ids(*self.mates, self.friend, self.fan))
+
+    def test_changes_update_cached_sets(self):
+        from apps.contacts.models import Contact
+        self.index.get(self.me.id)
+        self.index.get(self.mates[0].id)
+        newcomer = make_user("newcomer")
+        ChatParticipant.objects.create(chat_room=self.rooms[0], user=newcomer)
+        self.index.joined(self.rooms[0].id, [newcomer.id])
+        Contact.objects.create(owner=self.stranger, contact_user=self.mates[0])
+        self.index.contact_added(self.stranger.id, self.mates[0].id)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertIn(newcomer.id, self.index.get(self.me.id))
+            self.assertEqual(self.index.get(self.mates[0].id), self.ids(self.me, self.mates[1], newcomer, self.stranger))
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+        ChatParticipant.objects.filter(chat_room=self.rooms[1], user=self.mates[2]).delete()
+        self.index.left(self.rooms[1].id, [str(self.mates[2].id)])
+        self.assertNotIn(self.mates[2].id, self.index.get(self.me.id))
+        self.assertEqual(self.index.get(self.mates[2].id), set())
+
+    def test_least_recently_used_entries_are_evicted(self):
+        index = RelatedUsersIndex(max_entries=2)
+        index.get(self.me.id)
+        index.get(self.mates[0].id)
+        index.get(self.me.id)
+        index.get(self.mates[1].id)
+        self.assertEqual(list(index.entries), [self.me.id, self.mates[1].id])
+
+
+class GhostSuggestionTests(SimpleTestCase):
+    def scheduler(self, latency=0.0):
+        self.sent, self.calls, self.cancelled, self.contexts = [], [], [], 0
+
+        async def load_context():
+            self.contexts += 1
+            return "alice: dinner?"
+
+        async def generate(partial, context, lang):
+            self.calls.append(partial)
+            try:
+                await asyncio.sleep(latency)
+            except asyncio.CancelledError:
+                self.cancelled.append(partial)
+                raise
+            return "tomorrow at 5"
+
+        async def send(partial, continuation):
+            self.sent.append((partial, continuation))
+
+        self.metrics = SuggestionMetrics()
+        return GhostSuggestionScheduler(load_context, generate, send, debounce=0.02,
+                                        cache=SuggestionCache(100), metrics=self.metrics)
+
+    def test_keystroke_burst_makes_one_call_and_stale_calls_are_cancelled(self):
+        async def scenario():
+            scheduler = self.scheduler(latency=0.1)
+            for partial in ("see", "see y", "see yo", "see you"):
+                await scheduler.submit(partial, "en")
+                await asyncio.sleep(0.005)
+            await asyncio.sleep(0.05)  # "see you" is now at the model...
+            await scheduler.submit("see you at", "en")  # ...and this supersedes it
+            await asyncio.sleep(0.2)
+
+        asyncio.run(scenario())
+        self.assertEqual(self.calls, ["see you", "see you at"])
+        self.assertEqual(self.cancelled, ["see you"])
+        self.assertEqual(self.sent, [("see you at", "tomorrow at 5")])
+        self.assertEqual(self.contexts, 1)
+
+    def test_cached_and_extended_partials_skip_the_model(self):
+        async def scenario():
+            scheduler = self.scheduler()
+            await scheduler.submit("see you", "en")
+            await asyncio.sleep(0.05)
+            await scheduler.submit("see you", "en")  # exact hit
+            await scheduler.submit("see you tom", "en")  # typed into the suggestion
+            await scheduler.submit("see you later", "en")  # typed something else
+            await asyncio.sleep(0.05)
+            scheduler.invalidate_context()  # reloaded, but unchanged: still a hit
+            await scheduler.submit("see you", "en")
+            await asyncio.sleep(0.05)
+
+        asyncio.run(scenario())
+        self.assertEqual(self.calls, ["see you", "see you later"])
+        self.assertEqual(self.sent[1:3], [("see you", "tomorrow at 5"), ("see you tom", "orrow at 5")])
+        stats = self.metrics.snapshot()
+        self.assertEqual((stats["model"], stats["hit"], stats["prefix"]), (2, 2, 1))
+        self.assertEqual(stats["hit_rate"], 0.6)
+        self.assertIsNotNone(stats["p95_ms"])
+
+    def test_streamed_suggestion_sends_deltas_then_the_whole_continuation(self):
+        deltas = []
+
+        async def stream(partial, context, lang):
+            for word in (" tomorrow", " at", " 5"):
+                yield word
+
+        async def send_delta(partial, delta):
+            deltas.append(delta)
+
+        async def scenario():
+            scheduler = self.scheduler()
+            scheduler.stream, scheduler.send_delta = stream, send_delta
+            await scheduler.submit("see you", "en", streaming=True)
+            await asyncio.sleep(0.05)
+            await scheduler.submit("see you tom", "en", streaming=True)  # served from the cache
+
+        asyncio.run(scenario())
+        self.assertEqual(deltas, ["tomorrow", " at", " 5"])
+        self.assertEqual(self.sent, [("see you", "tomorrow at 5"), ("see you tom", "orrow at 5")])
+        self.assertEqual(self.calls, [])
+
+    def test_extend_suggestion(self):
+        self.assertEqual(extend_suggestion("hel", "lo there", "hello t"), "here")
+        self.assertEqual(extend_suggestion("see you", "tomorrow", "see you "), "tomorrow")
+        self.assertIsNone(extend_suggestion("see you", "tomorrow", "see you tomorrow"))
+        self.assertIsNone(extend_suggestion("see you", "tomorrow", "see you later"))
+
+
+class PreTranslationTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+
+    def test_fast_translations_ride_along_and_slow_ones_follow(self):
+        message = send(self.alice, self.room, "good morning")
+
+        async def translate(text, lang, source_lang):
+            await asyncio.sleep(0.01 if lang == "hi" else 0.2)
+            return text if lang == "ta" else f"{text} [{lang}]"  # "ta" fails: original text back
+
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add("chat_test", channel)
+            pretranslation = PreTranslation("good morning", target_languages(["en", "hi", "kn", "ta", "en"], "en"),
+                                            "en", translate=translate)
+            await asyncio.sleep(0.1)  # the broadcast goes out with whatever is done by then
+            sent = pretranslation.ready()
+            await pretranslation.complete(layer, "chat_test", message.id, sent)
+            return sent, await asyncio.wait_for(layer.receive(channel), 1)
+
+        sent, event = asyncio.run(scenario())
+        self.assertEqual(sent, {"hi": "good morning [hi]"})
+        self.assertEqual(event["type"], "message_translated")
+        self.assertEqual(event["translations"], {"kn": "good morning [kn]"})
+        message.refresh_from_db()
+        self.assertEqual(message.translations, {"hi": "good morning [hi]", "kn": "good morning [kn]"})
+
+    def test_nothing_to_do(self):
+        async def start(languages, enabled=True, message_type="text"):
+            with self.settings(CHAT_PRETRANSLATE=enabled):
+                return PreTranslation.start("hello", languages, "en", message_type)
+
+        self.assertIsNone(asyncio.run(start({"en", "hi"}, enabled=False)))
+        self.assertIsNone(asyncio.run(start({"en"})))
+        self.assertIsNone(asyncio.run(start({"en", "hi"}, message_type="voice")))
+
+    def test_cancel_stops_pending_translations(self):
+        started, finished = [], []
+
+        async def translate(text, lang, source_lang):
+            started.append(lang)
+            await asyncio.sleep(0.2)
+            finished.append(lang)
+            return f"{text} [{lang}]"
+
+        async def scenario():
+            pretranslation = PreTranslation("hello", ["hi", "kn"], "en", translate=translate)
+            await asyncio.sleep(0)
+            pretranslation.cancel()
+            await asyncio.sleep(0.3)
+            return pretranslation.ready()
+
+        self.assertEqual(asyncio.run(scenario()), {})
+        self.assertEqual(started, ["hi", "kn"])
+        self.assertEqual(finished, [])
+
+
+class RoomAnalyzerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = make_user("alice"), make_user("bob"), make_user("carol")
+        User.objects.filter(id=self.bob.id).update(preferred_language="hi")
+        self.room = make_group([self.alice, self.bob, self.carol])
+        self.ids = {self.alice.id, self.bob.id, self.carol.id}
+
+    def message(self, i, sender, content):
+        return {"id": i, "content": content, "sender": {"id": sender.id}, "message_type": "text"}
+
+    def test_burst_is_analysed_once_per_language_and_fanned_out_to_everyone(self):
+        calls = []
+
+        async def analyze(conversation, lang):
+            calls.append((conversation.count("\n") + 1, lang))
+            score = 80 if len(calls) <= 2 else 40
+            return {"mood": {"score": score, "label": "x"}, "replies": [f"ok ({lang})"], "suggestions": []}
+
+        async def scenario():
+            layer = get_channel_layer()
+            inboxes = {}
+            for user in (self.alice, self.bob, self.carol):
+                inboxes[user.id] = await layer.new_channel()
+                await layer.group_add(f"user_{user.id}", inboxes[user.id])
+            analyzer = RoomAnalyzer(analyze=analyze, window=0.05)
+
+            for i in range(10):
+                sender = self.alice if i % 2 else self.bob
+                analyzer.add(layer, self.room.id, self.message(i + 1, sender, f"message number {i} is here"), self.ids)
+            await asyncio.sleep(0.2)
+            analyzer.add(layer, self.room.id, self.message(11, self.bob, "ok"), self.ids)  # not worth a call
+            await analyzer.flush_all()
+            analyzer.add(layer, self.room.id, self.message(12, self.bob, "how about sunday?"), self.ids)
+            await analyzer.flush_all()
+
+            received = {}
+            for user_id, channel in inboxes.items():
+                events = []
+                while True:
+                    try:
+                        events.append(await asyncio.wait_for(layer.receive(channel), 0.05))
+                    except asyncio.TimeoutError:
+                        break
+                received[user_id] = events
+            return analyzer, received
+
+        analyzer, received = asyncio.run(scenario())
+        # 12 messages, 3 model calls: one window read in two languages, one skipped, one more.
+        self.assertCountEqual(calls[:2], [(6, "en"), (6, "hi")])
+        self.assertEqual(calls[2:], [(6, "en")])
+        self.assertEqual(analyzer.counts["skipped"], 1)
+
+        def of(user, kind):
+            return [e for e in received[user.id] if e["type"] == kind]
+
+        self.assertEqual([e["replies"] for e in of(self.bob, "ai_suggestions")], [["ok (hi)"]])
+        self.assertEqual([e["replies"] for e in of(self.carol, "ai_suggestions")], [["ok (en)"], ["ok (en)"]])
+        self.assertEqual([e["message_id"] for e in of(self.alice, "ai_suggestions")], [12])  # not to the last sender
+        self.assertEqual([e["summary"] for e in of(self.carol, "ai_summary")],
+                         [{"score": 80, "label": "positive"}, {"score": 60, "label": "positive"}])
+        self.assertEqual(len(of(self.bob, "ai_summary")), 2)
+
+
+@override_settings(SUMMARY_BLOCK_SIZE=5, SUMMARY_FANOUT=2)
+class SummaryTreeTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user("alice"), make_user("bob")
+        self.room = make_group([self.alice, self.bob])
+        self.calls = []
+
+        async def summarize(lines, lang):
+            self.calls.append((lines, lang))
+            return f"summary {len(self.calls)}"
+
+        self.tree = SummaryTree(summarize=summarize)
+        self.messages = [send(self.alice, self.room, f"message {i}") for i in range(23)]
+
+    def update(self):
+        self.calls.clear()
+        return asyncio.run(self.tree.update(self.room.id))
+
+    def test_blocks_are_summarized_once_and_merged_upward(self):
+        self.assertEqual(self.update(), 7)  # 4 blocks of 5, 2 merges of 2, 1 root
+        self.assertEqual([len(lines) for lines, _ in self.calls], [5, 5, 5, 5, 2, 2, 2])
+        self.assertEqual(self.calls[4][0][0], "[Summary of 5 earlier messages] summary 1")
+        self.assertEqual(self.update(), 0)
+
+        for i in range(2):
+            self.messages.append(send(self.bob, self.room, f"late {i}"))
+        self.assertEqual(self.update(), 1)  # just the new block
+
+        invalidate_message(self.messages[6])  # edited: its block, the merge and the root go
+        self.assertEqual(self.update(), 3)
+        self.assertEqual(self.calls[0][0][1], "alice: message 6")
+
+    def test_catch_up_is_one_call_over_stored_summaries(self):
+        self.update()
+        self.calls.clear()
+        summary = asyncio.run(self.tree.catch_up(self.room.id, self.messages[1].id, "hi"))
+        self.assertEqual(summary, "summary 1")
+        [(lines, lang)] = self.calls
+        self.assertEqual(lang, "hi")
+        # Raw 2-4, block 5-9, merged blocks 10-19, raw 20-22.
+        self.assertEqual(lines[:3], ["alice: message 2", "alice: message 3", "alice: message 4"])
+        self.assertEqual(lines[3:5], ["[Summary of 5 earlier messages] summary 2",
+                                      "[Summary of 10 earlier messages] summary 6"])
+        self.assertEqual(lines[5:], ["alice: message 20", "alice: message 21", "alice: message 22"])
+
+        self.assertIsNone(asyncio.run(self.tree.catch_up(self.room.id, self.messages[-1].id)))
 
-# Create your tests here.
@@ -18,11 +18,13 @@ from .views import (
     RemoveGroupMemberView,
     ForwardMultipleMessagesView,
     SearchMessagesView,
+    SearchAllMessagesView,
     PinMessageView,
     UnpinMessageView, 
     GiphySearchView, 
     StickerPackListView, 
-    StickerView
+    StickerView,
+    GhostSuggestionStatsView,
 )
 
 urlpatterns = [
@@ -43,10 +45,12 @@ urlpatterns = [
     path('rooms/<int:room_id>/exit/', ExitGroupView.as_view()),
     path('forward-multiple/', ForwardMultipleMessagesView.as_view()),
     path("rooms/<int:room_id>/search/", SearchMessagesView.as_view()),
+    path("search/", SearchAllMessagesView.as_view()),
     path("rooms/<int:room_id>/pin/<int:message_id>/", PinMessageView.as_view()),
     path("rooms/<int:room_id>/unpin/<int:message_id>/", UnpinMessageView.as_view()),
     path("giphy/search/", GiphySearchView.as_view()),
     path("stickers/", StickerPackListView.as_view()),
     path("stickers/<int:pk>/", StickerView.as_view()),
+    path("suggestions/stats/", GhostSuggestionStatsView.as_view()),
 ]
 
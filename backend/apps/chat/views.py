@@ -4,26 +4,41 @@ from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.parsers import MultiPartParser, JSONParser
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
-from django.db.models import Count, Q, OuterRef, Subquery, Prefetch
-from .pagination import ChatPagination
-from .models import ChatRoom, Message, MessageReadStatus, StickerPack, Sticker
+from django.db import transaction
+from django.db.models import F, Prefetch
+from .pagination import ChatPagination, MessageCursorPagination
+from .models import ChatRoom, Message, StickerPack, Sticker
 from .serializers import (
     CreatePrivateChatSerializer, CreateGroupChatSerializer, ChatRoomListSerializer,
-    RoomMessageSerializer, SendMessageSerializer, EditMessageSerializer,
+    RoomMessageSerializer, MessageSearchResultSerializer, SendMessageSerializer, EditMessageSerializer,
     DeleteMessageSerializer, LanguageSerializer, ParticipantSerializer,
     StickerSerializer,StickerPackSerializer
 )
+from .fanout import group_send_many, user_groups
+from .read_state import record_deleted_message, record_edited_message, record_new_message
+from .related import related_users
+from .search import index_message, search_messages, unindex_message, unindex_room
+from .summaries import invalidate_message as invalidate_summaries
+from .suggestions import suggestion_metrics
 from apps.ai.services import GroqService
+from apps.ai.translation_cache import translation_cache
 from .models import ChatRoom, ChatParticipant
 from django.contrib.auth import get_user_model
 from apps.accounts.serializers import UserSerializer
 import json 
 import requests
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
+def notify_membership_changed(room_id):
+    """Tell open chat sockets for the room to reload their cached participant list."""
+    async_to_sync(get_channel_layer().group_send)(
+        f"chat_{room_id}", {"type": "membership_changed", "room_id": room_id}
+    )
+
 class CreatePrivateChatView(generics.CreateAPIView):
     serializer_class = CreatePrivateChatSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -55,15 +70,16 @@ class UserChatRoomsView(generics.ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        latest_message = Message.objects.filter(chat_room=OuterRef("pk")).order_by("-created_at")
+        counterparts = ChatParticipant.objects.filter(
+            chat_room__room_type="private"
+        ).exclude(user=user).select_related("user")
+        # Last message and unread count are denormalized (see read_state), so
+        # this is a plain join on the user's participant rows.
         return ChatRoom.objects.filter(participants__user=user).annotate(
-            unread_count=Count(
-                "messages__read_status",
-                filter=Q(messages__read_status__user=user, messages__read_status__is_read=False)
-            ),
-            last_message=Subquery(latest_message.values("content")[:1]),
-            last_message_time=Subquery(latest_message.values("created_at")[:1])
-        ).distinct().order_by("-updated_at")
+            unread_count=F("participants__unread_count"),
+        ).prefetch_related(
+            Prefetch("participants", queryset=counterparts, to_attr="counterparts")
+        ).order_by("-updated_at")
 
 class RoomMessagesView(generics.ListAPIView):
     serializer_class = RoomMessageSerializer
@@ -78,19 +94,20 @@ class RoomMessagesView(generics.ListAPIView):
         if not room.participants.filter(user=user).exists():
             raise PermissionDenied("You are not part of this room.")
 
-        return (
-            Message.objects.filter(chat_room=room)
-            .select_related("sender")
-            .prefetch_related(
-                Prefetch(
-                    "read_status",
-                    queryset=MessageReadStatus.objects.filter(user=user),
-                    to_attr="user_status",
-                )
-            )
-            .order_by("-created_at")
+        return RoomMessageSerializer.eager_load(
+            Message.objects.filter(chat_room=room).order_by("-created_at", "-id")
         )
 
+    @property
+    def paginator(self):
+        # ?before= / ?after= switch to keyset pagination; plain ?page= keeps working.
+        if not hasattr(self, "_paginator"):
+            if MessageCursorPagination.requested(self.request):
+                self._paginator = MessageCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context.update({
@@ -124,9 +141,18 @@ class EditMessageView(generics.GenericAPIView):
         serializer = self.get_serializer(data=request.data, context={'user': request.user})
         serializer.is_valid(raise_exception=True)
         message = serializer.validated_data['message']
+        old_content = message.content
         message.content = serializer.validated_data['new_content']
         message.edited = True
-        message.save()
+        message.translations = {}
+        with transaction.atomic():
+            message.save()
+            record_edited_message(message)
+            index_message(message)
+            invalidate_summaries(message)
+            # Don't keep translations of text that no longer exists.
+            if old_content and old_content != message.content:
+                translation_cache.invalidate(old_content)
         return Response(RoomMessageSerializer(message).data, status=status.HTTP_200_OK)
 
 class DeleteMessageView(generics.GenericAPIView):
@@ -137,9 +163,16 @@ class DeleteMessageView(generics.GenericAPIView):
         serializer = self.get_serializer(data=request.data, context={'user': request.user})
         serializer.is_valid(raise_exception=True)
         message = serializer.validated_data['message']
+        already_deleted = message.is_deleted
         message.is_deleted = True
         message.content = None
-        message.save()
+        message.translations = {}
+        with transaction.atomic():
+            message.save()
+            if not already_deleted:
+                record_deleted_message(message)
+                unindex_message(message)
+                invalidate_summaries(message)
         return Response({"id": message.id, "is_deleted": True}, status=status.HTTP_200_OK)
 
 class ForwardMessageView(generics.GenericAPIView):
@@ -157,42 +190,31 @@ class ForwardMessageView(generics.GenericAPIView):
         if not target_room.participants.filter(user=request.user).exists():
             return Response({'error': 'Not a participant'}, status=403)
 
-        # Create forwarded message
-        new_message = Message.objects.create(
-            chat_room=target_room,
-            sender=request.user,
-            content=original.content,
-            forwarded=True,
-            forwarded_from=original
-        )
-        # Update room's updated_at
-        target_room.updated_at = timezone.now()
-        target_room.save(update_fields=['updated_at'])
-
-        # Create read status for all participants
-        for participant in target_room.participants.all():
-            MessageReadStatus.objects.create(
-                message=new_message,
-                user=participant.user,
-                is_read=(participant.user == request.user),
-                is_delivered=False
+        # Create forwarded message, read statuses and room bump in one go
+        with transaction.atomic():
+            new_message = Message.objects.create(
+                chat_room=target_room,
+                sender=request.user,
+                content=original.content,
+                forwarded=True,
+                forwarded_from=original
             )
+            record_new_message(new_message)
+            index_message(new_message, created=True)
 
         # Broadcast new_message_notification via global socket
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
-        channel_layer = get_channel_layer()
         serialized = RoomMessageSerializer(new_message).data
-        for participant in target_room.participants.all():
-            async_to_sync(channel_layer.group_send)(
-                f"user_{participant.user.id}",
-                {
-                    "type": "new_message_notification",
-                    "message": serialized,
-                    "room_id": target_room.id,
-                    "sender_id": request.user.id
-                }
-            )
+        participant_ids = target_room.participants.values_list("user_id", flat=True)
+        async_to_sync(group_send_many)(
+            get_channel_layer(),
+            user_groups(participant_ids),
+            {
+                "type": "new_message_notification",
+                "message": serialized,
+                "room_id": target_room.id,
+                "sender_id": request.user.id
+            }
+        )
 
         return Response(RoomMessageSerializer(new_message).data, status=201)
     
@@ -257,7 +279,12 @@ class DeleteRoomView(generics.DestroyAPIView):
                     {"error": "You are not a participant of this chat."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-        room.delete()
+        member_ids = list(room.participants.values_list("user_id", flat=True))
+        with transaction.atomic():
+            # The FTS5 table isn't a model, so the cascade doesn't reach it.
+            unindex_room(room.id)
+            room.delete()
+        related_users.room_deleted(member_ids)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class GroupMembersView(generics.ListAPIView):
@@ -278,7 +305,14 @@ class AddGroupMemberView(generics.GenericAPIView):
             return Response({"error": "Only creator can add members"}, status=403)
         user_id = request.data.get('user_id')
         user = get_object_or_404(User, id=user_id)
-        ChatParticipant.objects.get_or_create(chat_room=room, user=user)
+        # New members start at the current end of the room, so its history
+        # does not show up as unread.
+        ChatParticipant.objects.get_or_create(chat_room=room, user=user, defaults={
+            "last_read_message_id": room.last_message_id or 0,
+            "last_delivered_message_id": room.last_message_id or 0,
+        })
+        related_users.joined(room.id, [user.id])
+        notify_membership_changed(room.id)
         return Response({"status": "added"})
 
 class RemoveGroupMemberView(generics.GenericAPIView):
@@ -290,6 +324,8 @@ class RemoveGroupMemberView(generics.GenericAPIView):
             return Response({"error": "Permission denied"}, status=403)
         user_id = request.data.get('user_id')
         ChatParticipant.objects.filter(chat_room=room, user_id=user_id).delete()
+        related_users.left(room.id, [user_id])
+        notify_membership_changed(room.id)
         return Response({"status": "removed"})
 
 class PromoteAdminView(generics.GenericAPIView):
@@ -311,6 +347,8 @@ class ExitGroupView(generics.GenericAPIView):
         if room.creator == request.user:
             return Response({"error": "Creator cannot exit, must delete or transfer"}, status=400)
         ChatParticipant.objects.filter(chat_room=room, user=request.user).delete()
+        related_users.left(room.id, [request.user.id])
+        notify_membership_changed(room.id)
         return Response({"status": "exited"})
 
 class ForwardMultipleMessagesView(generics.GenericAPIView):
@@ -333,59 +371,63 @@ class ForwardMultipleMessagesView(generics.GenericAPIView):
 
             # Create forwarded message
             content = caption if caption else original.content
-            new_message = Message.objects.create(
-                chat_room=room,
-                sender=request.user,
-                content=content,
-                forwarded=True,
-                forwarded_from=original,
-                file=file if file and room_id == target_room_ids[0] else None,  # only attach file to first? Or duplicate? Better to handle file separately.
-            )
-            room.updated_at = timezone.now()
-            room.save(update_fields=['updated_at'])
-
-            # Create read statuses
-            for participant in room.participants.all():
-                MessageReadStatus.objects.create(
-                    message=new_message,
-                    user=participant.user,
-                    is_read=(participant.user == request.user),
-                    is_delivered=False
+            with transaction.atomic():
+                new_message = Message.objects.create(
+                    chat_room=room,
+                    sender=request.user,
+                    content=content,
+                    forwarded=True,
+                    forwarded_from=original,
+                    file=file if file and room_id == target_room_ids[0] else None,  # only attach file to first? Or duplicate? Better to handle file separately.
                 )
+                record_new_message(new_message)
+                index_message(new_message, created=True)
             created_messages.append(new_message)
 
         # Broadcast notifications for each room (optional)
-        from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
         channel_layer = get_channel_layer()
         for msg in created_messages:
             serialized = RoomMessageSerializer(msg, context={'request': request}).data
-            for participant in msg.chat_room.participants.all():
-                async_to_sync(channel_layer.group_send)(
-                    f"user_{participant.user.id}",
-                    {
-                        "type": "new_message_notification",
-                        "message": serialized,
-                        "room_id": msg.chat_room.id,
-                        "sender_id": request.user.id
-                    }
-                )
+            participant_ids = msg.chat_room.participants.values_list("user_id", flat=True)
+            async_to_sync(group_send_many)(
+                channel_layer,
+                user_groups(participant_ids),
+                {
+                    "type": "new_message_notification",
+                    "message": serialized,
+                    "room_id": msg.chat_room.id,
+                    "sender_id": request.user.id
+                }
+            )
 
         return Response({'status': 'forwarded', 'count': len(created_messages)}, status=201)
     
 
 class SearchMessagesView(generics.ListAPIView):
+    """Ranked full-text search within one room (see apps.chat.search)."""
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = RoomMessageSerializer
+    pagination_class = ChatPagination
 
-    def get_queryset(self):
+    def get_hits(self):
         room_id = self.kwargs['room_id']
-        q = self.request.query_params.get('q', '')
-        return Message.objects.filter(
-            chat_room_id=room_id,
-            content__icontains=q,
-            is_deleted=False
-        ).order_by('-created_at')
+        if not ChatParticipant.objects.filter(chat_room_id=room_id, user=self.request.user).exists():
+            raise PermissionDenied("You are not part of this room.")
+        return search_messages(self.request.user, self.request.query_params.get('q', ''), room_id=room_id)
+
+    def list(self, request, *args, **kwargs):
+        # Paginate the ranked ids, then load just that page in rank order.
+        page = self.paginate_queryset(self.get_hits())
+        messages = RoomMessageSerializer.eager_load(Message.objects.all()).in_bulk(page)
+        serializer = self.get_serializer([messages[i] for i in page if i in messages], many=True)
+        return self.get_paginated_response(serializer.data)
+
+class SearchAllMessagesView(SearchMessagesView):
+    """The same search across every room the user is in."""
+    serializer_class = MessageSearchResultSerializer
+
+    def get_hits(self):
+        return search_messages(self.request.user, self.request.query_params.get('q', ''))
 
 class PinMessageView(generics.GenericAPIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -434,4 +476,12 @@ class StickerPackListView(generics.ListAPIView):
 class StickerView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
     queryset = Sticker.objects.all()
-    serializer_class = StickerSerializer
\ No newline at end of file
+    serializer_class = StickerSerializer
+
+
+class GhostSuggestionStatsView(generics.GenericAPIView):
+    """Cache hit rate and latency of this worker's ghost suggestions."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(suggestion_metrics.snapshot())
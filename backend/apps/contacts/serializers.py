@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import Contact
+from apps.chat.related import related_users
 
 User = get_user_model()
 
@@ -40,11 +41,13 @@ class AddContactSerializer(serializers.ModelSerializer):
         contact_user = validated_data.pop("contact_user")
         validated_data.pop("phone_number")
 
-        return Contact.objects.create(
+        contact = Contact.objects.create(
             owner=owner,
             contact_user=contact_user,
             **validated_data
         )
+        related_users.contact_added(owner.id, contact_user.id)
+        return contact
 
 class ContactListSerializer(serializers.ModelSerializer):
     phone_number = serializers.CharField(source="contact_user.phone_number", read_only=True)
@@ -150,13 +150,131 @@ REST_FRAMEWORK = {
 
 ASGI_APPLICATION = 'aura_chat.asgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
+# Set REDIS_URL to run more than one Daphne worker: the channel layer and the
+# presence registry then live in Redis and are shared by every process. For
+# local multi-worker runs without Redis, `python manage.py redis_standin`.
+REDIS_URL = os.getenv("REDIS_URL")
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "apps.chat.layers.RedisPubSubChannelLayer",
+            "CONFIG": {"hosts": [REDIS_URL]},
+        },
+    }
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Delivery receipts are coalesced per sender over this many seconds.
+DELIVERY_RECEIPT_WINDOW = 0.25
+
+PRESENCE_CACHE = "default"
+PRESENCE_TTL = 60 * 60 * 24
+# A user is announced offline only if they are still gone this many seconds
+# after their last connection closes; changes go out to related users in one
+# batch per PRESENCE_BATCH_WINDOW seconds.
+PRESENCE_OFFLINE_GRACE = 5
+PRESENCE_BATCH_WINDOW = 1.0
+# Last-seen times and online state are served from the presence cache and
+# saved to the User table in one batch every this many seconds.
+LAST_SEEN_FLUSH_INTERVAL = 30
+# Presence goes to each user's related users (room mates and contacts). Those
+# sets are kept in memory per process for this many users, for at most
+# RELATED_USERS_TTL seconds.
+RELATED_USERS_CACHE_SIZE = 10000
+RELATED_USERS_TTL = 300
+
+# Message search index: "fts5" (SQLite), "postings" (any database) or "auto".
+# Run `python manage.py rebuild_search_index` after changing it.
+CHAT_SEARCH_BACKEND = os.getenv("CHAT_SEARCH_BACKEND", "auto")
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
+# Every worker shares one pool of LLM keys (apps.ai.key_pool). Each key may send
+# KEY_POOL_RPM requests a minute, in bursts of up to KEY_POOL_BURST; after
+# KEY_POOL_FAILURE_THRESHOLD failures in a row it is rested for KEY_POOL_COOLDOWN
+# seconds, doubling on each failed retry up to KEY_POOL_MAX_COOLDOWN. Callers
+# wait at most KEY_POOL_MAX_WAIT seconds for a free key.
+KEY_POOL_RPM = 30
+KEY_POOL_BURST = 5
+KEY_POOL_FAILURE_THRESHOLD = 3
+KEY_POOL_COOLDOWN = 30
+KEY_POOL_MAX_COOLDOWN = 600
+KEY_POOL_MAX_WAIT = 5
+# Cache alias shared by all workers for breaker state and per-minute counts
+# (None keeps them per process).
+KEY_POOL_CACHE = "default" if REDIS_URL else None
+
+# Translations kept in each worker's memory; the rest live in the database.
+TRANSLATION_CACHE_SIZE = 10000
+# translate_batch splits work into chunks of about this many prompt tokens,
+# runs up to TRANSLATION_WORKERS at once and retries failed chunks.
+TRANSLATION_CHUNK_TOKENS = 1500
+TRANSLATION_CHUNK_ITEMS = 50
+TRANSLATION_WORKERS = 4
+TRANSLATION_RETRIES = 2
+# Translation from async code (apps.ai.translation): "libretranslate" or "groq".
+# translate_text calls within TRANSLATION_BATCH_WINDOW seconds of each other
+# go out together, up to TRANSLATION_HTTP_BATCH texts per request.
+TRANSLATION_PROVIDER = os.getenv("TRANSLATION_PROVIDER", "libretranslate")
+LIBRETRANSLATE_URL = os.getenv("LIBRETRANSLATE_URL", "https://libretranslate.com")
+LIBRETRANSLATE_API_KEY = os.getenv("LIBRETRANSLATE_API_KEY")
+TRANSLATION_BATCH_WINDOW = 0.01
+TRANSLATION_HTTP_BATCH = 50
+TRANSLATION_HTTP_TIMEOUT = 10.0
+# Opt-in: translate each text message, as it is sent, into every language its
+# room's participants read. Translations already done when the message is
+# broadcast go out with it, later ones follow as a message_translated event.
+# All are stored on the message.
+CHAT_PRETRANSLATE = os.getenv("CHAT_PRETRANSLATE", "false").lower() == "true"
+
+# AI calls from the chat (analysis, ghost suggestions, summaries) must fit
+# every tier: (calls per minute, burst) per user, per room and in total.
+AI_RATE_LIMITS = {
+    "user": (20, 6),
+    "room": (30, 10),
+    "global": (60, 20),
+}
+# Background analysis waits up to this many seconds for a slot, then is dropped.
+AI_RATE_MAX_DEFER = 10
+# Cache alias shared by all workers for the buckets (None keeps them per process).
+AI_RATE_LIMIT_CACHE = "default" if REDIS_URL else None
+
+# Messages are analysed (mood, reply suggestions) once per room every
+# ANALYSIS_WINDOW seconds, and only if the window adds at least
+# ANALYSIS_MIN_NEW_WORDS words or a question. Each analysis moves the room's
+# mood score ANALYSIS_MOOD_SMOOTHING of the way to the new reading.
+ANALYSIS_WINDOW = 5
+ANALYSIS_MIN_NEW_WORDS = 4
+ANALYSIS_MOOD_SMOOTHING = 0.5
+# Rooms idle this long drop their in-memory analysis state.
+ANALYSIS_IDLE_TTL = 600
+
+# Rooms keep a tree of stored summaries: every SUMMARY_BLOCK_SIZE text messages
+# are summarized once, and every SUMMARY_FANOUT summaries are merged a level up.
+# The tree is brought up to date SUMMARY_UPDATE_DELAY seconds after activity.
+SUMMARY_BLOCK_SIZE = 50
+SUMMARY_FANOUT = 4
+SUMMARY_UPDATE_DELAY = 30
+# One update summarizes at most this many new blocks; the rest wait for the next.
+SUMMARY_MAX_BLOCKS_PER_UPDATE = 20
+# A catch-up includes at most this many raw (not yet summarized) messages, newest first.
+SUMMARY_MAX_RAW_MESSAGES = 2 * SUMMARY_BLOCK_SIZE
+
+# Ghost suggestions wait for this many seconds of quiet typing before calling
+# the model; continuations are cached per (recent messages, language, partial).
+GHOST_SUGGESTION_DEBOUNCE = 0.3
+GHOST_SUGGESTION_CACHE_SIZE = 5000
+
 GIPHY_API_KEY = os.getenv('GIPHY_API_KEY')
 print(f"🔥 GIPHY_API_KEY = {GIPHY_API_KEY}") 
\ No newline at end of file
@@ -9,6 +9,7 @@ urlpatterns = [
     path('api/chat/', include('apps.chat.urls')),
     path("api/contacts/", include("apps.contacts.urls")),
     path('api/status/', include('apps.status.urls')),
+    path('api/ai/', include('apps.ai.urls')),
 ] 
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -48,11 +48,15 @@ export function AuthProvider({ children }) {
       const data = JSON.parse(event.data);
       console.log("📡 Global socket raw:", data);
 
-      if (data.type === "presence_update") handlePresenceUpdate(data);
-
-      if (data.type === "delivered_receipt") {
-        const msgId = parseInt(data.message_id, 10);
-        setDeliveredMap((prev) => ({ ...prev, [msgId]: true }));
+      if (data.type === "presence_snapshot") setOnlineUsers(data.online);
+      if (data.type === "presence_batch") handlePresenceBatch(data);
+
+      if (data.type === "delivered_receipts") {
+        setDeliveredMap((prev) => {
+          const next = { ...prev };
+          data.message_ids.forEach((id) => { next[parseInt(id, 10)] = true; });
+          return next;
+        });
       }
 
       if (data.type === "ai_suggestions") setAiSuggestions(data);
@@ -68,14 +72,12 @@ export function AuthProvider({ children }) {
     return () => ws.close();
   }, [user]);
 
-  const handlePresenceUpdate = (data) => {
-    if (data.is_online) {
-      setOnlineUsers((prev) =>
-        prev.includes(data.user_id) ? prev : [...prev, data.user_id]
-      );
-    } else {
-      setOnlineUsers((prev) => prev.filter((id) => id !== data.user_id));
-    }
+  const handlePresenceBatch = (data) => {
+    setOnlineUsers((prev) => {
+      const next = prev.filter((id) => !data.offline.includes(id));
+      data.online.forEach((id) => { if (!next.includes(id)) next.push(id); });
+      return next;
+    });
   };
 
   const register = async (formData) => {